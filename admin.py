@@ -8,7 +8,8 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy 
 from argparse import ArgumentParser
 
-from src.database import User, db
+from src.database import User, EnrollmentJob, db, init_app, create_all
+from src import user_cache
 
 """ Script for creating/reseting/deleting users. """
 
@@ -18,20 +19,19 @@ if __name__ == '__main__':
     args.add_argument('-r', '--reset', action='store_true', required=False, help='Reset the user. This will reset all associated data!')
     args.add_argument('-d', '--delete', action='store_true', required=False, help='Delete the user. This will also delete all associated data!')
     args.add_argument('-l', '--list', action='store_true', required=False, help='List all users.')
+    args.add_argument('-j', '--jobs', action='store_true', required=False, help='List the enrollment jobs of a user, or of all users if no username is given.')
     args = args.parse_args()
 
-    if not args.username and not args.list:
+    if not args.username and not args.list and not args.jobs:
         print('You need to specify a username!')
         
         sys.exit(1)
 
     app = Flask(__name__)
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///asvz.db"
-    
-    db.init_app(app)
+    init_app(app)
 
     with app.app_context():
-        db.metadata.create_all(db.engine)
+        create_all()
         
         if args.list:
             users = db.session.execute(db.select(User)).scalars().all()
@@ -40,6 +40,16 @@ if __name__ == '__main__':
                 print(user.username)
             sys.exit(0)
 
+        if args.jobs:
+            query = db.select(User.username, EnrollmentJob).join(EnrollmentJob, EnrollmentJob.chat_id == User.chat_id)
+            if args.username:
+                query = query.where(User.username == args.username)
+            jobs = db.session.execute(query.order_by(User.username, EnrollmentJob.created_at)).all()
+            print("Jobs:")
+            for username, job in jobs:
+                print(f"{username}: {job.lesson_start.strftime('%d.%m.%y %H:%M')} - {job.title} ({job.location}) [{job.state}]")
+            sys.exit(0)
+
         if args.reset or args.delete:
             if args.delete:
                 print('Deleting user')
@@ -49,6 +59,7 @@ if __name__ == '__main__':
             if user:
                 db.session.delete(user)
                 db.session.commit()
+                user_cache.touch(app)
             else:
                 print(f"User '{args.username}' does not exist!")
                 sys.exit(1)
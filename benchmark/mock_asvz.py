@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+import secrets
+import threading
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from flask import Flask, request, redirect, render_template_string, make_response, jsonify, abort
+
+""" Mock of schalter.asvz.ch and its login flows for benchmarking the enroller, see run.py.
+
+Only reproduces what the selenium enroller relies on: the lesson page ("Online-Einschreibungen",
+"Datum/Zeit" and "Anlage" fields, the "ausgebucht" alert and btnRegister), the ASVZ login form and
+the SwitchAAI organisation selection and login. The lesson pages are served on LESSON_HOST and the
+login on AUTH_HOST, both names of the same server, so a login leaves the lesson site and comes back
+to it like on the real site. Every password except INVALID_PASSWORD is accepted.
+
+With heavy=True the lesson page also pulls images, a web font and a tracker script,
+which are served slowly like third-party resources of the real site.
+"""
+
+LESSON_HOST = "127.0.0.1"
+AUTH_HOST = "localhost"
+INVALID_PASSWORD = "invalid"
+SESSION_COOKIE = "mock_session"
+
+# resources of a heavy lesson page
+HEAVY_IMAGES = 12
+HEAVY_ASSET_SIZE = 200 * 1024
+HEAVY_ASSET_LATENCY = 0.2
+
+LESSON_PAGE = """<!DOCTYPE html>
+<html><head><title>{{ lesson.title }}</title>
+{% if heavy %}
+  <style>@font-face { font-family: "Mock"; src: url("/assets/fonts/mock.woff2"); } body { font-family: "Mock"; }</style>
+  <script src="/gtm.js"></script>
+{% endif %}
+</head>
+<body>
+{% if heavy %}{% for i in range(images) %}<img src="/assets/img/{{ i }}.jpg" width="1" height="1">{% endfor %}{% endif %}
+<app-root>
+{% if not user %}
+  <button class="btn btn-default" title="Login" onclick="location.href='{{ login_url }}'">Login</button>
+{% else %}
+  <span>Online-Einschreibungen sind ab {{ opening }} möglich.</span>
+{% endif %}
+<h1>{{ lesson.title }}</h1>
+<dl><dt>Datum/Zeit</dt><dd>{{ interval }}</dd></dl>
+<dl><dt>Anlage</dt><dd>{{ lesson.location }}</dd></dl>
+<div id="alerts">
+{% if full and not enrolled %}<div class="alert alert-warning">Diese Lektion ist ausgebucht.</div>{% endif %}
+</div>
+{% if user %}
+  <button id="btnRegister" class="btn btn-primary" {% if not enrolled %}disabled{% endif %}>
+    {% if enrolled %}EINSCHREIBUNG ENTFERNEN{% else %}EINSCHREIBEN{% endif %}
+  </button>
+  <script>
+    var button = document.getElementById("btnRegister");
+    {% if not enrolled and not full %}
+    setTimeout(function () { button.disabled = false; }, {{ remaining_ms }});
+    {% endif %}
+    button.onclick = function () {
+      if (button.textContent.indexOf("ENTFERNEN") >= 0) { return; }
+      button.disabled = true;
+      fetch("{{ register_url }}", {method: "POST", credentials: "same-origin"})
+        .then(function (response) { return response.json(); })
+        .then(function (result) {
+          var alerts = document.getElementById("alerts");
+          if (result.enrolled) {
+            button.textContent = "EINSCHREIBUNG ENTFERNEN";
+            button.disabled = false;
+            alerts.innerHTML = '<div id="enrollmentConfirmation" class="alert alert-success">Einschreibung erfolgreich.</div>';
+          } else {
+            alerts.innerHTML = '<div class="alert alert-warning">Diese Lektion ist ausgebucht.</div>';
+          }
+        });
+    };
+  </script>
+{% endif %}
+</app-root>
+</body></html>
+"""
+
+NOT_FOUND_PAGE = """<!DOCTYPE html><html><body><app-root><app-page-not-found>Seite nicht gefunden</app-page-not-found></app-root></body></html>"""
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html><body>
+<form method="post" action="/account/login?next={{ next }}">
+  <input id="AsvzId" name="username">
+  <input id="Password" name="password" type="password">
+  <button type="submit">Login</button>
+</form>
+<button class="btn btn-warning btn-block" title="SwitchAai Account Login" onclick="location.href='/switchaai/wayf?next={{ next }}'">SwitchAai</button>
+</body></html>
+"""
+
+WAYF_PAGE = """<!DOCTYPE html>
+<html><body>
+<form method="post" action="/switchaai/wayf?next={{ next }}">
+  <input id="userIdPSelection_iddtext" name="organisation">
+</form>
+</body></html>
+"""
+
+IDP_PAGE = """<!DOCTYPE html>
+<html><body>
+<p>{{ organisation }}</p>
+<form method="post" action="/switchaai/login?next={{ next }}">
+  <input id="username" name="username">
+  <input id="password" name="password" type="password">
+  <button type="submit">Login</button>
+</form>
+</body></html>
+"""
+
+
+class Lesson:
+    def __init__(self, lesson_id, opening, capacity, title="Mock Lesson", location="Sport Center Polyterrasse"):
+        self.lesson_id = lesson_id
+        # unix time enrollment opens
+        self.opening = opening
+        self.capacity = capacity
+        self.title = title
+        self.location = location
+        self.start = datetime.fromtimestamp(opening) + timedelta(days=1)
+        # username: unix time of the registration
+        self.registrations = {}
+
+    def is_full(self):
+        return len(self.registrations) >= self.capacity
+
+
+class MockAsvz:
+    def __init__(self, lessons, port, latency=0.0, lesson_host=LESSON_HOST, auth_host=AUTH_HOST, heavy=False):
+        self.lessons = {lesson.lesson_id: lesson for lesson in lessons}
+        self.latency = latency
+        self.heavy = heavy
+        self.lesson_base = "http://{}:{}".format(lesson_host, port)
+        self.auth_base = "http://{}:{}".format(auth_host, port)
+        self.lesson_host = lesson_host
+        # token: username, handed from the login to the lesson site
+        self.tokens = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def user(self):
+        return self.sessions.get(request.cookies.get(SESSION_COOKIE))
+
+    def login(self, username, password, next_url):
+        if password == INVALID_PASSWORD:
+            return render_template_string(LOGIN_PAGE, next=quote(next_url, safe="")), 401
+        token = secrets.token_urlsafe(16)
+        with self.lock:
+            self.tokens[token] = username
+        return redirect("{}/signin?token={}&next={}".format(self.lesson_base, token, quote(next_url, safe="")))
+
+    def register(self, lesson, username):
+        with self.lock:
+            now = time.time()
+            if username in lesson.registrations:
+                return True
+            if now < lesson.opening or lesson.is_full():
+                return False
+            lesson.registrations[username] = now
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                lesson.lesson_id: {"opening": lesson.opening, "capacity": lesson.capacity, "registrations": dict(lesson.registrations)}
+                for lesson in self.lessons.values()
+            }
+
+    def create_app(self):
+        app = Flask(__name__)
+        mock = self
+
+        @app.before_request
+        def inject_latency():
+            if mock.latency > 0 and not request.path.startswith("/__"):
+                time.sleep(mock.latency)
+
+        @app.route("/")
+        def index():
+            return "mock schalter.asvz.ch"
+
+        @app.route("/tn/lessons/<lesson_id>")
+        def lesson_page(lesson_id):
+            lesson = mock.lessons.get(lesson_id)
+            if lesson is None:
+                return NOT_FOUND_PAGE
+            user = mock.user()
+            start = lesson.start
+            return render_template_string(
+                LESSON_PAGE,
+                lesson=lesson,
+                user=user,
+                heavy=mock.heavy,
+                images=HEAVY_IMAGES,
+                opening=datetime.fromtimestamp(lesson.opening).strftime("%d.%m.%Y %H:%M"),
+                interval="{}, {} - {}".format(start.strftime("%a"), start.strftime("%d.%m.%Y %H:%M"), (start + timedelta(hours=1)).strftime("%H:%M")),
+                full=lesson.is_full(),
+                enrolled=user in lesson.registrations,
+                remaining_ms=max(0, int((lesson.opening - time.time()) * 1000)),
+                login_url="{}/account/login?next={}".format(mock.auth_base, quote(request.base_url, safe="")),
+                register_url="/tn/lessons/{}/register".format(lesson_id),
+            )
+
+        @app.route("/tn/lessons/<lesson_id>/register", methods=["POST"])
+        def register(lesson_id):
+            lesson = mock.lessons.get(lesson_id)
+            user = mock.user()
+            if lesson is None or user is None:
+                abort(404 if lesson is None else 401)
+            return jsonify(enrolled=mock.register(lesson, user))
+
+        @app.route("/signin")
+        def signin():
+            with mock.lock:
+                username = mock.tokens.pop(request.args.get("token"), None)
+            if username is None:
+                abort(401)
+            session = secrets.token_urlsafe(16)
+            mock.sessions[session] = username
+            response = make_response(redirect(request.args.get("next") or "/"))
+            response.set_cookie(SESSION_COOKIE, session)
+            return response
+
+        @app.route("/account/login", methods=["GET", "POST"])
+        def asvz_login():
+            next_url = request.args.get("next", mock.lesson_base)
+            if request.method == "GET":
+                return render_template_string(LOGIN_PAGE, next=quote(next_url, safe=""))
+            return mock.login(request.form["username"], request.form["password"], next_url)
+
+        @app.route("/switchaai/wayf", methods=["GET", "POST"])
+        def wayf():
+            next_url = request.args.get("next", mock.lesson_base)
+            if request.method == "GET":
+                return render_template_string(WAYF_PAGE, next=quote(next_url, safe=""))
+            return render_template_string(IDP_PAGE, organisation=request.form.get("organisation", ""), next=quote(next_url, safe=""))
+
+        @app.route("/switchaai/login", methods=["POST"])
+        def idp_login():
+            return mock.login(request.form["username"], request.form["password"], request.args.get("next", mock.lesson_base))
+
+        @app.route("/assets/<path:name>")
+        def asset(name):
+            time.sleep(HEAVY_ASSET_LATENCY)
+            response = make_response(bytes(HEAVY_ASSET_SIZE))
+            response.headers["Cache-Control"] = "no-store"
+            return response
+
+        @app.route("/gtm.js")
+        def tracker():
+            time.sleep(HEAVY_ASSET_LATENCY)
+            return app.response_class("window.dataLayer = [];", mimetype="application/javascript")
+
+        @app.route("/__stats")
+        def stats():
+            return jsonify(mock.stats())
+
+        return app
+
+
+def make_lessons(count, opens_in, capacity):
+    opening = time.time() + opens_in
+    return [Lesson(str(100000 + i), opening, capacity, title="Mock Lesson {}".format(i + 1)) for i in range(count)]
+
+
+if __name__ == '__main__':
+    args = ArgumentParser(description="Mock ASVZ server for benchmarking the enroller.")
+    args.add_argument('--port', type=int, default=5100)
+    args.add_argument('--lessons', type=int, default=1, help='Number of lessons.')
+    args.add_argument('--capacity', type=int, default=10, help='Places per lesson.')
+    args.add_argument('--opens-in', type=float, default=120, help='Seconds until enrollment opens.')
+    args.add_argument('--latency', type=float, default=0, help='Seconds added to every request.')
+    args.add_argument('--heavy', action='store_true', help='Lesson pages load images, a font and a tracker.')
+    args.add_argument('--lesson-host', default=LESSON_HOST)
+    args.add_argument('--auth-host', default=AUTH_HOST)
+    args = args.parse_args()
+
+    mock = MockAsvz(make_lessons(args.lessons, args.opens_in, args.capacity), args.port, args.latency, args.lesson_host, args.auth_host, args.heavy)
+    for lesson_id in mock.lessons:
+        print("{}/tn/lessons/{}".format(mock.lesson_base, lesson_id))
+    mock.create_app().run(host="0.0.0.0", port=args.port, threaded=True)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from selenium import webdriver
+from werkzeug.serving import make_server
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import auth_cache
+import browser_profile
+import enroller
+from mock_asvz import MockAsvz, make_lessons, LESSON_HOST, AUTH_HOST
+from run import percentile
+
+"""
+Page load benchmark of the default and the lean browser profile, see browser_profile.
+
+Loads the heavy lesson page of the mock ASVZ server in a few sessions per profile and
+reports the page load time, the requests and bytes the page pulled and the JavaScript
+heap per session as reported by DevTools.
+
+    python benchmark/page_load.py --sessions 2 --loads 10
+"""
+
+PROFILES = (("default", False), ("lean", True))
+MB = 1024 * 1024
+
+
+def heap_size(driver):
+    auth_cache.cdp(driver, "Performance.enable")
+    metrics = auth_cache.cdp(driver, "Performance.getMetrics")["metrics"]
+    return next((metric["value"] for metric in metrics if metric["name"] == "JSHeapTotalSize"), 0)
+
+
+def measure(selenium_url, lesson_url, lean, sessions, loads):
+    browser_profile.configure(lean)
+    load_times = []
+    heaps = []
+    requests = []
+    transferred = []
+    for _ in range(sessions):
+        driver = webdriver.Remote(command_executor=selenium_url, options=enroller.AsvzEnroller.get_options())
+        try:
+            browser_profile.block_resources(driver)
+            for _ in range(loads):
+                start = time.perf_counter()
+                # returns once the load event fired, i.e. every resource that was not blocked arrived
+                driver.get(lesson_url)
+                load_times.append(time.perf_counter() - start)
+                resources = driver.execute_script(
+                    "return performance.getEntriesByType('resource').map(function (r) { return r.transferSize; });"
+                )
+                requests.append(len(resources))
+                transferred.append(sum(resources))
+            heaps.append(heap_size(driver))
+        finally:
+            driver.quit()
+    return {
+        "load_p50": percentile(load_times, 50),
+        "load_p99": percentile(load_times, 99),
+        "requests": sum(requests) / len(requests),
+        "transferred": sum(transferred) / len(transferred),
+        "heap": sum(heaps) / len(heaps),
+    }
+
+
+if __name__ == '__main__':
+    args = ArgumentParser(description="Compare page loads of the default and the lean browser profile.")
+    args.add_argument('--sessions', type=int, default=2, help='Browser sessions per profile.')
+    args.add_argument('--loads', type=int, default=10, help='Page loads per session.')
+    args.add_argument('--latency', type=float, default=0, help='Seconds the mock adds to every request.')
+    args.add_argument('--port', type=int, default=5100)
+    args.add_argument('--lesson-host', default=LESSON_HOST, help='Host name of the mock as seen by the browser.')
+    args.add_argument('--selenium', default="http://localhost:4444/wd/hub", help='Selenium server.')
+    args = args.parse_args()
+
+    mock = MockAsvz(make_lessons(1, 60, 1), args.port, args.latency, args.lesson_host, AUTH_HOST, heavy=True)
+    server = make_server("0.0.0.0", args.port, mock.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    lesson_url = "{}/tn/lessons/{}".format(mock.lesson_base, next(iter(mock.lessons)))
+
+    try:
+        results = {name: measure(args.selenium, lesson_url, lean, args.sessions, args.loads) for name, lean in PROFILES}
+    finally:
+        server.shutdown()
+
+    print("{:<8} {:>10} {:>10} {:>9} {:>12} {:>10}".format("profile", "load p50", "load p99", "requests", "transferred", "JS heap"))
+    for name, result in results.items():
+        print("{:<8} {:>9.3f}s {:>9.3f}s {:>9.1f} {:>10.2f}MB {:>8.1f}MB".format(
+            name, result["load_p50"], result["load_p99"], result["requests"], result["transferred"] / MB, result["heap"] / MB,
+        ))
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+import json
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import requests
+from loguru import logger
+from werkzeug.serving import make_server
+
+# the enroller reads lesson times as local time in Zurich
+os.environ["TZ"] = "Europe/Zurich"
+time.tzset()
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import browser_profile
+import driver_pool
+import enroller
+from driver_pool import DriverPool
+from mock_asvz import MockAsvz, make_lessons, LESSON_HOST, AUTH_HOST
+
+"""
+End-to-end benchmark of the selenium enroller against the mock ASVZ server in mock_asvz.py.
+
+Runs N enrollment jobs in worker processes like the scheduler does, all for lessons opening
+at the same time, and reports the time from the opening to the registration (as recorded by
+the mock), the seconds a browser session was held and the success rate. Needs a selenium
+server whose browser can reach the mock under both host names.
+
+    python benchmark/run.py --jobs 8 --capacity 4 --latency 0.05
+"""
+
+OUTCOME_ENROLLED = "enrolled"
+OUTCOME_FULL = "full"
+
+
+class TimedDriverPool(DriverPool):
+    """ Driver pool that adds up the seconds its sessions were held by this process. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.held = 0.0
+        self._acquired = {}
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_acquired"] = {}
+        return state
+
+    def acquire(self, key, fresh=False):
+        driver = super().acquire(key, fresh)
+        self._acquired[driver.session_id] = time.perf_counter()
+        return driver
+
+    def release(self, key, driver, broken=None):
+        acquired = self._acquired.pop(driver.session_id, None)
+        if acquired is not None:
+            self.held += time.perf_counter() - acquired
+        super().release(key, driver, broken)
+
+
+def configure(selenium_url, lesson_base, pool_url, max_sessions, lean, log_level):
+    """ Points the enroller of a worker process at the mock. """
+    logger.remove()
+    logger.add(sys.stderr, level=log_level)
+    browser_profile.configure(lean)
+    enroller.SELENIUM_URL = selenium_url
+    enroller.LESSON_BASE_URL = lesson_base
+    enroller.DRIVER_POOL = TimedDriverPool(
+        selenium_url, enroller.AsvzEnroller.get_options, url=pool_url, max_sessions=max_sessions,
+        session_setup=browser_profile.block_resources,
+    )
+
+
+def run_job(username, organisation, password, lesson_url, opening):
+    enrollment_start = datetime.fromtimestamp(opening)
+    metadata = {
+        "title": "Mock Lesson",
+        "location": "Sport Center Polyterrasse",
+        "enrollment_start": enrollment_start,
+        "lesson_start": enrollment_start + timedelta(days=1),
+    }
+    job = enroller.get_enroller(lesson_url, username, password, organisation, metadata=metadata, id=username)
+    held = enroller.DRIVER_POOL.held
+    start = time.perf_counter()
+    try:
+        job.enroll()
+        outcome = OUTCOME_ENROLLED
+    except enroller.LessonFull:
+        outcome = OUTCOME_FULL
+    except Exception as e:
+        logger.error("Job of {} failed: {}".format(username, e))
+        outcome = type(e).__name__
+    return {
+        "username": username,
+        "lesson_id": enroller.get_lesson_id(lesson_url),
+        "outcome": outcome,
+        "seconds": time.perf_counter() - start,
+        "browser_seconds": enroller.DRIVER_POOL.held - held,
+    }
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile, None without values. """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(results, stats):
+    delays = []
+    registered = set()
+    for lesson in stats.values():
+        for username, registered_at in lesson["registrations"].items():
+            delays.append(registered_at - lesson["opening"])
+            registered.add(username)
+    places = sum(lesson["capacity"] for lesson in stats.values())
+    return {
+        "jobs": len(results),
+        "places": places,
+        "enrolled": len(registered),
+        # a job can only succeed while there are places
+        "success_rate": len(registered) / min(len(results), places) if results and places else 0.0,
+        "reported_enrolled": sum(1 for result in results if result["outcome"] == OUTCOME_ENROLLED),
+        "time_to_enroll_p50": percentile(delays, 50),
+        "time_to_enroll_p99": percentile(delays, 99),
+        "browser_seconds": sum(result["browser_seconds"] for result in results),
+        "job_seconds_p50": percentile([result["seconds"] for result in results], 50),
+        "errors": sorted({result["outcome"] for result in results} - {OUTCOME_ENROLLED, OUTCOME_FULL}),
+    }
+
+
+def print_summary(summary):
+    def seconds(value):
+        return "-" if value is None else "{:.3f}s".format(value)
+
+    print("jobs:                 {}".format(summary["jobs"]))
+    print("places:               {}".format(summary["places"]))
+    print("enrolled:             {} (jobs reporting success: {})".format(summary["enrolled"], summary["reported_enrolled"]))
+    print("success rate:         {:.1%}".format(summary["success_rate"]))
+    print("time to enroll p50:   {}".format(seconds(summary["time_to_enroll_p50"])))
+    print("time to enroll p99:   {}".format(seconds(summary["time_to_enroll_p99"])))
+    print("browser-seconds:      {:.1f}".format(summary["browser_seconds"]))
+    print("job duration p50:     {}".format(seconds(summary["job_seconds_p50"])))
+    if summary["errors"]:
+        print("errors:               {}".format(", ".join(summary["errors"])))
+
+
+if __name__ == '__main__':
+    args = ArgumentParser(description="Benchmark the enroller against a mock ASVZ server.")
+    args.add_argument('-n', '--jobs', type=int, default=6, help='Number of enrollment jobs.')
+    args.add_argument('-w', '--workers', type=int, default=3, help='Worker processes, like the scheduler\'s process pool.')
+    args.add_argument('--lessons', type=int, default=1, help='Number of lessons the jobs are spread over.')
+    args.add_argument('--capacity', type=int, default=10, help='Places per lesson.')
+    args.add_argument('--opens-in', type=float, default=30, help='Seconds until enrollment opens, jobs start right away.')
+    args.add_argument('--latency', type=float, default=0, help='Seconds the mock adds to every request.')
+    args.add_argument('--heavy', action='store_true', help='Lesson pages load images, fonts and a tracker like the real site.')
+    args.add_argument('--lean', action='store_true', help='Use the lean browser profile.')
+    args.add_argument('--organisations', default="ASVZ", help='Comma separated organisations the users are spread over, e.g. ASVZ,ETH.')
+    args.add_argument('--password', default="secret", help='Password of all users, "invalid" fails every login.')
+    args.add_argument('--port', type=int, default=5100)
+    args.add_argument('--lesson-host', default=LESSON_HOST, help='Host name of the mock as seen by the browser.')
+    args.add_argument('--auth-host', default=AUTH_HOST, help='Second host name of the mock, used for the login.')
+    args.add_argument('--selenium', default="http://localhost:4444/wd/hub", help='Selenium server.')
+    args.add_argument('--max-sessions', type=int, default=driver_pool.MAX_SESSIONS, help='Size of the selenium session pool.')
+    args.add_argument('--log-level', default="WARNING")
+    args.add_argument('--json', help='Also write the summary and all job results to this file.')
+    args = args.parse_args()
+
+    organisations = args.organisations.split(",")
+    for organisation in organisations:
+        if organisation not in enroller.ORGANISATIONS:
+            sys.exit("Unknown organisation '{}'".format(organisation))
+
+    mock = MockAsvz(make_lessons(args.lessons, args.opens_in, args.capacity), args.port, args.latency, args.lesson_host, args.auth_host, args.heavy)
+    server = make_server("0.0.0.0", args.port, mock.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    lessons = list(mock.lessons.values())
+    with tempfile.TemporaryDirectory() as tmp:
+        pool_url = "sqlite:///{}".format(Path(tmp) / "driver_pool.db")
+        executor = ProcessPoolExecutor(
+            args.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=configure,
+            initargs=(args.selenium, mock.lesson_base, pool_url, args.max_sessions, args.lean, args.log_level),
+        )
+        with executor:
+            futures = []
+            for i in range(args.jobs):
+                lesson = lessons[i % len(lessons)]
+                futures.append(executor.submit(
+                    run_job,
+                    "bench{}".format(i),
+                    organisations[i % len(organisations)],
+                    args.password,
+                    "{}/tn/lessons/{}".format(mock.lesson_base, lesson.lesson_id),
+                    lesson.opening,
+                ))
+            results = [future.result() for future in futures]
+            # quit the sessions left in the pool
+            configure(args.selenium, mock.lesson_base, pool_url, args.max_sessions, args.lean, args.log_level)
+            enroller.DRIVER_POOL.close()
+
+    stats = requests.get("{}/__stats".format(mock.lesson_base), timeout=10).json()
+    server.shutdown()
+
+    summary = summarize(results, stats)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "summary": summary, "results": results}, f, indent=2)
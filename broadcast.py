@@ -1,43 +1,150 @@
 #!/usr/bin/env python
 import sys
+import time
 from flask import current_app, Flask
-from flask_sqlalchemy import SQLAlchemy 
+from flask_sqlalchemy import SQLAlchemy
 from argparse import ArgumentParser
 import asyncio
 from telegram import Bot
+from telegram.error import RetryAfter, Forbidden, BadRequest, TelegramError
 import yaml
 
-from src.database import User, db
+from src.database import User, Broadcast, BroadcastDelivery, db, init_app, create_all
+from src.ratelimit import RateLimiter, retry_delay, GLOBAL_RATE
+
+""" Script for broadcasting messages to all users.
+
+Deliveries are checkpointed in the database. If a broadcast gets interrupted it can be
+continued with --resume, users that already received the message are skipped.
+"""
+
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 2
+
+
+def start_broadcast(message):
+    broadcast = Broadcast(message=message, created_at=time.time())
+    db.session.add(broadcast)
+    db.session.flush()
+    users = db.session.execute(db.select(User).where(User.verified == 1)).scalars().all()
+    for user in users:
+        db.session.add(BroadcastDelivery(broadcast_id=broadcast.id, username=user.username, chat_id=user.chat_id, status='pending'))
+    db.session.commit()
+    return broadcast
+
+
+def find_broadcast(broadcast_id=None):
+    """ Returns the broadcast with the given id or the latest unfinished one. """
+    if broadcast_id is not None:
+        return db.session.get(Broadcast, broadcast_id)
+    return db.session.execute(
+        db.select(Broadcast).where(Broadcast.finished_at.is_(None)).order_by(Broadcast.id.desc())
+    ).scalars().first()
+
+
+def set_status(broadcast_id, username, status, error=None):
+    db.session.execute(
+        db.update(BroadcastDelivery)
+        .where(BroadcastDelivery.broadcast_id == broadcast_id, BroadcastDelivery.username == username)
+        .values(status=status, error=error)
+    )
+    db.session.commit()
+
+
+async def deliver(bot, limiter, broadcast_id, username, chat_id, text, stats):
+    error = 'rate limited too often'
+    for attempt in range(MAX_ATTEMPTS):
+        await limiter.wait(chat_id)
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter as e:
+            await asyncio.sleep(retry_delay(e))
+            continue
+        except (Forbidden, BadRequest) as e:
+            # the user blocked the bot or the chat does not exist anymore, retrying will not help
+            error = str(e)
+            break
+        except TelegramError as e:
+            error = str(e)
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+            continue
+        set_status(broadcast_id, username, 'sent')
+        stats['sent'] += 1
+        print('Sent message to user {}'.format(username))
+        return
+    set_status(broadcast_id, username, 'failed', error)
+    stats['failed'] += 1
+    print('Failed to send message to user {}: {}'.format(username, error))
+
+
+async def run_broadcast(bot, broadcast, rate, retry_failed=False):
+    statuses = ['pending', 'failed'] if retry_failed else ['pending']
+    deliveries = db.session.execute(
+        db.select(BroadcastDelivery)
+        .where(BroadcastDelivery.broadcast_id == broadcast.id, BroadcastDelivery.status.in_(statuses))
+    ).scalars().all()
+    deliveries = [(d.username, d.chat_id) for d in deliveries]
+    print('Delivering to {} users'.format(len(deliveries)))
+
+    limiter = RateLimiter(rate=rate)
+    stats = {'sent': 0, 'failed': 0}
+    start = time.monotonic()
+    async with bot:
+        await asyncio.gather(*(
+            deliver(bot, limiter, broadcast.id, username, chat_id, broadcast.message, stats)
+            for username, chat_id in deliveries
+        ))
+    elapsed = time.monotonic() - start
+
+    remaining = db.session.execute(
+        db.select(db.func.count()).select_from(BroadcastDelivery)
+        .where(BroadcastDelivery.broadcast_id == broadcast.id, BroadcastDelivery.status == 'pending')
+    ).scalar()
+    if remaining == 0:
+        broadcast.finished_at = time.time()
+        db.session.commit()
+    return stats, elapsed
 
-""" Script for broadcasting messages to all users. """
 
 if __name__ == '__main__':
     app = Flask(__name__)
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///asvz.db"
-    # create the extension
-    db.init_app(app)
+    init_app(app)
 
     # load config
     config = None
     with open("config.yaml", "r") as f:
         config = yaml.safe_load(f)
-        
+
     args = ArgumentParser()
-    args.add_argument('-m', '--message', type=str, required=True)
+    args.add_argument('-m', '--message', type=str, required=False, help='Message to broadcast.')
+    args.add_argument('--resume', nargs='?', type=int, const=-1, default=None, metavar='ID', help='Resume an interrupted broadcast, defaults to the latest unfinished one.')
+    args.add_argument('--retry-failed', action='store_true', help='When resuming, also retry deliveries that failed.')
+    args.add_argument('--rate', type=float, default=GLOBAL_RATE, help='Maximum messages per second.')
 
     args = args.parse_args()
 
-    print("Broadcasting message...")
-    print(args.message)
+    if args.message is None and args.resume is None:
+        print('You need to specify a message or --resume!')
+        sys.exit(1)
 
     bot = Bot(token=config["bot"]["token"])
 
     with app.app_context():
-        users = db.session.execute(db.select(User)).scalars().all()
-        for user in users:
-            if user.verified == 1:
-                print('Sending message to user {}'.format(user.username))
-                asyncio.run(bot.send_message(chat_id=user.chat_id, text=args.message))
-
-            else:
-                print('User {} is not verified'.format(user.username))
\ No newline at end of file
+        create_all()
+
+        if args.resume is not None:
+            broadcast = find_broadcast(None if args.resume == -1 else args.resume)
+            if broadcast is None:
+                print('No broadcast to resume')
+                sys.exit(1)
+            print("Resuming broadcast {}...".format(broadcast.id))
+        else:
+            broadcast = start_broadcast(args.message)
+            print("Broadcasting message as broadcast {}...".format(broadcast.id))
+        print(broadcast.message)
+
+        stats, elapsed = asyncio.run(run_broadcast(bot, broadcast, args.rate, args.retry_failed))
+
+        total = stats['sent'] + stats['failed']
+        print('Sent {} of {} messages, {} failed, in {:.1f}s ({:.1f} messages/s)'.format(
+            stats['sent'], total, stats['failed'], elapsed, total / elapsed if elapsed > 0 else 0))
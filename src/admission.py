@@ -0,0 +1,124 @@
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from statistics import median
+from typing import List, Optional
+
+from database import LessonFill, db
+from app import app as flask_app
+
+"""
+Admission of the enrollment jobs of lessons that open at the same minute.
+
+Many lessons open at the same wall-clock minute and all their jobs fire at once, while
+the grid only runs a few browser sessions. The jobs of an opening are ranked by how
+quickly their lessons were fully booked in past weeks, lessons that fill up fastest go
+first and lessons that never filled up go last. The jobs start in that order, so the
+workers take them in that order, and only as many jobs as the grid has sessions get
+logged in ahead of the opening. Those pre-logins are spread over PRELOGIN_SPREAD
+seconds instead of hitting the login pages at the same time.
+"""
+
+# seconds over which the pre-logins of an opening are spread, they start PREWARM_LEAD before it
+PRELOGIN_SPREAD = 90
+# seconds between the starts of consecutive jobs of an opening, only orders them
+ADMISSION_STEP = 0.05
+# fills older than this many seconds do not count for the priority anymore
+FILL_HISTORY = 8 * 7 * 24 * 60 * 60
+
+
+def capacity(nodes):
+    """ Browser sessions the grid runs at once, see driver_pool.Node. """
+    return sum(node.capacity for node in nodes)
+
+
+def series(title, location, lesson_start):
+    """ Key shared by the weekly recurrences of a lesson. """
+    return "{}|{}|{}".format(title, location, lesson_start.strftime("%a %H:%M"))
+
+
+def record_full(lesson_id, title, location, lesson_start, enrollment_start):
+    """ Remembers how soon after the opening a lesson was full, only the first time it is seen full. """
+    with flask_app.app_context():
+        if db.session.get(LessonFill, lesson_id) is not None:
+            return
+        full_after = max((datetime.today() - enrollment_start).total_seconds(), 0)
+        db.session.add(LessonFill(
+            lesson_id=lesson_id,
+            series=series(title, location, lesson_start),
+            full_after=full_after,
+            recorded_at=time.time(),
+        ))
+        db.session.commit()
+
+
+def fill_times(keys):
+    """ Median seconds after the opening the lessons of each series were full, series that never filled up are missing. """
+    keys = set(keys)
+    if not keys:
+        return {}
+    with flask_app.app_context():
+        rows = db.session.execute(
+            db.select(LessonFill.series, LessonFill.full_after).where(
+                LessonFill.series.in_(keys), LessonFill.recorded_at > time.time() - FILL_HISTORY
+            )
+        ).all()
+    fills = {}
+    for key, full_after in rows:
+        fills.setdefault(key, []).append(full_after)
+    return {key: median(values) for key, values in fills.items()}
+
+
+@dataclass
+class Unit:
+    """ A job firing at an opening: the job of a lesson or the batch job of a user, with the registry entries of its lessons. """
+    job_id: str
+    enrollment_start: datetime
+    lessons: list = field(default_factory=list)
+
+    @property
+    def series(self):
+        return [series(lesson.title, lesson.location, lesson.lesson_start) for lesson in self.lessons]
+
+    @property
+    def created_at(self):
+        return min(lesson.created_at or 0 for lesson in self.lessons)
+
+
+@dataclass
+class Admission:
+    unit: Unit
+    rank: int
+    # when the job starts, it logs in unless warm and waits for the opening itself
+    start: datetime
+    # when the session of the job is logged in, None if it logs in when it starts
+    prelogin: Optional[datetime]
+
+
+def priority(unit, fills):
+    """ Sort key of a unit, the lesson of it that filled up fastest counts. Ties are first come, first served. """
+    times = [fills[key] for key in unit.series if key in fills]
+    return (not times, min(times) if times else 0, unit.created_at, unit.job_id)
+
+
+def plan(units, sessions, lead, prelogin_lead, fills=None) -> List[Admission]:
+    """ Start and pre-login times of the units of an opening, by rank.
+
+    :param sessions: browser sessions of the grid, only that many units are logged in ahead
+    :param lead: seconds before its enrollment start a job starts
+    :param prelogin_lead: seconds before its enrollment start the first pre-login runs
+    :param fills: fill_times() of the series of the units, looked up if None
+    """
+    if fills is None:
+        fills = fill_times(key for unit in units for key in unit.series)
+    ranked = sorted(units, key=lambda unit: priority(unit, fills))
+    prelogins = max(min(len(ranked), sessions), 1)
+    spread = PRELOGIN_SPREAD / prelogins
+    admissions = []
+    for rank, unit in enumerate(ranked):
+        start = unit.enrollment_start - timedelta(seconds=lead - rank * ADMISSION_STEP)
+        prelogin = None
+        if rank < sessions:
+            prelogin = unit.enrollment_start - timedelta(seconds=prelogin_lead - rank * spread)
+        admissions.append(Admission(unit, rank, start, prelogin))
+    return admissions
@@ -1,22 +1,23 @@
-from flask import Flask, request, render_template, redirect, session
+from flask import Flask, Response, request, render_template, redirect, session
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from passlib.hash import sha256_crypt
 from wtforms import Form, StringField, validators, PasswordField, SelectField
 import secrets
 import yaml
 
-from database import User, db
+from database import User, AuthSession, db, init_app
 from utils import encrypt
-from enroller import ORGANISATIONS
+import metrics
+import user_cache
+from enroller import ORGANISATIONS, AsvzEnroller, CREDENTIALS_UNAME, CREDENTIALS_ORG
 
 
 app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///asvz.db"
 
 # initialize the app with the extension
 login_manager = LoginManager()
 login_manager.init_app(app)
-db.init_app(app)
+init_app(app)
 
 # load config
 config = None
@@ -69,6 +70,10 @@ def credentials():
     form = ASVZCredentialsForm(request.form)
     if form.validate():
         user = current_user
+        if user.asvz_organisation in ORGANISATIONS:
+            # the cached login session belongs to the old credentials
+            key = AsvzEnroller.pool_key({CREDENTIALS_UNAME: user.asvz_username, CREDENTIALS_ORG: ORGANISATIONS[user.asvz_organisation]})
+            db.session.execute(db.delete(AuthSession).where(AuthSession.key == key))
         user.asvz_username = request.form['username']
         user.asvz_password = encrypt(request.form['password'], config["app"]["secret"])
         user.asvz_organisation = request.form['organisation']
@@ -78,6 +83,8 @@ def credentials():
         user.chat_id = 0
         user.verified = -1
         db.session.commit()
+        # the bot caches users by chat
+        user_cache.touch(app)
         return redirect('/welcome')
     else:
         return render_template('welcome.html', user=current_user, form=form, token=AccessToken(data={'access_token': current_user.access_token}), bot_link=config["bot"]["link"])
@@ -90,6 +97,11 @@ def welcome():
     form_data = {'username': user.asvz_username, 'organisation': user.asvz_organisation, 'password': 'placeholder' if user.asvz_password else None}
     return render_template('welcome.html', user=current_user, form=ASVZCredentialsForm(data=form_data), token=AccessToken(data={'access_token': user.access_token, 'telegram_account': "Not yet linked!" if not user.telegram_username else user.telegram_username}),  bot_link=config["bot"]["link"])
 
+@app.route('/metrics')
+def metrics_endpoint():
+    # samples are collected by the enrollment workers of the bot, see metrics.py
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/logout')
 def logout():
     logout_user()
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import time
+
+from selenium.common.exceptions import WebDriverException
+from loguru import logger
+
+"""
+Helpers for the cached login session of an ASVZ account.
+
+A session state is a plain dict so it can be stored encrypted in the database:
+    {"cookies": [...], "access_token": str or None, "expires": unix time}
+Cookies use the Chrome DevTools format (name, value, domain, path, expires, ...),
+they cover schalter/auth.asvz.ch as well as the SwitchAAI WAYF and IdP domains.
+"""
+
+# used when none of the cookies carries an expiry date
+SESSION_TTL = 60 * 60
+# a session this close to its expiry is not reused anymore
+EXPIRY_MARGIN = 60
+
+SESSION_DOMAIN = "asvz.ch"
+
+
+def is_valid(state):
+    return bool(state) and state.get("expires", 0) > time.time() + EXPIRY_MARGIN
+
+
+def make_state(cookies, access_token=None, expires=None):
+    now = time.time()
+    if expires is None:
+        expires = now + SESSION_TTL
+        for cookie in cookies:
+            if cookie.get("domain", "").endswith(SESSION_DOMAIN) and cookie.get("expires", -1) > now:
+                expires = min(expires, cookie["expires"])
+    return {"cookies": cookies, "access_token": access_token, "expires": expires}
+
+
+def cdp(driver, cmd, params=None):
+    # remote drivers do not expose the DevTools endpoint of the grid by default
+    driver.command_executor._commands.setdefault(
+        "executeCdpCommand", ("POST", "/session/$sessionId/goog/cdp/execute")
+    )
+    return driver.execute("executeCdpCommand", {"cmd": cmd, "params": params or {}})["value"]
+
+
+def get_browser_cookies(driver):
+    """ Returns the cookies of all domains, not just the one currently loaded. """
+    try:
+        return cdp(driver, "Network.getAllCookies")["cookies"]
+    except WebDriverException as e:
+        logger.debug("Could not read cookies via DevTools: {}".format(e))
+        cookies = []
+        for cookie in driver.get_cookies():
+            # webdriver calls it expiry, DevTools expires
+            expires = cookie.pop("expiry", -1)
+            cookies.append({**cookie, "expires": expires})
+        return cookies
+
+
+def set_browser_cookies(driver, cookies):
+    try:
+        cdp(driver, "Network.setCookies", {"cookies": [
+            {key: value for key, value in cookie.items() if key not in ("size", "session", "priority", "sourceScheme", "sourcePort")}
+            for cookie in cookies
+        ]})
+    except WebDriverException as e:
+        # without DevTools only cookies of the currently loaded domain can be set
+        logger.debug("Could not set cookies via DevTools: {}".format(e))
+        current = driver.current_url
+        for cookie in cookies:
+            if cookie.get("domain", "").lstrip(".") not in current:
+                continue
+            try:
+                driver.add_cookie({
+                    "name": cookie["name"],
+                    "value": cookie["value"],
+                    "path": cookie.get("path", "/"),
+                    "secure": cookie.get("secure", False),
+                })
+            except WebDriverException:
+                pass
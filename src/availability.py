@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+from datetime import datetime
+
+from enroller import LessonStarted
+from http_enroller import HttpClient, HttpBackendError, parse_api_time
+
+"""
+Lightweight availability checks for full lessons.
+
+One poller per lesson checks the public lesson API (no browser, no login) and
+wakes the enrollment jobs of the waiting users when places become available.
+"""
+
+
+def free_places(base_url, lesson_id):
+    """ Number of free places of a lesson, raises LessonStarted once it has started. """
+    client = HttpClient(base_url)
+    try:
+        lesson = client.get_lesson(lesson_id)
+    finally:
+        client.close()
+    try:
+        if datetime.today() > parse_api_time(lesson["starts"]):
+            raise LessonStarted("Stopping polling because lesson has started.")
+        participants_max = lesson["participantsMax"]
+        participant_count = lesson.get("participantCount") or 0
+    except (KeyError, TypeError, ValueError) as e:
+        raise HttpBackendError("Malformed lesson data: {}".format(e))
+    if participants_max is None:
+        return 1
+    return max(participants_max - participant_count, 0)
+
+
+def fair_order(subscriptions):
+    """ Users that have been woken least recently go first, ties are broken by subscription time. """
+    return sorted(
+        subscriptions,
+        key=lambda subscription: (subscription.last_woken or 0, subscription.subscribed_at),
+    )
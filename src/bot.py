@@ -2,18 +2,38 @@ from loguru import logger
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import filters, MessageHandler, ApplicationBuilder, CommandHandler, ContextTypes, TypeHandler, ConversationHandler
 from telegram.ext.filters import ChatType 
-from telegram import Bot
-import asyncio
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.executors.pool import ProcessPoolExecutor
+from apscheduler.executors.pool import ProcessPoolExecutor, ThreadPoolExecutor
+from apscheduler.events import EVENT_JOB_EXECUTED
 import re
+import json
+import asyncio
+import time
 import pytz
 import yaml
+from collections import defaultdict
+from datetime import datetime, timedelta
+from apscheduler.jobstores.base import JobLookupError
 
-from enroller import verify_login, LESSON_BASE_URL, get_enroller, CREDENTIALS_UNAME, LessonStarted, LoginFailed, LessonFull, AlreadyEnrolled
-from utils import decrypt
+from enroller import verify_login, LESSON_BASE_URL, get_enroller, CREDENTIALS_UNAME, LessonStarted, LoginFailed, LessonFull, AlreadyEnrolled, BACKEND_SELENIUM, AsvzEnroller, CREDENTIALS_ORG, ORGANISATIONS, get_lesson_id, get_base_url, WEEKDAYS, FACILITIES, LEVELS, configure_timeouts, configure_nodes, DRIVER_POOL
+from utils import decrypt, encrypt
 from app import db, User, app as flask_app
+from database import AuthSession, LessonSubscription, LessonObservation, RecurringSubscription, session_scope, create_all
+from availability import free_places, fair_order
+from polling import AdaptiveTrigger, RECENT_CANCELLATION_WINDOW, HISTORY_WINDOW
+import polling
+import http_enroller
+import lesson_cache
+import job_registry
+import admission
+import sportfahrplan
+import catalog
+import browser_profile
+import user_cache
+import metrics
+from pipeline import SubmissionPipeline
+from notifications import Dispatcher, queue_message
 
 
 #### CONFIG ####
@@ -28,37 +48,104 @@ logger.add("logs/bot.log", rotation="500 MB")
 DELETE, CONFIRM = range(2)
 
 LESSON_CHECK_INTERVAL = 30
+# seconds before enrollment start a pooled selenium session gets logged in
+PREWARM_LEAD = 180
+# seconds before enrollment start the job is started, it logs in and waits for the opening itself
+ENROLLMENT_LEAD = 75
+PREWARM_SUFFIX = "_prewarm"
+# full lessons are polled by one lightweight job per lesson instead of every waiting user,
+# at the interval of the adaptive polling policy
+POLL_PREFIX = "poll_"
+# lessons of a user opening at the same time are enrolled by one batch job, the jobs of the
+# lessons only start this many seconds after the opening to handle lessons that were full
+BATCH_PREFIX = "batch_"
+BATCH_FOLLOWUP = 60
+# recurring subscriptions are resolved to lessons of the catalog this often and whenever the catalog changed
+RESOLVE_JOB = "resolve_subscriptions"
+RESOLVE_INTERVAL = 6 * 60 * 60
+# the local lesson catalog is synced with the Sportfahrplan this often, only stale days are fetched
+CATALOG_JOB = "sync_catalog"
+CATALOG_SYNC_INTERVAL = 15 * 60
+# jobs of the bot itself, not of a user
+SYSTEM_JOBS = (RESOLVE_JOB, CATALOG_JOB)
+# free places seen within this many seconds count as the same cancellation
+OBSERVATION_DEDUP = 60
+
+# lesson lookups run in the background, bounded overall and per user
+SETUP_WORKERS = 4
+SETUP_PER_USER = 3
+submissions = SubmissionPipeline(SETUP_WORKERS, SETUP_PER_USER, name="setup")
+# event loop of the bot, the lessons of recurring subscriptions are set up on its pipeline as well
+event_loop = None
+# ids of the subscriptions whose lessons are being set up, only touched on the event loop
+resolving = set()
+# credential checks at onboarding, one at a time per account so repeated tokens are not verified twice
+VERIFY_WORKERS = 2
+verifications = SubmissionPipeline(VERIFY_WORKERS, 1, name="verify")
+
+# results of an enrollment job, handled in the scheduler process
+JOB_FULL = "full"
+JOB_DONE = "done"
+# outcomes of an enrollment attempt as counted in the metrics
+OUTCOME_ENROLLED = "enrolled"
+OUTCOME_FULL = "full"
+OUTCOME_STARTED = "started"
+OUTCOME_ALREADY_ENROLLED = "already_enrolled"
+OUTCOME_LOGIN_FAILED = "login_failed"
+OUTCOME_ERROR = "error"
+
+# workers of the enrollment jobs, with the selenium backend a job holds at most one browser
+# session and there are as many workers as the grid runs sessions, see admission.py
+ENROLLMENT_WORKERS = 3
+
+# load config
+config = None
+with open("config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+
+ENROLLMENT_BACKEND = (config.get("enroller") or {}).get("backend", BACKEND_SELENIUM)
+configure_timeouts((config.get("enroller") or {}).get("timeouts"))
+configure_nodes((config.get("enroller") or {}).get("selenium_nodes"))
+http_enroller.configure_auth_url((config.get("enroller") or {}).get("auth_url"))
+browser_profile.configure((config.get("enroller") or {}).get("lean_profile", False))
 
 jobstores = {
     'default': SQLAlchemyJobStore(url='sqlite:///instance/jobs.db')
 }
 executors = {
-    'default': ProcessPoolExecutor(3)
+    'default': ProcessPoolExecutor(admission.capacity(DRIVER_POOL.nodes) if ENROLLMENT_BACKEND == BACKEND_SELENIUM else ENROLLMENT_WORKERS),
+    # availability polls are single http requests and have to wake jobs in this process
+    'poller': ThreadPoolExecutor(4),
 }
 scheduler = BackgroundScheduler(jobstores=jobstores, executors=executors, timezone=pytz.timezone("CET"))
 
-# load config
-config = None
-with open("config.yaml", "r") as f:
-    config = yaml.safe_load(f)
+# users by chat, every update is authorized through it
+USER_CACHE = user_cache.UserCache(user_cache.marker_path(flask_app))
 #################
 
 #### MESSAGES ####
 # registration
 WELCOME = "Welcome {0}! You are now authorized. Verifying your login credentials..."
+VERIFICATION_QUEUED = "There are {0} other accounts being verified right now, yours is next in line."
+VERIFICATION_PENDING = "Your login credentials are still being verified, please wait a moment."
+VERIFICATION_ERROR = "Sorry, I could not verify your login credentials right now. Please send me your access token again later."
 VALID_CREDENTIALS = "Your login credentials have been verified. Your account is now linked to this telegram account. Send /help for more information on how to use me."
 INVALID_CREDENTIALS = f"Your login credentials are not valid and your authorization has been retracted. Please visit {config['app']['url']} to change them and reauthorize."
 CREDENTIAL_NO_LONGER_VALID = f"Sorry, your login credentials are invalid. You are no longer authorized to use this bot. Please register again on {config['app']['url']}."
 NOT_YET_VALIDATED = "Your login credentials are not yet verified. This might take some minutes. Resubmit the job in a few minutes. You will be notified when you're credentials have been verified."
 
 # enrollment
+JOB_RECEIVED = "Got it, I'm looking up the lesson. This may take a moment."
 JOB_SUBMITTED = "Job '{0}' has been submitted."
+TOO_MANY_SUBMISSIONS = "I'm still looking up your previous lessons. Please wait until they are submitted and try again."
+ERROR_SUBMITTING = "An error occured while looking up the lesson. Please check the link and try again later."
 NO_URL_FOUND = f"Could not find a lesson url in your message. It should look like {LESSON_BASE_URL}/tn/lessons/ followed by some number."
 LESSON_STARTED = "Sorry, the lesson {0} has started and I did not manage to find a place for you."
 LESSON_FULL = "Sorry the lesson '{0}' is already full. I will notify you when a place becomes available."
 ERROR_ENROLLING = "An error occured while enrolling you for the lesson. Please try again later."
 ENROLL_SUCCESS = "You have been successfully enrolled for '{0}'!"
 NO_JOBS = "You have no open enrollment jobs."
+JOB_WAITING = "   waiting for a free place, checking every {0}s ({1})"
 ALREADY_ENROLLED = "You are already enrolled for the lesson '{0}'."
 
 # delete
@@ -67,8 +154,22 @@ DELETE_NUMBER_NOTFOUND = "Job number not found. Try again."
 DELETE_VALIDATE = "Are you sure you want to delete job '{0}'?"
 DELETE_CONFIRMATION = "Job has been deleted."
 
+# recurring subscriptions
+SUBSCRIBE_USAGE = f"Send /subscribe followed by sport, weekday and time, optionally facility and level, separated by commas, e.g. /subscribe Yoga, Mo, 18:30, Sport Center Polyterrasse, Alle\nWeekdays: {', '.join(WEEKDAYS)}\nFacilities: {', '.join(FACILITIES)}\nLevels: {', '.join(LEVELS)}"
+SUBSCRIBED = "Subscribed to {0}. I will submit a job for every lesson as soon as it shows up in the Sportfahrplan."
+SUBSCRIPTION_JOB_SUBMITTED = "Job '{0}' has been submitted for your subscription to {1}."
+NO_SUBSCRIPTIONS = "You have no recurring subscriptions."
+UNSUBSCRIBE_NO_NUMBER = "Please provide a subscription number. The numbers can be found with /subscriptions."
+UNSUBSCRIBED = "Your subscription to {0} has been removed. Jobs that were already submitted are kept, see /jobs."
+
+# search
+SEARCH_USAGE = f"Send /search followed by words of the lesson title, optionally weekday, time, facility and level, separated by commas, e.g. /search yoga, Mo, Sport Center Polyterrasse\nWeekdays: {', '.join(WEEKDAYS)}\nFacilities: {', '.join(FACILITIES)}\nLevels: {', '.join(LEVELS)}"
+NO_LESSONS_FOUND = "I could not find any upcoming lessons matching your search."
+SEARCH_HINT = "Send me one of the links to enroll."
+
 # help
-HELP = """Send me a link to an ASVZ lesson and I will enroll you. You can directly share a lesson with me from the ASVZ app. Send /jobs to see a list of open enrolment jobs. With /delete {jobnumber} you can remove specific jobs. The jobnumber can be found with /jobs."""
+HELP = """Send me a link to an ASVZ lesson and I will enroll you. You can directly share a lesson with me from the ASVZ app. Send /jobs to see a list of open enrolment jobs. With /delete {jobnumber} you can remove specific jobs. The jobnumber can be found with /jobs.
+Send /search followed by a sport to find upcoming lessons, e.g. /search yoga, Mo. To be enrolled for a lesson every week, send /subscribe followed by sport, weekday and time, e.g. /subscribe Yoga, Mo, 18:30. Send /subscriptions to see them and /unsubscribe {number} to remove one."""
 
 # other
 UNKNOWN_COMMAND = "Sorry, I didn't understand that command."
@@ -76,88 +177,486 @@ UNKNOWN_COMMAND = "Sorry, I didn't understand that command."
 #### HELPERS ####
 
 def get_user_from_token(token):
-    with flask_app.app_context():
-        return db.session.execute(db.select(User).where(User.access_token == token)).scalar()
+    with session_scope(flask_app) as session:
+        return session.execute(db.select(User).where(User.access_token == token)).scalar()
 
 def get_user_from_chat_id(chat_id):
-    with flask_app.app_context():
-        return db.session.execute(db.select(User).where(User.chat_id == chat_id)).scalar()
+    with session_scope(flask_app) as session:
+        return session.execute(db.select(User).where(User.chat_id == chat_id)).scalar()
 
 def get_user_from_username(username, with_context=True):
     if with_context:
-        with flask_app.app_context():
-            return db.session.execute(db.select(User).where(User.username == username)).scalar()
+        with session_scope(flask_app) as session:
+            return session.execute(db.select(User).where(User.username == username)).scalar()
     else:
         return db.session.execute(db.select(User).where(User.username == username)).scalar()
 
 def set_user_data(db_user, user, chat):
-    with flask_app.app_context():
-        db_user = db.session.execute(db.select(User).filter_by(username=db_user.username)).scalar()
+    with session_scope(flask_app) as session:
+        db_user = session.execute(db.select(User).filter_by(username=db_user.username)).scalar()
+        previous_chat = db_user.chat_id
         db_user.telegram_username = user.username
         db_user.chat_id = chat.id
         db_user.linked = True
         db_user.verified = 1
-        db.session.commit()
+        session.commit()
+    USER_CACHE.invalidate(previous_chat, chat.id)
 
 def reset_token(user):
-    with flask_app.app_context():
-        db_user = db.session.execute(db.select(User).filter_by(username=user.username)).scalar()
+    with session_scope(flask_app) as session:
+        db_user = session.execute(db.select(User).filter_by(username=user.username)).scalar()
         db_user.access_token = ""
         db_user.asvz_username = ""
         db_user.verified = -1
-        db.session.commit()
+        session.commit()
+        # runs in the workers of the process pool, the bot's cache lives in the main process
+        user_cache.touch(flask_app)
+        USER_CACHE.invalidate(db_user.chat_id)
+
+def get_auth_session(key):
+    with session_scope(flask_app) as session:
+        entry = session.get(AuthSession, key)
+        if entry is None or entry.expires < time.time():
+            return None
+        return json.loads(decrypt(entry.state, config["app"]["secret"]))
+
+def set_auth_session(key, state):
+    with session_scope(flask_app) as session:
+        entry = session.get(AuthSession, key)
+        if state is None:
+            if entry is not None:
+                session.delete(entry)
+        else:
+            if entry is None:
+                entry = AuthSession(key=key)
+                session.add(entry)
+            entry.state = encrypt(json.dumps(state), config["app"]["secret"])
+            entry.expires = state["expires"]
+        session.commit()
+
+def user_session_key(db_user):
+    return AsvzEnroller.pool_key({CREDENTIALS_UNAME: db_user.asvz_username, CREDENTIALS_ORG: ORGANISATIONS[db_user.asvz_organisation]})
+
+def user_enroller(db_user, lesson_url, metadata=None, id=None):
+    password = decrypt(db_user.asvz_password, config["app"]["secret"])
+    session_state = get_auth_session(user_session_key(db_user))
+    return get_enroller(lesson_url, db_user.asvz_username, password, db_user.asvz_organisation, backend=ENROLLMENT_BACKEND, session_state=session_state, metadata=metadata, id=id)
+
+def load_enroller(job_id, db_user, lesson_url):
+    """ Rebuilds the enroller of a job from the current user record and the cached lesson details. """
+    metadata = lesson_cache.get_lesson(get_lesson_id(lesson_url)) or job_registry.get_metadata(job_id)
+    return user_enroller(db_user, lesson_url, metadata, id=job_id)
 
 def enroller_summary(enroller):
     return f"{enroller.lesson_start.strftime('%d.%m.%y %H:%M')} - {enroller.lesson_title} ({enroller.lesson_location})"
 
 def job_summary(job):
-    return enroller_summary(job.args[0])
+    """ Summary of a job of the registry, see job_registry.py. """
+    return f"{job.lesson_start.strftime('%d.%m.%y %H:%M')} - {job.title} ({job.location})"
 
-def enroll(enroller, chat_id, notify_full=True):
+def enroll(job_id, username, lesson_url, chat_id, notify_full=True):
+    user = get_user_from_username(username)
+    if user is None:
+        logger.info(f"{username} - User does not exist anymore, removing job {job_id}")
+        scheduler.remove_job(job_id)
+        return JOB_DONE
+    if user.verified != 1:
+        # the credentials were changed and are not verified yet, try again on the next run
+        logger.info(f"{username} - Credentials not verified, skipping job {job_id}")
+        return None
+    enroller = load_enroller(job_id, user, lesson_url)
     logger.info(f"{enroller.creds[CREDENTIALS_UNAME]} - Started enrollment for {enroller_summary(enroller)}")
-    response = None
+    session_key = AsvzEnroller.pool_key(enroller.creds)
+    error = None
     try:
         enroller.enroll()
-    except LessonStarted as e:
+    except Exception as e:
+        error = e
+    set_auth_session(session_key, enroller.session_state)
+
+    response, result = enrollment_outcome(user, enroller, error, (job_id, username, lesson_url, chat_id, notify_full))
+    metrics.flush()
+    if response is not None:
+        send_message(response)
+    return result
+
+def enrollment_outcome(user, enroller, error, args):
+    """ Updates the job of an enrollment attempt that failed with error (None if enrolled), returns the response and the job result. """
+    job_id, username, lesson_url, chat_id = args[:4]
+    notify_full = args[4] if len(args) > 4 else True
+    response = None
+    result = JOB_DONE
+    outcome = OUTCOME_ERROR
+    if error is None:
+        outcome = OUTCOME_ENROLLED
+        response = Response(chat_id, ENROLL_SUCCESS.format(enroller_summary(enroller)))
+    elif isinstance(error, LessonStarted):
+        outcome = OUTCOME_STARTED
         response = Response(chat_id, LESSON_STARTED.format(enroller_summary(enroller)))
-        scheduler.remove_job(enroller.id)
-    except LessonFull as e:
+    elif isinstance(error, LessonFull):
+        outcome = OUTCOME_FULL
+        result = JOB_FULL
+        admission.record_full(enroller.lesson_id, enroller.lesson_title, enroller.lesson_location, enroller.lesson_start, enroller.enrollment_start)
         if notify_full:
             response = Response(chat_id, LESSON_FULL.format(enroller_summary(enroller)))
-            scheduler.modify_job(enroller.id, args=(enroller, chat_id, False))
-    except LoginFailed as e:
+            scheduler.modify_job(job_id, args=(job_id, username, lesson_url, chat_id, False))
+    elif isinstance(error, LoginFailed):
+        outcome = OUTCOME_LOGIN_FAILED
         response = Response(chat_id, CREDENTIAL_NO_LONGER_VALID)
-        user = get_user_from_chat_id(chat_id)
         reset_token(user)
-        scheduler.remove_job(enroller.id)    
-    except AlreadyEnrolled as e:
+    elif isinstance(error, AlreadyEnrolled):
+        outcome = OUTCOME_ALREADY_ENROLLED
         response = Response(chat_id, ALREADY_ENROLLED.format(enroller_summary(enroller)))
-        scheduler.remove_job(enroller.id)
-    except Exception as e:
-        logger.error(e)
-        response = Response(chat_id, ERROR_ENROLLING)
-        scheduler.remove_job(enroller.id)
     else:
-        response = Response(chat_id, ENROLL_SUCCESS.format(enroller_summary(enroller)))
-        scheduler.remove_job(enroller.id)
+        logger.error(error)
+        response = Response(chat_id, ERROR_ENROLLING)
+        # the lesson might have changed since its details were cached
+        lesson_cache.invalidate_lesson(enroller.lesson_id)
+    metrics.count("enrollment_outcomes_total", outcome=outcome, backend=enroller.backend)
+    if result == JOB_DONE:
+        scheduler.remove_job(job_id)
+    return response, result
 
-    if response is not None:
-        asyncio.run(send_message(response))
+def enroll_batch(username, chat_id, enrollment_start):
+    """ Enrolls for all lessons of a user that open at enrollment_start with a single login, see group_jobs. """
+    user = get_user_from_username(username)
+    if user is None or user.verified != 1:
+        # the jobs of the lessons take care of it
+        return
+    jobs = {}
+    for entry in job_registry.get_group(chat_id, enrollment_start):
+        job = scheduler.get_job(entry.job_id)
+        if job is not None:
+            jobs[job.id] = job.args
+    if len(jobs) == 0:
+        return
+    enrollers = [load_enroller(job_id, user, args[2]) for job_id, args in jobs.items()]
+    logger.info(f"{user.asvz_username} - Started batch enrollment for {len(enrollers)} lessons")
+    try:
+        results = enrollers[0].enroll_batch(enrollers)
+    except LoginFailed as e:
+        results = {enroller.id: e for enroller in enrollers}
+    except Exception as e:
+        # the jobs of the lessons retry on their own
+        logger.error(f"{user.asvz_username} - Batch enrollment failed: {e}")
+        metrics.flush()
+        return
+    set_auth_session(user_session_key(user), enrollers[0].session_state)
+
+    messages = []
+    for enroller in enrollers:
+        response, result = enrollment_outcome(user, enroller, results[enroller.id], jobs[enroller.id])
+        if result == JOB_DONE:
+            # the lesson jobs never ran, so there is no job executed event cleaning up after them
+            unsubscribe(enroller.id)
+            job_registry.remove_job(enroller.id)
+        if response is not None and response.message not in messages:
+            messages.append(response.message)
+    metrics.flush()
+    for message in messages:
+        send_message(Response(chat_id, message))
+
+def batch_job_id(chat_id, enrollment_start):
+    return f"{BATCH_PREFIX}{chat_id}_{enrollment_start.strftime('%Y%m%d%H%M%S')}"
+
+def group_jobs(username, chat_id, enrollment_start):
+    """ Lets one batch job enroll for all lessons of a user that open at the same time. """
+    jobs = job_registry.get_group(chat_id, enrollment_start)
+    run_date = enrollment_start - timedelta(seconds=ENROLLMENT_LEAD)
+    if len(jobs) < 2 or run_date < datetime.today():
+        return
+    logger.info(f"{username} - Grouping {len(jobs)} lessons opening at {enrollment_start}")
+    batch_id = batch_job_id(chat_id, enrollment_start)
+    scheduler.add_job(enroll_batch, args=(username, chat_id, enrollment_start), id=batch_id, trigger='date', run_date=run_date, misfire_grace_time=ENROLLMENT_LEAD, replace_existing=True)
+    for job in jobs:
+        # the lesson jobs take over once the batch is done, e.g. for lessons that were full
+        scheduler.reschedule_job(job.job_id, trigger='interval', start_date=enrollment_start + timedelta(seconds=BATCH_FOLLOWUP), seconds=LESSON_CHECK_INTERVAL)
+
+def subscribe(job_id):
+    """ Pauses the job of a full lesson and lets the lesson poller wake it. """
+    job = scheduler.get_job(job_id)
+    metadata = job_registry.get_metadata(job_id)
+    if job is None or metadata is None:
+        return
+    lesson_url = job.args[2]
+    lesson_id = get_lesson_id(lesson_url)
+    scheduler.pause_job(job_id)
+    job_registry.set_state(job_id, job_registry.WAITING)
+    with flask_app.app_context():
+        if db.session.get(LessonSubscription, job_id) is None:
+            db.session.add(LessonSubscription(job_id=job_id, lesson_id=lesson_id, lesson_url=lesson_url, subscribed_at=time.time()))
+            db.session.commit()
+    poll_id = POLL_PREFIX + lesson_id
+    if scheduler.get_job(poll_id) is None:
+        logger.info(f"Polling lesson {lesson_id} for free places")
+        trigger = AdaptiveTrigger(lesson_id, metadata["enrollment_start"], metadata["lesson_start"])
+        scheduler.add_job(poll_lesson, args=(get_base_url(lesson_url), lesson_id, metadata["lesson_start"]), id=poll_id, executor='poller', max_instances=1, coalesce=True, trigger=trigger)
+
+def unsubscribe(job_id):
+    with flask_app.app_context():
+        db.session.execute(db.delete(LessonSubscription).where(LessonSubscription.job_id == job_id))
+        db.session.commit()
+
+def wake(job_id):
+    try:
+        scheduler.resume_job(job_id)
+        scheduler.modify_job(job_id, next_run_time=datetime.now(scheduler.timezone))
+    except JobLookupError:
+        return False
+    job_registry.set_state(job_id, job_registry.SCHEDULED)
+    return True
+
+def record_observation(lesson_id, lesson_start):
+    now = time.time()
+    last = db.session.execute(db.select(db.func.max(LessonObservation.observed_at)).where(LessonObservation.lesson_id == lesson_id)).scalar()
+    if last is None or now - last > OBSERVATION_DEDUP:
+        hours_before = (lesson_start - datetime.today()).total_seconds() / 3600
+        db.session.add(LessonObservation(lesson_id=lesson_id, observed_at=now, hours_before=hours_before))
+
+def cancellation_history(lesson_id):
+    now = time.time()
+    with flask_app.app_context():
+        recent = db.session.execute(db.select(LessonObservation.observed_at).where(LessonObservation.lesson_id == lesson_id, LessonObservation.observed_at > now - RECENT_CANCELLATION_WINDOW)).scalars().all()
+        history = db.session.execute(db.select(LessonObservation.hours_before).where(LessonObservation.observed_at > now - HISTORY_WINDOW)).scalars().all()
+    return recent, history
+
+polling.history_provider = cancellation_history
+
+def poll_lesson(base_url, lesson_id, lesson_start):
+    with flask_app.app_context():
+        subscriptions = db.session.execute(db.select(LessonSubscription).where(LessonSubscription.lesson_id == lesson_id)).scalars().all()
+        if len(subscriptions) == 0:
+            scheduler.remove_job(POLL_PREFIX + lesson_id)
+            return
+        # only free places count as cancellations, not lesson starts or failed polls
+        observed = False
+        try:
+            places = free_places(base_url, lesson_id)
+            observed = places > 0
+        except LessonStarted:
+            # the enrollment jobs notify their users and clean up
+            places = len(subscriptions)
+            scheduler.remove_job(POLL_PREFIX + lesson_id)
+        except Exception as e:
+            # fall back to letting every job check on its own
+            logger.warning(f"Polling lesson {lesson_id} failed: {e}")
+            places = len(subscriptions)
+        if places == 0:
+            return
+        if observed:
+            record_observation(lesson_id, lesson_start)
+        now = time.time()
+        woken = []
+        for subscription in fair_order(subscriptions)[:places]:
+            subscription.last_woken = now
+            woken.append(subscription.job_id)
+        db.session.commit()
+    for job_id in woken:
+        logger.info(f"Lesson {lesson_id} has free places, waking {job_id}")
+        if not wake(job_id):
+            unsubscribe(job_id)
+            job_registry.remove_job(job_id)
+
+def on_job_executed(event):
+    if event.retval == JOB_FULL:
+        subscribe(event.job_id)
+    elif event.retval == JOB_DONE:
+        unsubscribe(event.job_id)
+        job_registry.remove_job(event.job_id)
+
+def prewarm(job_id, username, lesson_url):
+    user = get_user_from_username(username)
+    if user is None or user.verified != 1:
+        return
+    enroller = load_enroller(job_id, user, lesson_url)
+    session_key = AsvzEnroller.pool_key(enroller.creds)
+    try:
+        enroller.prewarm()
+    except Exception as e:
+        # enroll() logs in on its own if warming up failed
+        logger.warning(f"{enroller.creds[CREDENTIALS_UNAME]} - Prewarming failed: {e}")
+    set_auth_session(session_key, enroller.session_state)
 
-def initialise_job(lesson_url, user, password, organisation, chat_id):
-    enroller = get_enroller(lesson_url, user, decrypt(password, config["app"]["secret"]), organisation)
-    logger.info(f"{user} - Job: {enroller_summary(enroller)} - Exec: {enroller.enrollment_start} ")
-    scheduler.add_job(enroll, args=(enroller, chat_id), id=enroller.id, max_instances=1, coalesce=True, trigger='interval', start_date=enroller.enrollment_start, seconds=LESSON_CHECK_INTERVAL)
+def remove_prewarm(job_id):
+    try:
+        scheduler.remove_job(job_id + PREWARM_SUFFIX)
+    except JobLookupError:
+        pass
+
+def admit(enrollment_start):
+    """ Orders the jobs of all users whose lessons open in the same minute and staggers their pre-logins, see admission.py. """
+    now = datetime.today()
+    groups = defaultdict(list)
+    for job in job_registry.get_opening(enrollment_start):
+        groups[(job.chat_id, job.enrollment_start)].append(job)
+    units = []
+    for (chat_id, start), lessons in groups.items():
+        batch_id = batch_job_id(chat_id, start)
+        if len(lessons) > 1 and scheduler.get_job(batch_id) is not None:
+            units.append(admission.Unit(batch_id, start, lessons))
+        else:
+            units.extend(admission.Unit(lesson.job_id, start, [lesson]) for lesson in lessons)
+    for slot in admission.plan(units, admission.capacity(DRIVER_POOL.nodes), ENROLLMENT_LEAD, PREWARM_LEAD):
+        if slot.start < now:
+            # the job already runs
+            continue
+        try:
+            if slot.unit.job_id.startswith(BATCH_PREFIX):
+                scheduler.reschedule_job(slot.unit.job_id, trigger='date', run_date=slot.start)
+            else:
+                scheduler.reschedule_job(slot.unit.job_id, trigger='interval', start_date=slot.start, seconds=LESSON_CHECK_INTERVAL)
+                scheduler.modify_job(slot.unit.job_id, misfire_grace_time=ENROLLMENT_LEAD)
+        except JobLookupError:
+            continue
+        # a batch logs in once for all its lessons, jobs beyond the capacity of the grid log in when they start
+        for i, lesson in enumerate(slot.unit.lessons):
+            job = scheduler.get_job(lesson.job_id)
+            if i == 0 and job is not None and ENROLLMENT_BACKEND == BACKEND_SELENIUM and slot.prelogin is not None and slot.prelogin > now:
+                scheduler.add_job(prewarm, args=job.args[:3], id=lesson.job_id + PREWARM_SUFFIX, trigger='date', run_date=slot.prelogin, misfire_grace_time=PREWARM_LEAD, replace_existing=True)
+            else:
+                remove_prewarm(lesson.job_id)
+    if units:
+        logger.info(f"Admitted {len(units)} jobs opening at {enrollment_start.strftime('%d.%m.%y %H:%M')}")
+
+def initialise_job(lesson_url, username, chat_id):
+    db_user = get_user_from_username(username)
+    lesson_id = get_lesson_id(lesson_url)
+    metadata = lesson_cache.get_lesson(lesson_id)
+    enroller = user_enroller(db_user, lesson_url, metadata)
+    if metadata is None:
+        lesson_cache.set_lesson(lesson_id, enroller.get_metadata())
+        set_auth_session(user_session_key(db_user), enroller.session_state)
+    logger.info(f"{db_user.asvz_username} - Job: {enroller_summary(enroller)} - Exec: {enroller.enrollment_start} ")
+    # jobs only carry identifiers, the enroller is rebuilt from the database on every run
+    # queued behind the other jobs of a busy opening the job still has to run, not be skipped as misfired
+    scheduler.add_job(enroll, args=(enroller.id, username, lesson_url, chat_id), id=enroller.id, max_instances=1, coalesce=True, trigger='interval', start_date=enroller.enrollment_start - timedelta(seconds=ENROLLMENT_LEAD), seconds=LESSON_CHECK_INTERVAL, misfire_grace_time=ENROLLMENT_LEAD)
+    job_registry.add_job(enroller.id, chat_id, lesson_id, enroller.get_metadata())
+    group_jobs(username, chat_id, enroller.enrollment_start)
+    admit(enroller.enrollment_start)
     return enroller_summary(enroller)
 
+def match_option(options, value):
+    """ Key of options matching value case-insensitively, by key or by name. """
+    for key, name in options.items():
+        if value.lower() in (key.lower(), str(name).lower()):
+            return key
+    raise ValueError(f"Unknown option '{value}'")
+
+def parse_slot(text):
+    """ Parses 'sport, weekday, time[, facility][, level]' into the columns of a RecurringSubscription. """
+    parts = [part.strip() for part in text.split(",")]
+    if len(parts) < 3 or len(parts) > 5 or not parts[0]:
+        raise ValueError("Expected sport, weekday and time")
+    slot = {
+        "sport": parts[0],
+        "weekday": match_option(WEEKDAYS, parts[1]),
+        "time": datetime.strptime(parts[2], sportfahrplan.TIMEFORMAT).strftime(sportfahrplan.TIMEFORMAT),
+        "facility": None,
+        "level": None,
+    }
+    for part in parts[3:]:
+        try:
+            slot["facility"] = match_option(FACILITIES, part)
+        except ValueError:
+            slot["level"] = match_option(LEVELS, part)
+    return slot
+
+def slot_summary(subscription):
+    summary = f"{subscription.sport} on {WEEKDAYS[subscription.weekday]} at {subscription.time}"
+    if subscription.facility:
+        summary += f" ({subscription.facility})"
+    if subscription.level:
+        summary += f", level {subscription.level}"
+    return summary
+
+def get_subscriptions(chat_id=None):
+    with flask_app.app_context():
+        query = db.select(RecurringSubscription).order_by(RecurringSubscription.id)
+        if chat_id is not None:
+            query = query.where(RecurringSubscription.chat_id == chat_id)
+        subscriptions = db.session.execute(query).scalars().all()
+        db.session.expunge_all()
+        return subscriptions
+
+def resolve_subscriptions():
+    """ Finds the upcoming lessons of all recurring subscriptions and hands them to the setup pipeline of the bot. """
+    if event_loop is None:
+        # the bot resolves them once it is running
+        return
+    for subscription in get_subscriptions():
+        user = get_user_from_username(subscription.username)
+        if user is None or user.verified != 1:
+            continue
+        try:
+            lessons = catalog.find_lessons(subscription.sport, subscription.weekday, subscription.time, subscription.facility, subscription.level, after=subscription.resolved_until)
+        except Exception as e:
+            logger.warning(f"{subscription.username} - Resolving subscription to {slot_summary(subscription)} failed: {e}")
+            continue
+        if len(lessons) > 0:
+            asyncio.run_coroutine_threadsafe(submit_subscription(subscription, lessons), event_loop)
+
+async def submit_subscription(subscription, lessons):
+    if subscription.id in resolving:
+        return
+    future = submissions.submit(subscription.chat_id, initialise_subscription, subscription, lessons)
+    if future is None:
+        # the user is submitting lessons right now, tried again on the next run
+        return
+    resolving.add(subscription.id)
+    try:
+        await future
+    except Exception as e:
+        logger.error(f"{subscription.username} - Resolving subscription to {slot_summary(subscription)} failed: {e}")
+    finally:
+        resolving.discard(subscription.id)
+
+def initialise_subscription(subscription, lessons):
+    """ Submits jobs for the lessons of a subscription in order, runs on the setup pipeline. """
+    for lesson in lessons:
+        if not job_registry.has_lesson(subscription.chat_id, lesson.lesson_id):
+            try:
+                summary = initialise_job(lesson.url, subscription.username, subscription.chat_id)
+            except Exception as e:
+                # tried again on the next run
+                logger.error(f"{subscription.username} - Submitting {lesson.url} failed: {e}")
+                return
+            send_message(Response(subscription.chat_id, SUBSCRIPTION_JOB_SUBMITTED.format(summary, slot_summary(subscription))))
+        with flask_app.app_context():
+            db.session.execute(db.update(RecurringSubscription).where(RecurringSubscription.id == subscription.id).values(resolved_until=lesson.start))
+            db.session.commit()
+
+def sync_catalog():
+    if catalog.sync() > 0:
+        # new lessons might belong to a subscription
+        scheduler.modify_job(RESOLVE_JOB, next_run_time=datetime.now(scheduler.timezone))
+
+def parse_search(text):
+    """ Parses 'words[, weekday][, time][, facility][, level]' into the arguments of catalog.search. """
+    parts = [part.strip() for part in text.split(",")]
+    criteria = {"text": parts[0] or None}
+    for part in parts[1:]:
+        try:
+            criteria["start_time"] = datetime.strptime(part, sportfahrplan.TIMEFORMAT).strftime(sportfahrplan.TIMEFORMAT)
+            continue
+        except ValueError:
+            pass
+        for key, options in (("weekday", WEEKDAYS), ("facility", FACILITIES), ("level", LEVELS)):
+            try:
+                criteria[key] = match_option(options, part)
+                break
+            except ValueError:
+                pass
+        else:
+            raise ValueError(f"Unknown search criterion '{part}'")
+    if not any(criteria.values()):
+        raise ValueError("Nothing to search for")
+    return criteria
+
 def user_authorized(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
-
-    user = get_user_from_chat_id(chat.id)
-    if chat.type == "private" and user is not None:
-        return user
-    else:
+    if chat.type != "private":
         return None
+    return USER_CACHE.get(chat.id, get_user_from_chat_id)
 
 def authorized(function):
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -168,9 +667,50 @@ def authorized(function):
             return
     return wrapper
 
-def get_jobs(chat_id):
-    jobs = scheduler.get_jobs()
-    return [job for job in jobs if job.args[1] == chat_id]
+def is_enrollment_job(job):
+    return not job.id.endswith(PREWARM_SUFFIX) and not job.id.startswith(POLL_PREFIX) and not job.id.startswith(BATCH_PREFIX) and job.id not in SYSTEM_JOBS
+
+def sync_jobs():
+    """ Converts jobs that still carry a pickled enroller, registers jobs missing in the registry and drops entries of jobs that are gone. """
+    registered = job_registry.job_ids()
+    scheduled = set()
+    for job in scheduler.get_jobs():
+        if job.id.startswith(POLL_PREFIX) or job.id in SYSTEM_JOBS:
+            continue
+        if isinstance(job.args[0], AsvzEnroller):
+            enroller = job.args[0]
+            user = get_user_from_chat_id(job.args[1]) if is_enrollment_job(job) else None
+            if user is None:
+                # the user is gone, or it is a prewarm job which is only an optimisation anyway
+                scheduler.remove_job(job.id)
+                continue
+            scheduler.modify_job(job.id, args=(job.id, user.username, enroller.lesson_url) + tuple(job.args[1:]))
+            if job.id not in registered:
+                job_registry.add_job(job.id, job.args[1], enroller.lesson_id, enroller.get_metadata())
+                registered.add(job.id)
+        elif is_enrollment_job(job) and job.id not in registered:
+            metadata = lesson_cache.get_lesson(get_lesson_id(job.args[2]))
+            if metadata is not None:
+                job_registry.add_job(job.id, job.args[3], get_lesson_id(job.args[2]), metadata)
+                registered.add(job.id)
+        if is_enrollment_job(job):
+            scheduled.add(job.id)
+            if job.next_run_time is None:
+                job_registry.set_state(job.id, job_registry.WAITING)
+    for job_id in registered - scheduled:
+        job_registry.remove_job(job_id)
+
+def start_scheduler():
+    """ Starts the scheduler, the stored jobs are synced with the registry before any of them runs. """
+    # no worker holds a session yet, the ones still registered belong to an earlier run
+    DRIVER_POOL.reset()
+    scheduler.add_listener(on_job_executed, EVENT_JOB_EXECUTED)
+    # a scheduler only loads the stored jobs once it is started, get_jobs() misses them before
+    scheduler.start(paused=True)
+    sync_jobs()
+    scheduler.add_job(sync_catalog, trigger='interval', seconds=CATALOG_SYNC_INTERVAL, id=CATALOG_JOB, executor='poller', max_instances=1, coalesce=True, next_run_time=datetime.now(scheduler.timezone), replace_existing=True)
+    scheduler.add_job(resolve_subscriptions, trigger='interval', seconds=RESOLVE_INTERVAL, id=RESOLVE_JOB, executor='poller', max_instances=1, coalesce=True, next_run_time=datetime.now(scheduler.timezone), replace_existing=True)
+    scheduler.resume()
 
 #################
 
@@ -188,13 +728,16 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @authorized
 async def jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    jobs = get_jobs(update.effective_chat.id)
+    jobs = job_registry.get_jobs(update.effective_chat.id)
     if len(jobs) == 0:
         msg = NO_JOBS
     else:
         msg = "Jobs:\n"
         for i, job in enumerate(jobs):
             msg += f"{i+1}. {job_summary(job)}\n"
+            poll_job = scheduler.get_job(POLL_PREFIX + job.lesson_id) if job.state == job_registry.WAITING else None
+            if poll_job is not None:
+                msg += JOB_WAITING.format(*poll_job.trigger.explain()) + "\n"
     await context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
     return DELETE
 
@@ -205,16 +748,16 @@ async def delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=DELETE_NO_NUMBER)
         return ConversationHandler.END
-    jobs = scheduler.get_jobs()
+    jobs = job_registry.get_jobs(update.effective_chat.id)
     if len(jobs) == 0:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=NO_JOBS)
         return ConversationHandler.END
-    elif job_id > len(jobs):
+    elif job_id < 1 or job_id > len(jobs):
         await context.bot.send_message(chat_id=update.effective_chat.id, text=DELETE_NUMBER_NOTFOUND)
         return ConversationHandler.END
     else:
         job = jobs[job_id-1]
-        context.user_data["job"] = job.id
+        context.user_data["job"] = job.job_id
         reply_keyboard = [["Yes", "No"]]
         await context.bot.send_message(chat_id=update.effective_chat.id, text=DELETE_VALIDATE.format(job_summary(job)), reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, input_field_placeholder="Yes or No?"))
         return CONFIRM
@@ -223,10 +766,82 @@ async def delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == "Yes":
         job_id = context.user_data["job"]
-        scheduler.remove_job(job_id)
+        try:
+            scheduler.remove_job(job_id)
+        except JobLookupError:
+            # the job finished in the meantime
+            pass
+        remove_prewarm(job_id)
+        unsubscribe(job_id)
+        job_registry.remove_job(job_id)
         await context.bot.send_message(chat_id=update.effective_chat.id, text=DELETE_CONFIRMATION)
     return ConversationHandler.END
 
+@authorized
+async def search_lessons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        criteria = parse_search(update.message.text.partition(" ")[2])
+    except ValueError:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=SEARCH_USAGE)
+        return
+    lessons = catalog.search(**criteria)
+    if len(lessons) == 0:
+        msg = NO_LESSONS_FOUND
+    else:
+        msg = "Lessons:\n"
+        for i, lesson in enumerate(lessons):
+            msg += f"{i+1}. {lesson.start.strftime('%d.%m.%y %H:%M')} - {lesson.title} ({lesson.facility})\n{lesson.url}\n"
+        msg += SEARCH_HINT
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+
+@authorized
+async def add_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    db_user = user_authorized(update, context)
+    try:
+        slot = parse_slot(update.message.text.partition(" ")[2])
+    except ValueError:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=SUBSCRIBE_USAGE)
+        return
+    subscription = RecurringSubscription(username=db_user.username, chat_id=update.effective_chat.id, created_at=time.time(), **slot)
+    summary = slot_summary(subscription)
+    with flask_app.app_context():
+        db.session.add(subscription)
+        db.session.commit()
+    logger.info(f"{db_user.username} - Subscribed to {summary}")
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=SUBSCRIBED.format(summary))
+    # look for lessons right away instead of waiting for the next run
+    scheduler.modify_job(RESOLVE_JOB, next_run_time=datetime.now(scheduler.timezone))
+
+@authorized
+async def list_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    subscriptions = get_subscriptions(update.effective_chat.id)
+    if len(subscriptions) == 0:
+        msg = NO_SUBSCRIPTIONS
+    else:
+        msg = "Subscriptions:\n"
+        for i, subscription in enumerate(subscriptions):
+            msg += f"{i+1}. {slot_summary(subscription)}\n"
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+
+@authorized
+async def remove_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    subscriptions = get_subscriptions(update.effective_chat.id)
+    if len(subscriptions) == 0:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=NO_SUBSCRIPTIONS)
+        return
+    try:
+        number = int(update.message.text.split(" ")[1])
+    except (IndexError, ValueError):
+        number = 0
+    if number < 1 or number > len(subscriptions):
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=UNSUBSCRIBE_NO_NUMBER)
+        return
+    subscription = subscriptions[number-1]
+    with flask_app.app_context():
+        db.session.execute(db.delete(RecurringSubscription).where(RecurringSubscription.id == subscription.id))
+        db.session.commit()
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=UNSUBSCRIBED.format(slot_summary(subscription)))
+
 @authorized
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
@@ -235,6 +850,32 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text=UNKNOWN_COMMAND)
 
+def verify_user(db_user, user, chat):
+    verified = verify_login(db_user.asvz_username, decrypt(db_user.asvz_password, config["app"]["secret"]), db_user.asvz_organisation, backend=ENROLLMENT_BACKEND)
+    if verified:
+        set_user_data(db_user, user, chat)
+    else:
+        reset_token(db_user)
+    return verified
+
+async def notify_verification(bot, chat_id, future):
+    try:
+        verified = await future
+    except Exception as e:
+        logger.error(e)
+        await bot.send_message(chat_id=chat_id, text=VERIFICATION_ERROR)
+    else:
+        await bot.send_message(chat_id=chat_id, text=VALID_CREDENTIALS if verified else INVALID_CREDENTIALS)
+
+async def notify_submission(bot, chat_id, future):
+    try:
+        summary = await future
+    except Exception as e:
+        logger.error(e)
+        await bot.send_message(chat_id=chat_id, text=ERROR_SUBMITTING)
+    else:
+        await bot.send_message(chat_id=chat_id, text=JOB_SUBMITTED.format(summary))
+
 async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
@@ -242,16 +883,16 @@ async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if db_user is None:
         db_user = get_user_from_token(update.message.text)
         if db_user and not db_user.linked:
+                ahead = verifications.pending()
+                future = verifications.submit(db_user.username, verify_user, db_user, user, chat)
+                if future is None:
+                    await context.bot.send_message(chat_id=update.effective_chat.id, text=VERIFICATION_PENDING)
+                    return
                 logger.info(f"User {db_user.username} authorized.")
                 await context.bot.send_message(chat_id=update.effective_chat.id, text=WELCOME.format(db_user.username))
-                verified = verify_login(db_user.asvz_username, decrypt(db_user.asvz_password, config["app"]["secret"]), db_user.asvz_organisation)
-                if verified == 0:
-                    reset_token(db_user)
-                    await context.bot.send_message(chat_id=update.effective_chat.id, text=INVALID_CREDENTIALS)
-                elif verified == 1:
-                    set_user_data(db_user, user, chat)
-                    # update user
-                    await context.bot.send_message(chat_id=update.effective_chat.id, text=VALID_CREDENTIALS)
+                if ahead >= VERIFY_WORKERS:
+                    await context.bot.send_message(chat_id=update.effective_chat.id, text=VERIFICATION_QUEUED.format(ahead))
+                context.application.create_task(notify_verification(context.bot, chat.id, future))
         return
     else:
         logger.info(f"{update.effective_user.username} - Job received: {update.message.text}")
@@ -262,16 +903,30 @@ async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # get full url from message with regex(starts with LESSON_BASE_URL) 
             url = re.search(f"https:\/\/schalter\.asvz\.ch\/tn\/lessons/\d*", update.message.text).group(0)
             if url:
-                job_summary = initialise_job(url, db_user.asvz_username, db_user.asvz_password, db_user.asvz_organisation, chat.id)
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=JOB_SUBMITTED.format(job_summary))
+                future = submissions.submit(chat.id, initialise_job, url, db_user.username, chat.id)
+                if future is None:
+                    await context.bot.send_message(chat_id=update.effective_chat.id, text=TOO_MANY_SUBMISSIONS)
+                    return
+                await context.bot.send_message(chat_id=update.effective_chat.id, text=JOB_RECEIVED)
+                context.application.create_task(notify_submission(context.bot, chat.id, future))
         else:
             await context.bot.send_message(chat_id=update.effective_chat.id, text=NO_URL_FOUND)
    
 
 # Message Dispatcher
-async def send_message(response):
-    bot = Bot(token=config["bot"]["token"])
-    await bot.send_message(chat_id=response.chat_id, text=response.message)
+def send_message(response):
+    # delivered by the notification dispatcher of the bot process
+    queue_message(response.chat_id, response.message)
+
+async def start_dispatcher(application):
+    application.create_task(Dispatcher(application.bot).run())
+
+async def post_init(application):
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    await start_dispatcher(application)
+    # the subscriptions were skipped while the bot was starting
+    scheduler.modify_job(RESOLVE_JOB, next_run_time=datetime.now(scheduler.timezone))
 
 class Response:
     def __init__(self, chat_id, message):
@@ -281,13 +936,19 @@ class Response:
 
 
 if __name__ == '__main__':
-    scheduler.start()
-    application = ApplicationBuilder().token(config["bot"]["token"]).build()
+    with flask_app.app_context():
+        create_all()
+    start_scheduler()
+    application = ApplicationBuilder().token(config["bot"]["token"]).post_init(post_init).build()
 
     # Handlers
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('help', help))
     application.add_handler(CommandHandler('jobs', jobs))
+    application.add_handler(CommandHandler('search', search_lessons))
+    application.add_handler(CommandHandler('subscribe', add_subscription))
+    application.add_handler(CommandHandler('subscriptions', list_subscriptions))
+    application.add_handler(CommandHandler('unsubscribe', remove_subscription))
     delete_handler = ConversationHandler(
         entry_points=[CommandHandler("delete", delete)],
         states={
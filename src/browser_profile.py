@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+from selenium.common.exceptions import WebDriverException
+from loguru import logger
+
+import auth_cache
+
+"""
+Lean browser profile for enrollment sessions.
+
+The enroller only needs the markup and the scripts of the lesson and login pages.
+With the lean profile Chrome skips images, fonts, media and trackers and starts
+without the background services of a desktop browser. Chrome flags and preferences
+are applied to the options of new sessions, the URL blocklist is installed over
+DevTools once a session was created.
+"""
+
+# enabled with configure(), e.g. from the enroller section of the config
+LEAN = False
+
+LEAN_ARGUMENTS = (
+    "--blink-settings=imagesEnabled=false",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-extensions",
+    "--disable-features=Translate,MediaRouter,OptimizationHints",
+    "--disable-notifications",
+    "--disable-sync",
+    "--mute-audio",
+    "--no-first-run",
+)
+
+LEAN_PREFS = {
+    "profile.managed_default_content_settings.images": 2,
+    "profile.default_content_setting_values.notifications": 2,
+}
+
+# patterns as understood by Network.setBlockedURLs, "*" matches any characters
+BLOCKED_URLS = (
+    # images
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    # fonts
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    # media
+    "*.mp4", "*.webm", "*.mp3",
+    # analytics and other third parties
+    "*google-analytics.com*", "*googletagmanager.com*", "*/gtm.js*", "*/gtag/js*",
+    "*doubleclick.net*", "*facebook.net*", "*hotjar.com*", "*youtube.com*",
+)
+
+
+def configure(lean):
+    global LEAN
+    LEAN = bool(lean)
+
+
+def apply_options(options, lean=None):
+    """ Adds the flags and preferences of the lean profile to ChromeOptions. """
+    if not (LEAN if lean is None else lean):
+        return options
+    for argument in LEAN_ARGUMENTS:
+        options.add_argument(argument)
+    prefs = dict(options.experimental_options.get("prefs", {}))
+    prefs.update(LEAN_PREFS)
+    options.add_experimental_option("prefs", prefs)
+    return options
+
+
+def block_resources(driver, lean=None):
+    """ Installs the URL blocklist on a new session. """
+    if not (LEAN if lean is None else lean):
+        return
+    try:
+        auth_cache.cdp(driver, "Network.enable")
+        auth_cache.cdp(driver, "Network.setBlockedURLs", {"urls": list(BLOCKED_URLS)})
+    except WebDriverException as e:
+        # the flags still skip images, the rest loads as usual
+        logger.debug("Could not block resources via DevTools: {}".format(e))
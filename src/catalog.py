@@ -0,0 +1,198 @@
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+
+import requests
+from loguru import logger
+from sqlalchemy.exc import OperationalError
+
+from database import CatalogLesson, CatalogDay, db
+from app import app as flask_app
+from enroller import FACILITIES, LEVELS, WEEKDAYS
+import sportfahrplan
+
+"""
+Local catalog of the lessons in the Sportfahrplan.
+
+A crawler fetches the lessons per facility and day and only rewrites days whose
+lessons changed. Lookups (/search, recurring subscriptions) are local queries,
+titles and sports are searchable through an FTS5 table where SQLite supports it.
+"""
+
+# days ahead the catalog covers
+HORIZON_DAYS = 14
+# days that are close change often (cancellations, substitutes) and are fetched more often
+NEAR_DAYS = 2
+NEAR_MAX_AGE = 30 * 60
+FAR_MAX_AGE = 6 * 60 * 60
+
+SEARCH_LIMIT = 10
+
+FTS_TABLE = "catalog_fts"
+_fts = None
+
+
+def _has_fts():
+    """ Creates the full-text index on first use, False if this SQLite lacks FTS5. """
+    global _fts
+    if _fts is None:
+        try:
+            db.session.execute(db.text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(lesson_id UNINDEXED, title, sport)"))
+            db.session.commit()
+            _fts = True
+        except OperationalError as e:
+            logger.warning(f"No full-text search for the catalog: {e}")
+            db.session.rollback()
+            _fts = False
+    return _fts
+
+
+def _level_key(name):
+    for key in LEVELS:
+        if key.lower() == name.lower():
+            return key
+    return name
+
+
+def _digest(lessons):
+    rows = sorted((lesson["lesson_id"], lesson["title"], lesson["level"], lesson["start"].isoformat()) for lesson in lessons)
+    return hashlib.sha1(json.dumps(rows).encode()).hexdigest()
+
+
+def _is_stale(day, synced_at, now):
+    if synced_at is None:
+        return True
+    max_age = NEAR_MAX_AGE if (day - now.date()).days < NEAR_DAYS else FAR_MAX_AGE
+    return time.time() - synced_at > max_age
+
+
+def _unindex(lesson_ids):
+    if _has_fts():
+        for lesson_id in lesson_ids:
+            db.session.execute(db.text(f"DELETE FROM {FTS_TABLE} WHERE lesson_id = :id"), {"id": lesson_id})
+
+
+def _replace_day(facility, day, lessons):
+    condition = (CatalogLesson.facility == facility, CatalogLesson.day == day)
+    _unindex(db.session.execute(db.select(CatalogLesson.lesson_id).where(*condition)).scalars().all())
+    db.session.execute(db.delete(CatalogLesson).where(*condition))
+    weekdays = list(WEEKDAYS)
+    for lesson in lessons:
+        # a lesson in several facilities is listed once, under the last facility it was fetched for
+        db.session.merge(CatalogLesson(
+            lesson_id=lesson["lesson_id"],
+            url=lesson["url"],
+            sport=lesson["sport"],
+            title=lesson["title"],
+            facility=facility,
+            level=_level_key(lesson["level"]),
+            weekday=weekdays[lesson["start"].weekday()],
+            time=lesson["start"].strftime(sportfahrplan.TIMEFORMAT),
+            day=day,
+            start=lesson["start"],
+            end=lesson["end"],
+        ))
+        _unindex([lesson["lesson_id"]])
+        if _has_fts():
+            db.session.execute(db.text(f"INSERT INTO {FTS_TABLE} (lesson_id, title, sport) VALUES (:id, :title, :sport)"), {"id": lesson["lesson_id"], "title": lesson["title"], "sport": lesson["sport"]})
+
+
+def _prune(today):
+    _unindex(db.session.execute(db.select(CatalogLesson.lesson_id).where(CatalogLesson.day < today)).scalars().all())
+    db.session.execute(db.delete(CatalogLesson).where(CatalogLesson.day < today))
+    db.session.execute(db.delete(CatalogDay).where(CatalogDay.day < today))
+
+
+def sync(search=sportfahrplan.search, now=None):
+    """ Fetches the stale days of every facility, returns how many days changed.
+
+    :param search: lookup of the lessons of a facility between two times, see sportfahrplan.search.
+        Can be replaced to sync from recorded responses.
+    """
+    now = now or datetime.today()
+    today = now.date()
+    changed = 0
+    session = requests.Session()
+    try:
+        with flask_app.app_context():
+            _prune(today)
+            db.session.commit()
+            synced = {
+                (entry.facility, entry.day): entry
+                for entry in db.session.execute(db.select(CatalogDay)).scalars().all()
+            }
+            for facility in FACILITIES:
+                for offset in range(HORIZON_DAYS):
+                    day = today + timedelta(days=offset)
+                    entry = synced.get((facility, day))
+                    if not _is_stale(day, entry.synced_at if entry else None, now):
+                        continue
+                    start = datetime.combine(day, datetime.min.time())
+                    try:
+                        lessons = search(start, start + timedelta(days=1), facility=facility, session=session)
+                    except Exception as e:
+                        logger.warning(f"Fetching the lessons of {facility} on {day} failed: {e}")
+                        continue
+                    digest = _digest(lessons)
+                    if entry is None:
+                        entry = CatalogDay(facility=facility, day=day)
+                        db.session.add(entry)
+                    if entry.digest != digest:
+                        _replace_day(facility, day, lessons)
+                        entry.digest = digest
+                        changed += 1
+                    entry.synced_at = time.time()
+                    db.session.commit()
+    finally:
+        session.close()
+    if changed:
+        logger.info(f"Catalog sync updated {changed} days")
+    return changed
+
+
+def _fts_query(text):
+    # every word as a quoted prefix, so user input can not break the FTS5 syntax
+    return " ".join('"{}"*'.format(word.replace('"', '""')) for word in text.split())
+
+
+def search(text=None, facility=None, level=None, weekday=None, start_time=None, after=None, until=None, limit=SEARCH_LIMIT):
+    """ Upcoming lessons of the catalog, ordered by start.
+
+    :param str text: words to look for in title and sport
+    :param str facility: key of FACILITIES
+    :param str level: key of LEVELS
+    :param str weekday: key of WEEKDAYS
+    :param str start_time: start of the lesson, formatted as sportfahrplan.TIMEFORMAT
+    """
+    with flask_app.app_context():
+        query = db.select(CatalogLesson).where(CatalogLesson.start > (after or datetime.today()))
+        if until is not None:
+            query = query.where(CatalogLesson.start < until)
+        if facility is not None:
+            query = query.where(CatalogLesson.facility == facility)
+        if level is not None:
+            query = query.where(CatalogLesson.level == level)
+        if weekday is not None:
+            query = query.where(CatalogLesson.weekday == weekday)
+        if start_time is not None:
+            query = query.where(CatalogLesson.time == start_time)
+        if text:
+            if _has_fts():
+                matches = db.text(f"SELECT lesson_id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :query").bindparams(query=_fts_query(text))
+                query = query.where(CatalogLesson.lesson_id.in_(matches.columns(db.column("lesson_id"))))
+            else:
+                for word in text.split():
+                    query = query.where(db.or_(CatalogLesson.title.ilike(f"%{word}%"), CatalogLesson.sport.ilike(f"%{word}%")))
+        query = query.order_by(CatalogLesson.start)
+        if limit is not None:
+            query = query.limit(limit)
+        lessons = db.session.execute(query).scalars().all()
+        db.session.expunge_all()
+        return lessons
+
+
+def find_lessons(sport, weekday, start_time, facility=None, level=None, after=None, days=HORIZON_DAYS):
+    """ Lessons of a recurring slot starting after `after` (default now) within the next `days` days. """
+    now = datetime.today()
+    return search(sport, facility, level, weekday, start_time, after=max(after or now, now), until=now + timedelta(days=days), limit=None)
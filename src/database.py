@@ -1,9 +1,96 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
 import yaml
 
+""" Models and the database setup shared by the web app, the bot, its workers and the scripts.
+
+All of them write to the same SQLite files. Every SQLite connection is switched to WAL
+journaling, so readers never block the writer, and waits for a lock instead of failing with
+"database is locked". Pooled connections are only used by the process that opened them, the
+enrollment workers are forked from the bot.
+"""
+
+DATABASE_URI = "sqlite:///asvz.db"
+# seconds a connection waits for another writer
+BUSY_TIMEOUT = 30
+ENGINE_OPTIONS = {
+    "connect_args": {"timeout": BUSY_TIMEOUT},
+    "pool_size": 5,
+    "max_overflow": 10,
+}
+
 # create the extension
 db = SQLAlchemy()
 
+
+@event.listens_for(Engine, "connect")
+def _configure_connection(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # durable across application crashes, only a power loss may lose the last commits
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout={}".format(BUSY_TIMEOUT * 1000))
+    cursor.close()
+
+
+@event.listens_for(Engine, "checkout")
+def _check_process(dbapi_connection, connection_record, connection_proxy):
+    # a connection inherited from the parent process is discarded, the pool opens a new one
+    pid = os.getpid()
+    if connection_record.info.get("pid", pid) != pid:
+        connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+        raise exc.DisconnectionError(
+            "Connection belongs to process {}, checked out in {}".format(connection_record.info["pid"], pid)
+        )
+
+
+def init_app(app):
+    app.config.setdefault("SQLALCHEMY_DATABASE_URI", DATABASE_URI)
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", ENGINE_OPTIONS)
+    db.init_app(app)
+
+
+def create_all():
+    """ Creates missing tables and indexes, needs an app context. """
+    db.create_all()
+    # create_all skips the indexes of tables that already exist
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+_session_factories = {}
+
+
+@contextmanager
+def session_scope(app):
+    """ A session on the pooled engine of `app`, without the cost of pushing an app context.
+
+    Objects stay usable after the block, call commit() to keep changes.
+    """
+    factory = _session_factories.get(app)
+    if factory is None:
+        with app.app_context():
+            factory = sessionmaker(bind=db.engine, expire_on_commit=False)
+        _session_factories[app] = factory
+    session = factory()
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
 class User(db.Model):
     """An admin user capable of viewing reports.
 
@@ -21,9 +108,9 @@ class User(db.Model):
     authenticated = db.Column(db.Boolean, default=False)
     linked = db.Column(db.Boolean, default=False)
     verified = db.Column(db.Integer, default=-1)
-    chat_id = db.Column(db.Integer, default=0)
-    access_token = db.Column(db.String, default="")
-    telegram_username = db.Column(db.String, default="")
+    chat_id = db.Column(db.Integer, default=0, index=True)
+    access_token = db.Column(db.String, default="", index=True)
+    telegram_username = db.Column(db.String, default="", index=True)
 
     def is_active(self):
         """True, as all users are active."""
@@ -40,3 +127,241 @@ class User(db.Model):
     def is_anonymous(self):
         """False, as anonymous users aren't supported."""
         return False
+
+
+class AuthSession(db.Model):
+    """A cached login session of an ASVZ account.
+
+    :param str key: ASVZ username and organisation, see AsvzEnroller.pool_key
+    :param str state: encrypted json of the session cookies and tokens
+    :param float expires: unix time after which the session has to be renewed
+    """
+    __tablename__ = 'auth_session'
+
+    key = db.Column(db.String, primary_key=True)
+    state = db.Column(db.String)
+    expires = db.Column(db.Float)
+
+
+class LessonSubscription(db.Model):
+    """An enrollment job waiting for a place in a full lesson.
+
+    :param str job_id: id of the (paused) enrollment job
+    :param str lesson_id: id of the lesson on schalter.asvz.ch
+    :param str lesson_url: url of the lesson
+    :param float subscribed_at: unix time the lesson was found to be full
+    :param float last_woken: unix time the job was last woken for a free place
+    """
+    __tablename__ = 'lesson_subscription'
+
+    job_id = db.Column(db.String, primary_key=True)
+    lesson_id = db.Column(db.String, index=True)
+    lesson_url = db.Column(db.String)
+    subscribed_at = db.Column(db.Float)
+    last_woken = db.Column(db.Float)
+
+
+class LessonObservation(db.Model):
+    """A free place that showed up in a full lesson.
+
+    :param str lesson_id: id of the lesson on schalter.asvz.ch
+    :param float observed_at: unix time the free place was seen
+    :param float hours_before: hours between the observation and the lesson start
+    """
+    __tablename__ = 'lesson_observation'
+
+    id = db.Column(db.Integer, primary_key=True)
+    lesson_id = db.Column(db.String, index=True)
+    observed_at = db.Column(db.Float, index=True)
+    hours_before = db.Column(db.Float)
+
+
+class LessonFill(db.Model):
+    """How soon after the opening a lesson was first seen fully booked.
+
+    :param str lesson_id: id of the lesson on schalter.asvz.ch
+    :param str series: title, facility, weekday and time of the lesson, shared by its recurrences
+    :param float full_after: seconds between the enrollment start and the first full attempt
+    :param float recorded_at: unix time of the attempt
+    """
+    __tablename__ = 'lesson_fill'
+
+    lesson_id = db.Column(db.String, primary_key=True)
+    series = db.Column(db.String, index=True)
+    full_after = db.Column(db.Float)
+    recorded_at = db.Column(db.Float, index=True)
+
+
+class Lesson(db.Model):
+    """Cached details of a lesson, shared by all users enrolling for it.
+
+    :param str lesson_id: id of the lesson on schalter.asvz.ch
+    :param str title: title of the lesson
+    :param str location: facility of the lesson
+    :param datetime enrollment_start: local time enrollment opens
+    :param datetime lesson_start: local time the lesson starts
+    :param float fetched_at: unix time the details were scraped
+    """
+    __tablename__ = 'lesson'
+
+    lesson_id = db.Column(db.String, primary_key=True)
+    title = db.Column(db.String)
+    location = db.Column(db.String)
+    enrollment_start = db.Column(db.DateTime)
+    lesson_start = db.Column(db.DateTime)
+    fetched_at = db.Column(db.Float)
+
+
+class OutboxMessage(db.Model):
+    """A telegram message waiting to be sent by the notification dispatcher.
+
+    :param int chat_id: telegram chat the message goes to
+    :param str message: text of the message
+    :param float created_at: unix time the message was queued
+    :param int attempts: number of failed send attempts
+    :param float next_attempt_at: unix time of the next send attempt
+    :param float sent_at: unix time the message was delivered, None while pending
+    :param str error: last error, set for messages that were given up on
+    """
+    __tablename__ = 'outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    chat_id = db.Column(db.Integer)
+    message = db.Column(db.String)
+    created_at = db.Column(db.Float)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.Float, index=True)
+    sent_at = db.Column(db.Float, index=True)
+    error = db.Column(db.String)
+
+
+class Broadcast(db.Model):
+    """A message broadcast to all verified users, see broadcast.py.
+
+    :param str message: text of the broadcast
+    :param float created_at: unix time the broadcast was started
+    :param float finished_at: unix time all deliveries were attempted, None while incomplete
+    """
+    __tablename__ = 'broadcast'
+
+    id = db.Column(db.Integer, primary_key=True)
+    message = db.Column(db.String)
+    created_at = db.Column(db.Float)
+    finished_at = db.Column(db.Float)
+
+
+class BroadcastDelivery(db.Model):
+    """Delivery of a broadcast to a single user, checkpointed so interrupted broadcasts can resume.
+
+    :param int broadcast_id: id of the broadcast
+    :param str username: user the message goes to
+    :param int chat_id: telegram chat of the user
+    :param str status: one of 'pending', 'sent' or 'failed'
+    :param str error: error of a failed delivery
+    """
+    __tablename__ = 'broadcast_delivery'
+
+    broadcast_id = db.Column(db.Integer, db.ForeignKey('broadcast.id'), primary_key=True)
+    username = db.Column(db.String, primary_key=True)
+    chat_id = db.Column(db.Integer)
+    status = db.Column(db.String, default='pending', index=True)
+    error = db.Column(db.String)
+
+
+class EnrollmentJob(db.Model):
+    """Summary of a scheduled enrollment job, so jobs can be listed without loading the jobstore.
+
+    :param str job_id: id of the job in the scheduler
+    :param int chat_id: telegram chat of the user that submitted the job
+    :param str lesson_id: id of the lesson on schalter.asvz.ch
+    :param str title: title of the lesson
+    :param str location: facility of the lesson
+    :param datetime enrollment_start: local time enrollment opens
+    :param datetime lesson_start: local time the lesson starts
+    :param str state: one of 'scheduled' or 'waiting' (lesson full, waiting for a free place)
+    :param float created_at: unix time the job was submitted
+    """
+    __tablename__ = 'enrollment_job'
+
+    job_id = db.Column(db.String, primary_key=True)
+    chat_id = db.Column(db.Integer, index=True)
+    lesson_id = db.Column(db.String, index=True)
+    title = db.Column(db.String)
+    location = db.Column(db.String)
+    enrollment_start = db.Column(db.DateTime)
+    lesson_start = db.Column(db.DateTime)
+    state = db.Column(db.String, default='scheduled')
+    created_at = db.Column(db.Float)
+
+
+class RecurringSubscription(db.Model):
+    """A weekly lesson slot a user wants to be enrolled for, resolved through the Sportfahrplan.
+
+    :param str username: user that subscribed
+    :param int chat_id: telegram chat of the user
+    :param str sport: name of the sport, matched against the lessons in the Sportfahrplan
+    :param str weekday: day of the lesson, key of WEEKDAYS
+    :param str time: start of the lesson, e.g. 18:30
+    :param str facility: key of FACILITIES or None for any facility
+    :param str level: key of LEVELS or None for any level
+    :param float created_at: unix time the subscription was created
+    :param datetime resolved_until: start of the latest lesson a job was created for
+    """
+    __tablename__ = 'recurring_subscription'
+
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String, index=True)
+    chat_id = db.Column(db.Integer, index=True)
+    sport = db.Column(db.String)
+    weekday = db.Column(db.String)
+    time = db.Column(db.String)
+    facility = db.Column(db.String)
+    level = db.Column(db.String)
+    created_at = db.Column(db.Float)
+    resolved_until = db.Column(db.DateTime)
+
+
+class CatalogLesson(db.Model):
+    """A lesson of the Sportfahrplan in the local catalog, see catalog.py.
+
+    :param str lesson_id: id of the lesson on schalter.asvz.ch
+    :param str url: url of the lesson
+    :param str sport: name of the sport
+    :param str title: title of the lesson
+    :param str facility: key of FACILITIES the lesson was listed under
+    :param str level: key of LEVELS, or the level as listed if it is not one of them
+    :param str weekday: day of the lesson, key of WEEKDAYS
+    :param str time: start of the lesson, e.g. 18:30
+    :param date day: date of the lesson
+    :param datetime start: local time the lesson starts
+    :param datetime end: local time the lesson ends
+    """
+    __tablename__ = 'catalog_lesson'
+
+    lesson_id = db.Column(db.String, primary_key=True)
+    url = db.Column(db.String)
+    sport = db.Column(db.String, index=True)
+    title = db.Column(db.String)
+    facility = db.Column(db.String, index=True)
+    level = db.Column(db.String, index=True)
+    weekday = db.Column(db.String, index=True)
+    time = db.Column(db.String, index=True)
+    day = db.Column(db.Date, index=True)
+    start = db.Column(db.DateTime, index=True)
+    end = db.Column(db.DateTime)
+
+
+class CatalogDay(db.Model):
+    """Sync state of the lessons of a facility on a day, so unchanged days are not rewritten.
+
+    :param str facility: key of FACILITIES
+    :param date day: date of the lessons
+    :param str digest: hash of the lessons as last fetched
+    :param float synced_at: unix time the day was last fetched
+    """
+    __tablename__ = 'catalog_day'
+
+    facility = db.Column(db.String, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    digest = db.Column(db.String)
+    synced_at = db.Column(db.Float)
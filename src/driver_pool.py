@@ -0,0 +1,412 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import os
+import time
+from contextlib import contextmanager
+
+import requests
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException, NoSuchElementException, TimeoutException
+from sqlalchemy import create_engine, MetaData, Table, Column, String, Float, Boolean, Integer, select, func, inspect, text
+from loguru import logger
+
+"""
+Pool of pre-authenticated remote WebDriver sessions.
+
+Enrollment jobs run in separate worker processes, so the pool is kept in a small
+SQLite registry (session id per user) and workers attach to an existing remote
+session instead of creating a new one. This bounds the number of sessions on the
+grid across all processes.
+
+Sessions can be spread over several selenium nodes, each with its own capacity. New
+sessions go to the least loaded node. Nodes are probed on their status endpoint, a
+node that does not answer is drained: its idle sessions are dropped and it gets no
+new sessions until it answers again.
+
+A session in use records the pid of the worker holding it. Sessions and reservations of
+workers that died, or held far longer than any job takes, are reclaimed, and the bot
+resets the registry when it starts.
+"""
+
+POOL_DB_URL = "sqlite:///instance/driver_pool.db"
+
+# the grid refuses more sessions than this, keep it in sync with docker-compose.yaml
+MAX_SESSIONS = int(os.environ.get("SE_NODE_MAX_SESSIONS", 4))
+MAX_SESSIONS_PER_USER = 2
+# the grid drops sessions that have been idle for 300 seconds (SE_NODE_SESSION_TIMEOUT)
+SESSION_MAX_IDLE = 240
+SESSION_MAX_AGE = 30 * 60
+# sessions held longer than SESSION_MAX_AGE plus this are given up on
+IN_USE_MARGIN = 10 * 60
+ACQUIRE_TIMEOUT = 120
+ACQUIRE_POLL_INTERVAL = 1
+
+# seconds between status probes of a node, shared by all processes
+HEALTH_CHECK_INTERVAL = 30
+HEALTH_CHECK_TIMEOUT = 3
+# seconds a failing node gets no sessions before it is probed again
+DRAIN_PERIOD = 60
+
+metadata = MetaData()
+
+sessions = Table(
+    "driver_session",
+    metadata,
+    Column("id", String, primary_key=True),
+    Column("key", String, index=True),
+    Column("created", Float),
+    Column("last_used", Float),
+    Column("in_use", Boolean, default=False),
+    # url of the node the session lives on
+    Column("node", String, index=True),
+    # pid of the process holding the session while it is in use
+    Column("pid", Integer),
+)
+
+nodes_table = Table(
+    "grid_node",
+    metadata,
+    Column("url", String, primary_key=True),
+    Column("healthy", Boolean),
+    Column("checked", Float),
+    Column("failures", Integer, default=0),
+    Column("drained_until", Float, default=0),
+)
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class Node:
+    """ A selenium endpoint (standalone or grid hub) and how many sessions it takes. """
+
+    def __init__(self, url, capacity=MAX_SESSIONS):
+        self.url = url
+        self.capacity = capacity
+
+    def __repr__(self):
+        return "Node({!r}, {})".format(self.url, self.capacity)
+
+
+class _AttachedRemote(webdriver.Remote):
+    """ Remote driver that reuses an existing session instead of starting a new one. """
+
+    def __init__(self, command_executor, session_id, options):
+        self._attach_session_id = session_id
+        super().__init__(command_executor=command_executor, options=options)
+
+    def start_session(self, *args, **kwargs):
+        self.session_id = self._attach_session_id
+        self.caps = {}
+
+
+class DriverPool:
+    def __init__(self, executor, options_factory, url=POOL_DB_URL, max_sessions=MAX_SESSIONS,
+                 max_per_user=MAX_SESSIONS_PER_USER, session_setup=None, nodes=None):
+        """
+        :param executor: selenium endpoint used when no nodes are given
+        :param nodes: list of Node to spread the sessions over, see set_nodes()
+        """
+        self.options_factory = options_factory
+        # called with every newly created driver, e.g. to configure it over DevTools
+        self.session_setup = session_setup
+        self.url = url
+        self.max_per_user = max_per_user
+        self.nodes = list(nodes) if nodes else [Node(executor, max_sessions)]
+        self._engine = None
+        # drivers of this process, avoids re-attaching to sessions we already hold
+        self._drivers = {}
+
+    def set_nodes(self, nodes):
+        self.nodes = list(nodes)
+
+    @property
+    def executor(self):
+        return self.nodes[0].url
+
+    @property
+    def engine(self):
+        # created lazily, so the pool can be pickled and imported in every process
+        if self._engine is None:
+            self._engine = create_engine(self.url, connect_args={"timeout": 30})
+            metadata.create_all(self._engine)
+            self._migrate()
+        return self._engine
+
+    def _migrate(self):
+        columns = {column["name"] for column in inspect(self._engine).get_columns("driver_session")}
+        # registries of a single node lack the node column, their sessions live on the first node
+        if "node" not in columns:
+            with self._engine.begin() as conn:
+                conn.execute(text("ALTER TABLE driver_session ADD COLUMN node VARCHAR"))
+        # sessions in use without a pid are reclaimed by their age
+        if "pid" not in columns:
+            with self._engine.begin() as conn:
+                conn.execute(text("ALTER TABLE driver_session ADD COLUMN pid INTEGER"))
+        with self._engine.begin() as conn:
+            conn.execute(sessions.update().where(sessions.c.node == None).values(node=self.executor))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_engine"] = None
+        state["_drivers"] = {}
+        return state
+
+    def _driver(self, session_id, node):
+        driver = self._drivers.get(session_id)
+        if driver is None:
+            driver = _AttachedRemote(node, session_id, self.options_factory())
+            self._drivers[session_id] = driver
+        return driver
+
+    def _quit(self, session_id, node):
+        try:
+            self._driver(session_id, node).quit()
+        except WebDriverException as e:
+            logger.debug("Could not quit session {}: {}".format(session_id, e))
+        self._drivers.pop(session_id, None)
+
+    @staticmethod
+    def _healthy(driver):
+        try:
+            driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    @staticmethod
+    def _alive(pid):
+        """ Whether the process holding a session still runs, all workers share the host of the bot. """
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @staticmethod
+    def _probe(node_url):
+        """ Whether the node answers on its status endpoint. A full node is still healthy. """
+        try:
+            response = requests.get(node_url.rstrip("/") + "/status", timeout=HEALTH_CHECK_TIMEOUT)
+            response.raise_for_status()
+            response.json()
+            return True
+        except (requests.RequestException, ValueError) as e:
+            logger.debug("Probing node {} failed: {}".format(node_url, e))
+            return False
+
+    def _record_health(self, node_url, healthy, now):
+        with self.engine.begin() as conn:
+            row = conn.execute(select(nodes_table).where(nodes_table.c.url == node_url)).first()
+            failures = 0 if healthy else (row.failures if row else 0) + 1
+            values = {"healthy": healthy, "checked": now, "failures": failures}
+            if not healthy:
+                values["drained_until"] = now + DRAIN_PERIOD
+                # the idle sessions are lost with the node, sessions in use fail on their own
+                conn.execute(sessions.delete().where((sessions.c.node == node_url) & (sessions.c.in_use == False)))
+            if row is None:
+                conn.execute(nodes_table.insert().values(url=node_url, **values))
+            else:
+                conn.execute(nodes_table.update().where(nodes_table.c.url == node_url).values(**values))
+        if not healthy:
+            logger.warning("Draining selenium node {} for {}s ({} failed checks)".format(node_url, DRAIN_PERIOD, failures))
+
+    def _available_nodes(self):
+        """ Nodes that currently take sessions, probes the ones that were not checked recently. """
+        now = time.time()
+        with self.engine.connect() as conn:
+            checks = {row.url: row for row in conn.execute(select(nodes_table)).all()}
+        available = []
+        for node in self.nodes:
+            check = checks.get(node.url)
+            if check is not None and now < (check.drained_until or 0):
+                continue
+            if check is None or check.checked < now - HEALTH_CHECK_INTERVAL or not check.healthy:
+                healthy = self._probe(node.url)
+                self._record_health(node.url, healthy, now)
+                if not healthy:
+                    continue
+            available.append(node)
+        return available
+
+    def _purge(self, conn, now):
+        """ Removes idle sessions the grid has most likely already dropped or that are too old.
+        Sessions in use are recycled by release() once their worker is done with them, unless
+        the worker died or has held them for longer than SESSION_MAX_AGE plus IN_USE_MARGIN. """
+        stale = conn.execute(
+            select(sessions.c.id, sessions.c.node).where(
+                (sessions.c.in_use == False)
+                & ((sessions.c.last_used < now - SESSION_MAX_IDLE) | (sessions.c.created < now - SESSION_MAX_AGE))
+            )
+        ).all()
+        held = conn.execute(
+            select(sessions.c.id, sessions.c.node, sessions.c.last_used, sessions.c.pid).where(sessions.c.in_use == True)
+        ).all()
+        for session_id, node, acquired, pid in held:
+            if acquired < now - SESSION_MAX_AGE - IN_USE_MARGIN or not self._alive(pid):
+                logger.warning("Reclaiming session {} of process {}".format(session_id, pid))
+                stale.append((session_id, node))
+        for session_id, _ in stale:
+            conn.execute(sessions.delete().where(sessions.c.id == session_id))
+        return [tuple(session) for session in stale]
+
+    @staticmethod
+    def _least_loaded(nodes, load):
+        """ The node with the lowest share of its capacity in use, None if all are full. """
+        candidates = [node for node in nodes if load.get(node.url, 0) < node.capacity]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda node: load.get(node.url, 0) / node.capacity)
+
+    def _reserve(self, key, fresh, nodes):
+        """ Returns the stale sessions and the id and node of a reserved idle session or of a
+        new reservation, the id is None if the pool is full. """
+        now = time.time()
+        urls = [node.url for node in nodes]
+        with self.engine.begin() as conn:
+            stale = self._purge(conn, now)
+
+            if not fresh:
+                session = conn.execute(
+                    select(sessions.c.id, sessions.c.node)
+                    .where((sessions.c.key == key) & (sessions.c.in_use == False) & sessions.c.node.in_(urls))
+                    .order_by(sessions.c.last_used.desc())
+                ).first()
+                if session is not None:
+                    conn.execute(
+                        sessions.update().where(sessions.c.id == session.id).values(in_use=True, last_used=now, pid=os.getpid())
+                    )
+                    return stale, session.id, session.node, False
+
+            load = dict(conn.execute(
+                select(sessions.c.node, func.count()).group_by(sessions.c.node)
+            ).all())
+            per_user = conn.execute(
+                select(func.count()).select_from(sessions).where(sessions.c.key == key)
+            ).scalar()
+            node = self._least_loaded(nodes, load)
+            if node is None or per_user >= self.max_per_user:
+                # make room by dropping the least recently used idle session
+                query = select(sessions.c.id, sessions.c.node).where((sessions.c.in_use == False) & sessions.c.node.in_(urls))
+                if per_user >= self.max_per_user:
+                    query = query.where(sessions.c.key == key)
+                evict = conn.execute(query.order_by(sessions.c.last_used)).first()
+                if evict is None:
+                    return stale, None, None, False
+                conn.execute(sessions.delete().where(sessions.c.id == evict.id))
+                stale.append(tuple(evict))
+                load[evict.node] -= 1
+                node = self._least_loaded(nodes, load)
+                if node is None:
+                    return stale, None, None, False
+
+            reservation = "pending-{}-{}".format(os.getpid(), now)
+            conn.execute(sessions.insert().values(
+                id=reservation, key=key, created=now, last_used=now, in_use=True, node=node.url, pid=os.getpid(),
+            ))
+            return stale, reservation, node.url, True
+
+    def acquire(self, key, fresh=False):
+        """ Returns a driver for `key`, reusing an idle (already logged in) session if possible. """
+        deadline = time.time() + ACQUIRE_TIMEOUT
+        while True:
+            nodes = self._available_nodes()
+            stale, session_id, node, new = self._reserve(key, fresh, nodes) if nodes else ([], None, None, False)
+            for stale_id, stale_node in stale:
+                if not stale_id.startswith("pending-"):
+                    self._quit(stale_id, stale_node)
+            if session_id is not None:
+                break
+            if time.time() > deadline:
+                raise PoolExhausted("No selenium session available")
+            time.sleep(ACQUIRE_POLL_INTERVAL)
+
+        if not new:
+            driver = self._driver(session_id, node)
+            if self._healthy(driver):
+                logger.debug("Reusing warm session {} on {}".format(session_id, node))
+                return driver
+            logger.info("Dropping broken session {}".format(session_id))
+            self._drivers.pop(session_id, None)
+            with self.engine.begin() as conn:
+                conn.execute(sessions.delete().where(sessions.c.id == session_id))
+            return self.acquire(key, fresh)
+
+        try:
+            driver = webdriver.Remote(command_executor=node, options=self.options_factory())
+        except Exception:
+            with self.engine.begin() as conn:
+                conn.execute(sessions.delete().where(sessions.c.id == session_id))
+            if not self._probe(node):
+                # place the session on another node
+                self._record_health(node, False, time.time())
+                return self.acquire(key, fresh)
+            raise
+        with self.engine.begin() as conn:
+            conn.execute(sessions.update().where(sessions.c.id == session_id).values(id=driver.session_id))
+        self._drivers[driver.session_id] = driver
+        if self.session_setup is not None:
+            self.session_setup(driver)
+        logger.debug("Created session {} on {}".format(driver.session_id, node))
+        return driver
+
+    def release(self, key, driver, broken=None):
+        if broken is None:
+            broken = not self._healthy(driver)
+        now = time.time()
+        with self.engine.begin() as conn:
+            session = conn.execute(
+                select(sessions.c.created, sessions.c.node).where(sessions.c.id == driver.session_id)
+            ).first()
+            if broken or session is None or session.created < now - SESSION_MAX_AGE:
+                conn.execute(sessions.delete().where(sessions.c.id == driver.session_id))
+                recycle = True
+            else:
+                conn.execute(
+                    sessions.update().where(sessions.c.id == driver.session_id).values(in_use=False, last_used=now, pid=None)
+                )
+                recycle = False
+        if recycle:
+            try:
+                driver.quit()
+            except WebDriverException as e:
+                logger.debug("Could not quit session {}: {}".format(driver.session_id, e))
+            self._drivers.pop(driver.session_id, None)
+
+    def reset(self):
+        """ Quits the sessions of an earlier run and empties the registry, call before any worker starts. """
+        with self.engine.begin() as conn:
+            known = conn.execute(select(sessions.c.id, sessions.c.node)).all()
+            conn.execute(sessions.delete())
+        for session_id, node in known:
+            if not session_id.startswith("pending-"):
+                self._quit(session_id, node)
+        if known:
+            logger.info("Reset {} sessions of the driver pool".format(len(known)))
+
+    def close(self):
+        """ Quits all idle sessions of the pool. """
+        with self.engine.begin() as conn:
+            idle = conn.execute(select(sessions.c.id, sessions.c.node).where(sessions.c.in_use == False)).all()
+            conn.execute(sessions.delete().where(sessions.c.in_use == False))
+        for session_id, node in idle:
+            self._quit(session_id, node)
+
+    @contextmanager
+    def session(self, key, fresh=False):
+        driver = self.acquire(key, fresh)
+        broken = False
+        try:
+            yield driver
+        except WebDriverException as e:
+            # missing elements and timeouts are page problems, not session problems
+            broken = not isinstance(e, (NoSuchElementException, TimeoutException))
+            raise
+        finally:
+            self.release(key, driver, broken)
@@ -13,9 +13,16 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, StaleElementReferenceException
 from loguru import logger
-import pytz
+from urllib.parse import urlparse
+
+from driver_pool import DriverPool, Node, MAX_SESSIONS
+import auth_cache
+import browser_profile
+import lesson_page
+import metrics
+import timing
 import re
 
 """
@@ -26,6 +33,37 @@ TIMEFORMAT = "%H:%M"
 
 LESSON_BASE_URL = "https://schalter.asvz.ch"
 
+SELENIUM_URL = "http://selenium:4444/wd/hub"
+
+# login is done this many seconds before enrollment opens
+LOGIN_BEFORE_ENROLLMENT = 59
+# seconds between checks whether the register button became clickable
+REGISTER_POLL_FREQUENCY = 0.1
+
+# seconds to wait for the silent SSO redirect when logging in with a cached session
+CACHED_LOGIN_TIMEOUT = 5
+
+# seconds the enrollment waits for page signals, can be changed with configure_timeouts()
+TIMEOUTS = {
+    # implicit wait of every element lookup
+    "implicit_wait": 3,
+    # redirect back to the lesson site after submitting the login
+    "login_redirect": 10,
+    # register button becoming clickable once enrollment opened
+    "register": 15,
+    # register button turning into "ENTFERNEN" after the click
+    "confirmation": 5,
+}
+# fixed waits the page signals replaced, to log the time they save
+LOGIN_SLEEP = 3
+CONFIRMATION_SLEEP = 5
+REGISTER_SLEEP = 60
+
+REGISTER_BUTTON_XPATH = lesson_page.REGISTER_BUTTON_XPATH
+FULL_ALERT_XPATH = lesson_page.FULL_ALERT_XPATH
+# the button is always there, so looking for both never runs into the implicit wait
+REGISTER_OR_FULL_XPATH = "{} | {}".format(REGISTER_BUTTON_XPATH, FULL_ALERT_XPATH)
+
 SPORTFAHRPLAN_BASE_URL = "https://asvz.ch/426-sportfahrplan"
 
 CREDENTIALS_FILENAME = ".asvz-bot.json"
@@ -66,6 +104,10 @@ FACILITIES = {
     "Online": 294542,
 }
 
+# enrollment backends, selenium is always available as a fallback
+BACKEND_SELENIUM = "selenium"
+BACKEND_HTTP = "http"
+
 ISSUES_URL = "https://github.com/fbuetler/asvz-bot/issues"
 NO_SUCH_ELEMENT_ERR_MSG = f"Element on website not found! This may happen when the website was updated recently. Please report this incident to: {ISSUES_URL}"
 
@@ -84,6 +126,16 @@ class LoginFailed(Exception):
 class AlreadyEnrolled(Exception):
     pass
 
+def get_base_url(lesson_url):
+    parsed = urlparse(lesson_url)
+    return "{}://{}".format(parsed.scheme, parsed.netloc)
+
+def get_lesson_id(lesson_url):
+    match = re.search(r"/lessons/(\d+)", lesson_url)
+    if match is None:
+        raise AsvzBotException("Could not find a lesson id in '{}'".format(lesson_url))
+    return match.group(1)
+
 class CredentialsManager:
     def __init__(self, org, uname, password):
         self.credentials = {
@@ -98,17 +150,26 @@ class CredentialsManager:
 
 class AsvzEnroller:
     @staticmethod
-    def get_driver():
+    def get_options():
         options = webdriver.ChromeOptions()
         options.add_argument("--headless")
         options.add_argument("--no-sandbox")
         options.add_experimental_option("prefs", {"intl.accept_languages": "de"})
+        return browser_profile.apply_options(options)
+
+    @staticmethod
+    def get_driver():
         driver = webdriver.Remote(
-            command_executor='http://selenium:4444/wd/hub',
-            options=options
+            command_executor=SELENIUM_URL,
+            options=AsvzEnroller.get_options()
         )
+        browser_profile.block_resources(driver)
         return driver
 
+    @staticmethod
+    def pool_key(credentials):
+        return "{}_{}".format(credentials[CREDENTIALS_UNAME], credentials[CREDENTIALS_ORG])
+
     @staticmethod
     def wait_until(enrollment_start):
         current_time = datetime.today()
@@ -119,31 +180,72 @@ class AsvzEnroller:
             )
         )
 
-        login_before_enrollment_seconds = 1 * 59
-        if (enrollment_start - current_time).seconds > login_before_enrollment_seconds:
-            sleep_time = (
-                enrollment_start - current_time
-            ).seconds - login_before_enrollment_seconds
+        sleep_time = (
+            timing.to_timestamp(enrollment_start) - time.time() - LOGIN_BEFORE_ENROLLMENT
+        )
+        if sleep_time > 0:
             logger.info(
-                "Sleep for {} seconds until {}".format(
+                "Sleep for {:.0f} seconds until {}".format(
                     sleep_time,
                     (current_time + timedelta(seconds=sleep_time)).strftime("%H:%M:%S"),
                 )
             )
             time.sleep(sleep_time)
 
+    def _wait_for_login(self):
+        """ Sleeps until the login before the opening, then syncs with the server clock while there is time. """
+        if datetime.today() < self.enrollment_start:
+            AsvzEnroller.wait_until(self.enrollment_start)
+            timing.get_clock(self.base_url, deadline=timing.to_timestamp(self.enrollment_start))
+
+    def _wait_for_opening(self):
+        """ Waits until enrollment opens on the server clock, returns the clock if it had to wait. """
+        target = timing.to_timestamp(self.enrollment_start)
+        if time.time() > target + LOGIN_BEFORE_ENROLLMENT:
+            return None
+        # synced by _wait_for_login(), unless the job started late
+        clock = timing.get_clock(self.base_url, deadline=target)
+        if clock.wait_until(target):
+            return clock
+        return None
+
+    def _log_fire_error(self, clock, action):
+        if clock is not None:
+            delay = clock.log_fire_error(timing.to_timestamp(self.enrollment_start), action)
+            metrics.observe("enrollment_click_delay_seconds", delay, backend=self.backend)
+
+    def _span(self, phase):
+        return metrics.span(phase, backend=self.backend)
+
+    # cached login session, see auth_cache. Never pickled, it is persisted encrypted by the caller.
+    session_state = None
+    base_url = LESSON_BASE_URL
+    backend = BACKEND_SELENIUM
+    # seconds the waits on page signals saved compared to the fixed sleeps they replaced
+    wait_saved = 0.0
+
     def __init__(self, lesson_url, creds, id):
         self.lesson_url = lesson_url
         self.creds = creds
         self.id = id
+        self.base_url = get_base_url(lesson_url)
+        self.lesson_id = get_lesson_id(lesson_url)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("session_state", None)
+        return state
 
     @staticmethod
     def check_login(credentials):
         logger.info("Checking login credentials")
+        key = AsvzEnroller.pool_key(credentials)
+        driver = None
         try:
-            driver = AsvzEnroller.get_driver()
+            # verify on a fresh session, a warm one would already be logged in
+            driver = DRIVER_POOL.acquire(key, fresh=True)
             driver.get(LESSON_BASE_URL)
-            driver.implicitly_wait(3)
+            driver.implicitly_wait(TIMEOUTS["implicit_wait"])
             logger.info("Login to '{}'".format(credentials[CREDENTIALS_ORG]))
             if credentials[CREDENTIALS_ORG] == "ASVZ":
                 driver.find_element(By.XPATH, "//input[@id='AsvzId']").send_keys(
@@ -192,9 +294,7 @@ class AsvzEnroller:
                 driver.find_element(By.XPATH, "//button[@type='submit']").click()
 
             logger.info("Submitted login credentials")
-            time.sleep(3)  # wait until redirect is completed
-
-            if not driver.current_url.startswith(LESSON_BASE_URL):
+            if not AsvzEnroller.__wait_for_redirect(driver, TIMEOUTS["login_redirect"]):
                 logger.warning(
                     "Authentication might have failed. Current URL is '{}'".format(
                         driver.current_url
@@ -209,46 +309,70 @@ class AsvzEnroller:
             raise e
         finally:
             if driver is not None:
-                driver.quit()
+                DRIVER_POOL.release(key, driver)
+
+    def prewarm(self):
+        """ Logs in on a pooled session ahead of the enrollment, so enroll() gets a warm one. """
+        key = AsvzEnroller.pool_key(self.creds)
+        driver = None
+        try:
+            driver = DRIVER_POOL.acquire(key)
+            driver.get(self.lesson_url)
+            driver.implicitly_wait(TIMEOUTS["implicit_wait"])
+            self.__organisation_login(driver)
+            logger.info("Session is warm.")
+        finally:
+            if driver is not None:
+                DRIVER_POOL.release(key, driver)
 
     def enroll(self):
-        if datetime.today() < self.enrollment_start:
-            AsvzEnroller.wait_until(self.enrollment_start)
+        self._wait_for_login()
 
+        key = AsvzEnroller.pool_key(self.creds)
+        driver = None
         try:
-            driver = AsvzEnroller.get_driver()
-            driver.get(self.lesson_url)
-            driver.implicitly_wait(3)
+            with self._span("driver"):
+                driver = DRIVER_POOL.acquire(key)
+            with self._span("page_load"):
+                driver.get(self.lesson_url)
+            driver.implicitly_wait(TIMEOUTS["implicit_wait"])
 
             while True:
                 logger.info("Starting enrollment")
 
-                self.__check_for_free_places(driver)
+                with self._span("free_place_check"):
+                    state = lesson_page.snapshot(driver, TIMEOUTS["implicit_wait"])
+                    self.__check_for_free_places(state)
 
                 logger.info("Lesson has free places.")
 
-                self.__organisation_login(driver)
+                with self._span("login"):
+                    self.__organisation_login(driver, state=state)
                     
                 try:
                     logger.info("Waiting for enrollment")
-                    button = WebDriverWait(driver, 60).until(
-                        EC.element_to_be_clickable(
-                            (
-                                By.XPATH,
-                                "//button[@id='btnRegister']",
-                            )
-                        )
-                    )
+                    clock = self._wait_for_opening()
+                    with self._span("wait_for_register"):
+                        button = self.__wait_for_register(driver)
                     if "ENTFERNEN" in button.text:
                         logger.info("Already enrolled.")
                         raise AlreadyEnrolled
-                    button.click()
-                    time.sleep(5)
+                    with self._span("click"):
+                        button.click()
+                    self._log_fire_error(clock, "registration click")
+                    with self._span("confirmation"):
+                        self.__wait_for_confirmation(driver)
                 except TimeoutException as e:
                     logger.info(
                         "Place was already taken in the meantime. Rechecking for available places."
                     )
+                    metrics.count("enrollment_retries_total", reason="place_taken", backend=self.backend)
+                    driver.refresh()
                     continue
+                except LessonFull as e:
+                    logger.info("Place was already taken in the meantime.")
+                    metrics.count("enrollment_retries_total", reason="place_taken", backend=self.backend)
+                    raise e
                 except AlreadyEnrolled as e:
                     raise e
                 except Exception as e:
@@ -262,118 +386,161 @@ class AsvzEnroller:
             raise e
         finally:
             if driver is not None:
-                driver.quit()
-
-    @staticmethod
-    def __get_enrollment_and_start_time(driver):
-        try:
-            try:
-                driver.find_element(By.TAG_NAME, "app-page-not-found")
-            except NoSuchElementException:
-                pass
-            else:
-                logging.error("Lesson not found! Please check your lesson details")
-                raise Exception("Lesson not found")
-
-            enrollment_start = AsvzEnroller.__get_enrollment_time(driver)
-            lesson_start = AsvzEnroller.__get_lesson_time(driver)
-        except NoSuchElementException as e:
-            logging.error(NO_SUCH_ELEMENT_ERR_MSG)
-            raise e
-
-        return (enrollment_start, lesson_start)
-
-    @staticmethod
-    def __get_enrollment_time(driver):
-        # requires the user to be logged in, as the intro text is only available then
-        try:
-            introduction_text = driver.find_element(
-                By.XPATH, "//span[contains(., 'Online-Einschreibungen')]"
-            ).get_attribute("innerHTML")
-        except NoSuchElementException as e:
-            logging.info(
-                "No enrollment time found. Assuming enrollment is already open."
-            )
-            # setting enrollment to some date in the past
-            return datetime.today() - timedelta(days=1)
-
-        # assumes enrollment start is the first date
-        enrollment_start_raw = re.findall(
-            "\d{2}\.\d{2}\.\d{4}\s\d{2}:\d{2}", introduction_text
-        )[0]
-
-        # enrollment_start_raw is like '17.01.2023 20:00'
-        enrollment_start_raw = enrollment_start_raw.strip()
+                DRIVER_POOL.release(key, driver)
+            self._log_wait_saved()
+
+    @classmethod
+    def enroll_batch(cls, enrollers):
+        """ Enrolls for several lessons of one account that open at the same time, with a single login.
+
+        Every lesson is loaded in its own tab ahead of the opening, so registering only takes a click per lesson.
+        Returns a dict of enroller id to the exception the lesson failed with, None if enrolled.
+        """
+        first = enrollers[0]
+        first._wait_for_login()
+
+        key = AsvzEnroller.pool_key(first.creds)
+        results = {}
+        tabs = {}
+        driver = None
         try:
-            enrollment_start = datetime.strptime(enrollment_start_raw, "%d.%m.%Y %H:%M")
-        except ValueError as e:
-            logging.error(e)
-            raise AsvzBotException(
-                "Failed to parse enrollment start time: '{}'".format(
-                    enrollment_start_raw
-                )
-            )
-        return enrollment_start
+            with first._span("driver"):
+                driver = DRIVER_POOL.acquire(key)
+            main = driver.current_window_handle
+            for enroller in enrollers:
+                if driver.current_window_handle in tabs.values():
+                    driver.switch_to.new_window("tab")
+                try:
+                    with enroller._span("page_load"):
+                        driver.get(enroller.lesson_url)
+                    driver.implicitly_wait(TIMEOUTS["implicit_wait"])
+                    with enroller._span("free_place_check"):
+                        state = lesson_page.snapshot(driver, TIMEOUTS["implicit_wait"])
+                        enroller.__check_for_free_places(state)
+                    # only the first tab has to log in, the others share its cookies
+                    enroller.session_state = first.session_state
+                    with enroller._span("login"):
+                        enroller.__organisation_login(driver, state=state)
+                    first.session_state = enroller.session_state
+                except (LessonStarted, LessonFull, NoSuchElementException) as e:
+                    results[enroller.id] = e
+                    continue
+                tabs[enroller.id] = driver.current_window_handle
 
-    @staticmethod
-    def __get_lesson_time(driver):
-        lesson_interval_raw = driver.find_element(
-            By.XPATH, "//dl[contains(., 'Datum/Zeit')]/dd"
-        )
-        # lesson_interval_raw is like 'Mo, 10.05.2021 06:55 - 08:05'
-        lesson_start_raw = (
-            lesson_interval_raw.get_attribute("innerHTML")
-            .split("-")[0]
-            .split(",")[1]
-            .strip()
-        )
-        try:
-            lesson_start = datetime.strptime(lesson_start_raw, "%d.%m.%Y %H:%M")
-        except ValueError as e:
-            logging.error(e)
-            raise AsvzBotException(
-                "Failed to parse lesson start time: '{}'".format(lesson_start_raw)
-            )
-        return lesson_start
+            logger.info("Waiting for enrollment of {} lessons".format(len(tabs)))
+            clock = first._wait_for_opening()
+            for enroller in enrollers:
+                if enroller.id not in tabs:
+                    continue
+                driver.switch_to.window(tabs[enroller.id])
+                try:
+                    with enroller._span("wait_for_register"):
+                        button = enroller.__wait_for_register(driver)
+                    if "ENTFERNEN" in button.text:
+                        logger.info("Already enrolled for {}.".format(enroller.lesson_id))
+                        raise AlreadyEnrolled
+                    with enroller._span("click"):
+                        button.click()
+                    first._log_fire_error(clock, "registration click")
+                except TimeoutException:
+                    # taken before we got to it, the job of the lesson keeps checking for free places
+                    results[enroller.id] = LessonFull()
+                except Exception as e:
+                    results[enroller.id] = e
+                else:
+                    results[enroller.id] = None
+            with first._span("confirmation"):
+                for enroller in enrollers:
+                    if results.get(enroller.id, False) is not None:
+                        continue
+                    driver.switch_to.window(tabs[enroller.id])
+                    try:
+                        enroller.__wait_for_confirmation(driver)
+                    except LessonFull as e:
+                        results[enroller.id] = e
+            logger.info("Enrolled for {} of {} lessons.".format(list(results.values()).count(None), len(enrollers)))
+            return results
+        finally:
+            if driver is not None:
+                # the session goes back to the pool with a single tab
+                for handle in driver.window_handles:
+                    if handle != main:
+                        driver.switch_to.window(handle)
+                        driver.close()
+                driver.switch_to.window(main)
+                DRIVER_POOL.release(key, driver)
+            first.wait_saved += sum(enroller.wait_saved for enroller in enrollers[1:])
+            first._log_wait_saved()
 
     def setup(self):
+        key = AsvzEnroller.pool_key(self.creds)
         driver = None
         try:
-            driver = AsvzEnroller.get_driver()
+            driver = DRIVER_POOL.acquire(key)
             driver.get(self.lesson_url)
-            driver.implicitly_wait(3)
+            driver.implicitly_wait(TIMEOUTS["implicit_wait"])
             self.__organisation_login(driver)
-            (
-                self.enrollment_start,
-                self.lesson_start,
-            ) = AsvzEnroller.__get_enrollment_and_start_time(driver)
-            self.enrollment_start.replace(tzinfo=pytz.timezone("CET"))
-            self.lesson_start.replace(tzinfo=pytz.timezone("CET"))
-
-            self.lesson_title = driver.find_element(By.XPATH, "//h1").text
-            lesson_location_raw = driver.find_element(
-               By.XPATH, "//dl[contains(., 'Anlage')]/dd"
-            )
-            self.lesson_location = lesson_location_raw.text
+            # the enrollment time is only shown when logged in
+            self.__apply_state(lesson_page.snapshot(driver, TIMEOUTS["implicit_wait"]))
             logger.info("Lesson title: '{}' at '{}'".format(self.lesson_title, self.lesson_location))
         except NoSuchElementException as e:
             logging.error(NO_SUCH_ELEMENT_ERR_MSG)
             raise e
+        except lesson_page.PageParseError as e:
+            logging.error(e)
+            raise AsvzBotException(str(e))
         finally:
             if driver is not None:
-                driver.quit()
+                DRIVER_POOL.release(key, driver)
 
-    def __organisation_login(self, driver, retry=True):
+    def __apply_state(self, state):
+        if state.not_found:
+            logging.error("Lesson not found! Please check your lesson details")
+            raise AsvzBotException("Lesson not found")
+        if state.lesson_start is None or state.title is None or state.location is None:
+            raise NoSuchElementException("Lesson details not found")
+
+        if state.enrollment_start is None:
+            logging.info(
+                "No enrollment time found. Assuming enrollment is already open."
+            )
+            # setting enrollment to some date in the past
+            self.enrollment_start = datetime.today() - timedelta(days=1)
+        else:
+            self.enrollment_start = state.enrollment_start
+        self.lesson_start = state.lesson_start
+        self.lesson_title = state.title
+        self.lesson_location = state.location
+
+    def get_metadata(self):
+        """ Lesson details as scraped by setup(), can be cached and restored with set_metadata(). """
+        return {
+            "title": self.lesson_title,
+            "location": self.lesson_location,
+            "enrollment_start": self.enrollment_start,
+            "lesson_start": self.lesson_start,
+        }
+
+    def set_metadata(self, metadata):
+        self.lesson_title = metadata["title"]
+        self.lesson_location = metadata["location"]
+        self.enrollment_start = metadata["enrollment_start"]
+        self.lesson_start = metadata["lesson_start"]
+
+    def __organisation_login(self, driver, retry=True, state=None):
         logger.debug("Start login process")
-        try:
-            logger.debug("Check if already logged in")
-            driver.find_element(By.XPATH, "//button[@class='btn btn-default' and @title='Login']")
-        except NoSuchElementException:
+        logger.debug("Check if already logged in")
+        if state is None:
+            state = lesson_page.snapshot(driver, TIMEOUTS["implicit_wait"])
+        if state.logged_in:
             logger.debug("Already logged in")
             return
-        except Exception as e:
-            logger.error(e)
-            raise e
+
+        cached = auth_cache.is_valid(self.session_state)
+        if cached:
+            logger.debug("Restoring cached session")
+            auth_cache.set_browser_cookies(driver, self.session_state["cookies"])
+
         WebDriverWait(driver, 20).until(
             EC.element_to_be_clickable(
                 (
@@ -383,6 +550,10 @@ class AsvzEnroller:
             )
         ).click()
 
+        if cached and self.__wait_for_redirect(driver):
+            logger.debug("Logged in with cached session")
+            return self.__store_session(driver)
+
         logger.info("Login to '{}'".format(self.creds[CREDENTIALS_ORG]))
         if self.creds[CREDENTIALS_ORG] == "ASVZ":
             driver.find_element(By.XPATH, "//input[@id='AsvzId']").send_keys(
@@ -414,12 +585,18 @@ class AsvzEnroller:
                 )
             ).click()
 
-            organization = driver.find_element(
+            # the cached WAYF and IdP cookies may skip the selection or the whole IdP login
+            if cached and self.__wait_for_redirect(driver):
+                logger.debug("Logged in with cached SwitchAAI session")
+                return self.__store_session(driver)
+
+            organization = driver.find_elements(
                 By.XPATH, "//input[@id='userIdPSelection_iddtext']"
             )
-            organization.send_keys("{}a".format(Keys.CONTROL))
-            organization.send_keys(self.creds[CREDENTIALS_ORG])
-            organization.send_keys(Keys.ENTER)
+            if organization:
+                organization[0].send_keys("{}a".format(Keys.CONTROL))
+                organization[0].send_keys(self.creds[CREDENTIALS_ORG])
+                organization[0].send_keys(Keys.ENTER)
 
             # apparently all organisations have the same xpath
             driver.find_element(By.XPATH, "//input[@id='username']").send_keys(
@@ -431,49 +608,138 @@ class AsvzEnroller:
             driver.find_element(By.XPATH, "//button[@type='submit']").click()
 
         logger.debug("Submitted login credentials")
-        time.sleep(3)  # wait until redirect is completed
-
-        if not driver.current_url.startswith(LESSON_BASE_URL):
+        waited = time.perf_counter()
+        if not self.__wait_for_redirect(driver, TIMEOUTS["login_redirect"]):
             logger.warning(
                 "Authentication might have failed. Current URL is '{}'".format(
                     driver.current_url
                 )
             )
+            self.session_state = None
             if retry:
                 logger.warning("Sleeping for 5 seconds and retrying...")
+                metrics.count("enrollment_retries_total", reason="login", backend=self.backend)
                 self.__organisation_login(driver, retry=False)
                 return True
             raise LoginFailed("Login failed")
         else:
             logger.debug("Valid login credentials")
-            return True
+            self.wait_saved += LOGIN_SLEEP - (time.perf_counter() - waited)
+            return self.__store_session(driver)
 
-    def __check_for_free_places(self, driver):
+    def __store_session(self, driver):
+        self.session_state = auth_cache.make_state(auth_cache.get_browser_cookies(driver))
+        return True
+
+    @staticmethod
+    def __wait_for_redirect(driver, timeout=CACHED_LOGIN_TIMEOUT):
+        try:
+            WebDriverWait(driver, timeout).until(
+                lambda d: d.current_url.startswith(LESSON_BASE_URL)
+            )
+        except TimeoutException:
+            return False
+        return True
+
+    @staticmethod
+    def __find_register_or_full(driver):
+        """ The register button once clickable, raises LessonFull if the lesson got booked out, else False. """
+        for element in driver.find_elements(By.XPATH, REGISTER_OR_FULL_XPATH):
+            if element.tag_name == "div":
+                raise LessonFull()
+            if element.is_displayed() and element.is_enabled():
+                return element
+        return False
+
+    def __wait_for_register(self, driver):
+        """ Waits for the register button, a lesson booked out in the meantime ends the wait right away. """
+        waited = time.perf_counter()
+        try:
+            return WebDriverWait(
+                driver,
+                TIMEOUTS["register"],
+                poll_frequency=REGISTER_POLL_FREQUENCY,
+                ignored_exceptions=(StaleElementReferenceException,),
+            ).until(AsvzEnroller.__find_register_or_full)
+        except LessonFull:
+            # a lost race used to wait for the button until the timeout
+            self.wait_saved += REGISTER_SLEEP - (time.perf_counter() - waited)
+            raise
+
+    def __wait_for_confirmation(self, driver):
+        """ Waits until the button turns into "ENTFERNEN", raises LessonFull if the place was taken before. """
+
+        def confirmed(d):
+            for element in d.find_elements(By.XPATH, REGISTER_OR_FULL_XPATH):
+                if element.tag_name == "div":
+                    raise LessonFull()
+                if "ENTFERNEN" in element.text:
+                    return True
+            return False
+
+        waited = time.perf_counter()
+        try:
+            WebDriverWait(
+                driver,
+                TIMEOUTS["confirmation"],
+                poll_frequency=REGISTER_POLL_FREQUENCY,
+                ignored_exceptions=(StaleElementReferenceException,),
+            ).until(confirmed)
+        except TimeoutException:
+            # the page did not change, the registration most likely went through anyway
+            logger.warning("No confirmation of the registration after {}s".format(TIMEOUTS["confirmation"]))
+        self.wait_saved += CONFIRMATION_SLEEP - (time.perf_counter() - waited)
+
+    def _log_wait_saved(self):
+        if self.wait_saved:
+            logger.info("Waiting on page signals saved {:.1f}s compared to fixed sleeps".format(self.wait_saved))
+
+    def __check_for_free_places(self, state):
         if datetime.today() > self.lesson_start:
             raise LessonStarted(
                 "Stopping enrollment because lesson has started."
             )
-        
-        try:
-            driver.find_element(
-                By.XPATH,
-                "//div[@class='alert alert-warning'][contains(., 'ausgebucht')]",
-            )
-        except NoSuchElementException:
-            # has free places
-            return
-
-
-        logger.info("Lesson is full.")
-        raise LessonFull()
 
-def verify_login(username, password, organisation):
+        if state.full:
+            logger.info("Lesson is full.")
+            raise LessonFull()
+
+DRIVER_POOL = DriverPool(SELENIUM_URL, AsvzEnroller.get_options, session_setup=browser_profile.block_resources)
+
+def get_enroller_class(backend):
+    if backend == BACKEND_SELENIUM:
+        return AsvzEnroller
+    elif backend == BACKEND_HTTP:
+        # imported here as the http backend builds on top of this module
+        from http_enroller import HttpEnroller
+        return HttpEnroller
+    raise AsvzBotException("Unknown enrollment backend '{}'".format(backend))
+
+def configure_timeouts(timeouts):
+    """ Overrides entries of TIMEOUTS, e.g. from the enroller section of the config. """
+    for name, value in (timeouts or {}).items():
+        if name not in TIMEOUTS:
+            raise AsvzBotException("Unknown enroller timeout '{}'".format(name))
+        TIMEOUTS[name] = float(value)
+
+def configure_nodes(nodes):
+    """ Spreads the selenium sessions over several nodes, a list of dicts with url and capacity. """
+    if nodes:
+        DRIVER_POOL.set_nodes([Node(node["url"], int(node.get("capacity", MAX_SESSIONS))) for node in nodes])
+
+def verify_login(username, password, organisation, backend=BACKEND_SELENIUM):
     creds = CredentialsManager(organisation, username, password)
-    return AsvzEnroller.check_login(creds.get())
+    return get_enroller_class(backend).check_login(creds.get())
 
-def get_enroller(lesson_url, username, password, organisation):
+def get_enroller(lesson_url, username, password, organisation, backend=BACKEND_SELENIUM, session_state=None, metadata=None, id=None):
     creds = CredentialsManager(organisation, username, password)
-    id = f"{username}_{organisation}_{lesson_url}"
-    enroller = AsvzEnroller(lesson_url, creds.get(), id)
-    enroller.setup()
+    if id is None:
+        id = f"{username}_{organisation}_{lesson_url}"
+    enroller = get_enroller_class(backend)(lesson_url, creds.get(), id)
+    enroller.session_state = session_state
+    if metadata is not None:
+        # known lesson, no need to load the page
+        enroller.set_metadata(metadata)
+    else:
+        enroller.setup()
     return enroller
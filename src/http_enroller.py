@@ -0,0 +1,527 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import time
+from datetime import datetime, timedelta
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse, parse_qs, urlencode
+import secrets
+
+import requests
+from requests.adapters import HTTPAdapter
+from loguru import logger
+
+import auth_cache
+import metrics
+from timing import LESSON_TIMEZONE
+
+from enroller import (
+    AsvzEnroller,
+    AsvzBotException,
+    LessonStarted,
+    LessonFull,
+    LoginFailed,
+    AlreadyEnrolled,
+    LESSON_BASE_URL,
+    BACKEND_HTTP,
+    CREDENTIALS_ORG,
+    CREDENTIALS_UNAME,
+    CREDENTIALS_PW,
+    ORGANISATIONS,
+)
+
+"""
+Enrollment backend that talks to the schalter API directly with pooled HTTP
+requests instead of driving a browser. Falls back to the Selenium
+implementation of AsvzEnroller whenever the API behaves unexpectedly.
+"""
+
+# identity server of the login, can be changed with configure_auth_url(), e.g. to a local stub
+AUTH_BASE_URL = "https://auth.asvz.ch"
+
+API_LESSON_PATH = "/tn-api/api/Lessons/{}"
+API_ENROLLMENT_PATH = "/tn-api/api/Lessons/{}/Enrollment"
+API_MY_ENROLLMENT_PATH = "/tn-api/api/Lessons/{}/MyEnrollment"
+
+OIDC_CLIENT_ID = "55776bff-ef75-4c9d-9bdd-45e883ec38e0"
+OIDC_REDIRECT_PATH = "/tn/assets/oidc-login-redirect.html"
+OIDC_SCOPE = "openid profile tn-api tn-apiext tn-auth tn-hangfire"
+
+# SwitchAAI entity ids of the identity providers, keyed by the display name in ORGANISATIONS
+ORGANISATION_IDPS = {
+    ORGANISATIONS["ETH"]: "https://aai-logon.ethz.ch/idp/shibboleth",
+    ORGANISATIONS["UZH"]: "https://aai-idp.uzh.ch/idp/shibboleth",
+    ORGANISATIONS["ZHAW"]: "https://aai-login.zhaw.ch/idp/shibboleth",
+    ORGANISATIONS["PHZH"]: "https://aai-login.phzh.ch/idp/shibboleth",
+}
+
+REQUEST_TIMEOUT = 10
+POOL_SIZE = 4
+MAX_LOGIN_STEPS = 12
+
+
+def configure_auth_url(auth_url):
+    """ Overrides AUTH_BASE_URL, e.g. from the enroller section of the config. """
+    global AUTH_BASE_URL
+    if auth_url:
+        AUTH_BASE_URL = auth_url
+
+
+class HttpBackendError(AsvzBotException):
+    """ The schalter API answered in a way the HTTP backend does not understand. """
+    pass
+
+
+class _Form:
+    def __init__(self, action, method):
+        self.action = action
+        self.method = method
+        self.fields = {}
+        self.ids = {}
+        self.buttons = []
+        self.selects = []
+
+
+class _FormParser(HTMLParser):
+    """ Collects all forms of a page with their inputs, buttons and selects. """
+
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self._form = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "form":
+            self._form = _Form(attrs.get("action") or "", (attrs.get("method") or "get").lower())
+            self.forms.append(self._form)
+        elif self._form is None:
+            return
+        elif tag == "input":
+            name = attrs.get("name")
+            if name is None:
+                return
+            if attrs.get("type") in ("submit", "image"):
+                self._form.buttons.append(attrs)
+                return
+            if attrs.get("type") in ("checkbox", "radio") and "checked" not in attrs:
+                return
+            self._form.fields[name] = attrs.get("value") or ""
+            if attrs.get("id"):
+                self._form.ids[attrs["id"]] = name
+        elif tag == "button":
+            self._form.buttons.append(attrs)
+        elif tag == "select" and attrs.get("name"):
+            self._form.selects.append(attrs["name"])
+
+    def handle_endtag(self, tag):
+        if tag == "form":
+            self._form = None
+
+
+def _parse_forms(html):
+    parser = _FormParser()
+    parser.feed(html)
+    return parser.forms
+
+
+def parse_api_time(raw):
+    # the API returns ISO timestamps with offset, the rest of the enroller works with naive local times
+    parsed = datetime.fromisoformat(raw.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        return parsed
+    return parsed.astimezone(LESSON_TIMEZONE).replace(tzinfo=None)
+
+
+class HttpClient:
+    """ Thin client for the schalter API and the ASVZ/SwitchAAI login flow. """
+
+    def __init__(self, base_url=LESSON_BASE_URL, auth_url=None):
+        self.base_url = base_url.rstrip("/")
+        self.auth_url = (auth_url or AUTH_BASE_URL).rstrip("/")
+        self.access_token = None
+        self.expires = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept-Language": "de"})
+
+    def close(self):
+        self.session.close()
+
+    def restore(self, state):
+        """ Reuses a cached session, returns False if it has expired. """
+        if not auth_cache.is_valid(state):
+            return False
+        self.access_token = state.get("access_token")
+        self.expires = state["expires"]
+        for cookie in state["cookies"]:
+            self.session.cookies.set(
+                cookie["name"], cookie["value"], domain=cookie.get("domain", ""), path=cookie.get("path", "/")
+            )
+        return self.access_token is not None
+
+    def export(self):
+        cookies = [
+            {
+                "name": cookie.name,
+                "value": cookie.value,
+                "domain": cookie.domain,
+                "path": cookie.path,
+                "expires": cookie.expires if cookie.expires is not None else -1,
+                "secure": cookie.secure,
+            }
+            for cookie in self.session.cookies
+        ]
+        return auth_cache.make_state(cookies, self.access_token, self.expires)
+
+    def _request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        return self.session.request(method, url, **kwargs)
+
+    def _api(self, method, path, **kwargs):
+        headers = kwargs.pop("headers", {})
+        if self.access_token is not None:
+            headers["Authorization"] = "Bearer {}".format(self.access_token)
+        return self._request(method, self.base_url + path, headers=headers, **kwargs)
+
+    def get_lesson(self, lesson_id):
+        response = self._api("GET", API_LESSON_PATH.format(lesson_id))
+        if response.status_code == 404:
+            raise AsvzBotException("Lesson not found")
+        if response.status_code != 200:
+            raise HttpBackendError(
+                "Unexpected status {} while loading lesson {}".format(response.status_code, lesson_id)
+            )
+        try:
+            return response.json()["data"]
+        except (ValueError, KeyError) as e:
+            raise HttpBackendError("Malformed lesson response: {}".format(e))
+
+    def is_enrolled(self, lesson_id):
+        response = self._api("GET", API_MY_ENROLLMENT_PATH.format(lesson_id))
+        if response.status_code == 401:
+            raise LoginFailed("Session is not authenticated")
+        return response.status_code == 200
+
+    def enroll(self, lesson_id):
+        """ Returns None on success, otherwise the error message of the API. """
+        response = self._api("POST", API_ENROLLMENT_PATH.format(lesson_id), json={})
+        if response.status_code in (200, 201):
+            return None
+        if response.status_code == 401:
+            raise LoginFailed("Session is not authenticated")
+        if response.status_code not in (400, 409, 422):
+            raise HttpBackendError(
+                "Unexpected status {} while enrolling for lesson {}".format(response.status_code, lesson_id)
+            )
+        try:
+            errors = response.json().get("errors") or []
+            return " ".join(error.get("message", "") for error in errors) or response.text
+        except ValueError:
+            return response.text
+
+    def login(self, credentials):
+        logger.info("Login to '{}'".format(credentials[CREDENTIALS_ORG]))
+        query = urlencode({
+            "client_id": OIDC_CLIENT_ID,
+            "redirect_uri": self.base_url + OIDC_REDIRECT_PATH,
+            "response_type": "id_token token",
+            "scope": OIDC_SCOPE,
+            "state": secrets.token_hex(16),
+            "nonce": secrets.token_hex(16),
+        })
+        response = self._request("GET", "{}/connect/authorize?{}".format(self.auth_url, query))
+
+        for _ in range(MAX_LOGIN_STEPS):
+            token, expires_in = self._find_access_token(response)
+            if token is not None:
+                self.access_token = token
+                self.expires = time.time() + expires_in if expires_in else None
+                logger.debug("Valid login credentials")
+                return True
+            form = self._next_login_form(response, credentials)
+            if form is None:
+                break
+            response = self._submit(response, form)
+
+        logger.warning("Authentication might have failed. Current URL is '{}'".format(response.url))
+        return False
+
+    @staticmethod
+    def _find_access_token(response):
+        # the token is only handed out in the fragment of the redirect target
+        for r in [*response.history, response]:
+            for url in (r.headers.get("Location", ""), r.url):
+                fragment = urlparse(url).fragment
+                if "access_token=" in fragment:
+                    values = parse_qs(fragment)
+                    expires_in = int(values.get("expires_in", ["0"])[0])
+                    return values["access_token"][0], expires_in
+        return None, None
+
+    def _next_login_form(self, response, credentials):
+        forms = _parse_forms(response.text)
+
+        # SAML assertions are relayed by auto-submitting forms
+        for form in forms:
+            if "SAMLResponse" in form.fields or "SAMLRequest" in form.fields:
+                return form
+
+        for form in forms:
+            # ASVZ login form
+            if "AsvzId" in form.ids or "AsvzId" in form.fields:
+                if credentials[CREDENTIALS_ORG] != "ASVZ":
+                    continue
+                form.fields[form.ids.get("AsvzId", "AsvzId")] = credentials[CREDENTIALS_UNAME]
+                form.fields[form.ids.get("Password", "Password")] = credentials[CREDENTIALS_PW]
+                return form
+            # SwitchAAI IdP login form, apparently all organisations use the same ids
+            if "username" in form.ids and "password" in form.ids:
+                form.fields[form.ids["username"]] = credentials[CREDENTIALS_UNAME]
+                form.fields[form.ids["password"]] = credentials[CREDENTIALS_PW]
+                for button in form.buttons:
+                    if button.get("name") == "_eventId_proceed":
+                        form.fields["_eventId_proceed"] = button.get("value", "")
+                return form
+            # SwitchAAI organisation selection
+            if "user_idp" in form.selects or "user_idp" in form.fields:
+                if credentials[CREDENTIALS_ORG] not in ORGANISATION_IDPS:
+                    raise HttpBackendError(
+                        "No known identity provider for '{}'".format(credentials[CREDENTIALS_ORG])
+                    )
+                form.fields["user_idp"] = ORGANISATION_IDPS[credentials[CREDENTIALS_ORG]]
+                form.fields.setdefault("Select", "Select")
+                return form
+            # external login selection on the ASVZ login page
+            for button in form.buttons:
+                if button.get("title") == "SwitchAai Account Login":
+                    if credentials[CREDENTIALS_ORG] == "ASVZ":
+                        break
+                    if button.get("name"):
+                        form.fields[button["name"]] = button.get("value", "")
+                    return form
+        return None
+
+    def _submit(self, response, form):
+        url = urljoin(response.url, form.action) if form.action else response.url
+        if form.method == "post":
+            return self._request("POST", url, data=form.fields)
+        return self._request("GET", url, params=form.fields)
+
+
+class HttpEnroller(AsvzEnroller):
+    """ AsvzEnroller that logs in, looks up and registers via plain HTTP requests. """
+
+    backend = BACKEND_HTTP
+
+    def __init__(self, lesson_url, creds, id, auth_url=None):
+        super().__init__(lesson_url, creds, id)
+        self.auth_url = auth_url
+
+    def _client(self):
+        return HttpClient(self.base_url, self.auth_url)
+
+    @staticmethod
+    def check_login(credentials, auth_url=None):
+        logger.info("Checking login credentials")
+        # never restores a cached session, the credentials themselves are checked
+        client = HttpClient(auth_url=auth_url)
+        try:
+            return client.login(credentials)
+        except (requests.RequestException, HttpBackendError) as e:
+            logger.warning("HTTP login check failed ({}), falling back to selenium".format(e))
+            return AsvzEnroller.check_login(credentials)
+        finally:
+            client.close()
+
+    def setup(self):
+        client = self._client()
+        try:
+            self._apply_lesson(client.get_lesson(self.lesson_id))
+            logger.info("Lesson title: '{}' at '{}'".format(self.lesson_title, self.lesson_location))
+        except (requests.RequestException, HttpBackendError) as e:
+            logger.warning("HTTP setup failed ({}), falling back to selenium".format(e))
+            super().setup()
+        finally:
+            client.close()
+
+    def _apply_lesson(self, lesson):
+        try:
+            enrollment_from = lesson.get("enrollmentFrom")
+            self.enrollment_start = (
+                parse_api_time(enrollment_from)
+                if enrollment_from
+                # setting enrollment to some date in the past
+                else datetime.today() - timedelta(days=1)
+            )
+            self.lesson_start = parse_api_time(lesson["starts"])
+            self.lesson_title = lesson.get("title") or lesson["sportName"]
+            facilities = lesson.get("facilities") or []
+            self.lesson_location = (
+                ", ".join(facility["name"] for facility in facilities)
+                or lesson.get("location", "")
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise HttpBackendError("Malformed lesson data: {}".format(e))
+
+    def enroll(self):
+        self._wait_for_login()
+
+        client = self._client()
+        try:
+            return self._enroll(client)
+        except (requests.RequestException, HttpBackendError) as e:
+            logger.warning("HTTP enrollment failed ({}), falling back to selenium".format(e))
+            metrics.count("enrollment_retries_total", reason="selenium_fallback", backend=self.backend)
+            return super().enroll()
+        finally:
+            client.close()
+
+    def _enroll(self, client):
+        logger.info("Starting enrollment")
+        enrolled = None
+        with self._span("login"):
+            if client.restore(self.session_state):
+                try:
+                    enrolled = client.is_enrolled(self.lesson_id)
+                    logger.debug("Logged in with cached session")
+                except LoginFailed:
+                    logger.debug("Cached session was rejected")
+                    self.session_state = None
+            if enrolled is None:
+                self._login(client)
+                enrolled = client.is_enrolled(self.lesson_id)
+
+        if enrolled:
+            logger.info("Already enrolled.")
+            raise AlreadyEnrolled
+
+        # login is done ahead of time, registration is only sent once enrollment has opened
+        clock = self._wait_for_opening()
+        if clock is not None:
+            # the lesson is not yet full when it opens, do not lose a round-trip on checking
+            self._log_fire_error(clock, "registration request")
+            with self._span("click"):
+                error = client.enroll(self.lesson_id)
+            if self._enrolled(error):
+                return True
+            logger.info("Registration was rejected ({}), rechecking the lesson.".format(error))
+
+        with self._span("free_place_check"):
+            lesson = client.get_lesson(self.lesson_id)
+            self._check_for_free_places(lesson)
+        logger.info("Lesson has free places.")
+
+        with self._span("click"):
+            error = client.enroll(self.lesson_id)
+        if self._enrolled(error):
+            return True
+        raise HttpBackendError("Enrollment rejected: {}".format(error))
+
+    def _enrolled(self, error):
+        """ Whether the registration went through, raises AlreadyEnrolled or LessonFull like the
+        selenium backend if it was rejected for those, the job keeps checking for free places. """
+        if error is None:
+            logger.info("Successfully enrolled.")
+            return True
+        if "bereits" in error:
+            logger.info("Already enrolled.")
+            raise AlreadyEnrolled
+        if "ausgebucht" in error or "voll" in error:
+            logger.info("Place was already taken in the meantime.")
+            metrics.count("enrollment_retries_total", reason="place_taken", backend=self.backend)
+            raise LessonFull()
+        return False
+
+    @classmethod
+    def enroll_batch(cls, enrollers):
+        first = enrollers[0]
+        first._wait_for_login()
+
+        results = {}
+        client = first._client()
+        try:
+            first._enroll_batch(client, enrollers, results)
+            return results
+        except (requests.RequestException, HttpBackendError) as e:
+            logger.warning("HTTP batch enrollment failed ({}), falling back to selenium".format(e))
+            metrics.count("enrollment_retries_total", reason="selenium_fallback", backend=first.backend)
+            remaining = [enroller for enroller in enrollers if enroller.id not in results]
+            if remaining:
+                results.update(super().enroll_batch(remaining))
+            return results
+        finally:
+            client.close()
+
+    def _enroll_batch(self, client, enrollers, results):
+        logger.info("Starting enrollment of {} lessons".format(len(enrollers)))
+        logged_in = False
+        with self._span("login"):
+            if client.restore(self.session_state):
+                try:
+                    client.is_enrolled(self.lesson_id)
+                    logged_in = True
+                    logger.debug("Logged in with cached session")
+                except LoginFailed:
+                    logger.debug("Cached session was rejected")
+                    self.session_state = None
+            if not logged_in:
+                self._login(client)
+
+        pending = []
+        for enroller in enrollers:
+            if client.is_enrolled(enroller.lesson_id):
+                logger.info("Already enrolled for {}.".format(enroller.lesson_id))
+                results[enroller.id] = AlreadyEnrolled()
+            else:
+                pending.append(enroller)
+
+        clock = self._wait_for_opening()
+        if clock is not None:
+            self._log_fire_error(clock, "registration requests")
+        for enroller in pending:
+            try:
+                if clock is None:
+                    # enrollment opened a while ago, the lesson might be full by now
+                    with enroller._span("free_place_check"):
+                        enroller._check_for_free_places(client.get_lesson(enroller.lesson_id))
+            except (LessonStarted, LessonFull) as e:
+                results[enroller.id] = e
+                continue
+            with enroller._span("click"):
+                error = client.enroll(enroller.lesson_id)
+            if error is None:
+                results[enroller.id] = None
+            elif "bereits" in error:
+                results[enroller.id] = AlreadyEnrolled()
+            elif "ausgebucht" in error or "voll" in error:
+                # the job of the lesson keeps checking for free places
+                results[enroller.id] = LessonFull()
+            else:
+                raise HttpBackendError("Enrollment rejected: {}".format(error))
+        logger.info("Enrolled for {} of {} lessons.".format(list(results.values()).count(None), len(enrollers)))
+        for enroller in enrollers:
+            enroller.session_state = self.session_state
+
+    def _login(self, client):
+        if not client.login(self.creds):
+            # mirror the selenium backend which retries the login once
+            logger.warning("Retrying login...")
+            metrics.count("enrollment_retries_total", reason="login", backend=self.backend)
+            if not client.login(self.creds):
+                self.session_state = None
+                raise LoginFailed("Login failed")
+        self.session_state = client.export()
+
+    def _check_for_free_places(self, lesson):
+        if datetime.today() > self.lesson_start:
+            raise LessonStarted(
+                "Stopping enrollment because lesson has started."
+            )
+        participants_max = lesson.get("participantsMax")
+        participant_count = lesson.get("participantCount") or 0
+        if participants_max is not None and participant_count >= participants_max:
+            logger.info("Lesson is full.")
+            raise LessonFull()
@@ -0,0 +1,99 @@
+import time
+from datetime import timedelta
+
+from database import EnrollmentJob, db
+from app import app as flask_app
+
+""" Registry of enrollment jobs by chat and lesson, the jobstore itself is only touched by the scheduler. """
+
+SCHEDULED = "scheduled"
+WAITING = "waiting"
+
+
+def add_job(job_id, chat_id, lesson_id, metadata):
+    with flask_app.app_context():
+        job = db.session.get(EnrollmentJob, job_id)
+        if job is None:
+            job = EnrollmentJob(job_id=job_id, created_at=time.time())
+            db.session.add(job)
+        job.chat_id = chat_id
+        job.lesson_id = lesson_id
+        job.title = metadata["title"]
+        job.location = metadata["location"]
+        job.enrollment_start = metadata["enrollment_start"]
+        job.lesson_start = metadata["lesson_start"]
+        job.state = SCHEDULED
+        db.session.commit()
+
+
+def get_jobs(chat_id):
+    """ Jobs of a chat in the order they were submitted, detached from the session. """
+    with flask_app.app_context():
+        jobs = db.session.execute(
+            db.select(EnrollmentJob).where(EnrollmentJob.chat_id == chat_id).order_by(EnrollmentJob.created_at, EnrollmentJob.job_id)
+        ).scalars().all()
+        db.session.expunge_all()
+        return jobs
+
+
+def get_group(chat_id, enrollment_start):
+    """ Scheduled jobs of a chat whose lessons open at enrollment_start. """
+    with flask_app.app_context():
+        jobs = db.session.execute(
+            db.select(EnrollmentJob).where(EnrollmentJob.chat_id == chat_id, EnrollmentJob.enrollment_start == enrollment_start, EnrollmentJob.state == SCHEDULED)
+        ).scalars().all()
+        db.session.expunge_all()
+        return jobs
+
+
+def get_opening(enrollment_start):
+    """ Scheduled jobs of all chats whose lessons open within the minute of enrollment_start. """
+    minute = enrollment_start.replace(second=0, microsecond=0)
+    with flask_app.app_context():
+        jobs = db.session.execute(
+            db.select(EnrollmentJob).where(
+                EnrollmentJob.enrollment_start >= minute,
+                EnrollmentJob.enrollment_start < minute + timedelta(minutes=1),
+                EnrollmentJob.state == SCHEDULED,
+            ).order_by(EnrollmentJob.created_at, EnrollmentJob.job_id)
+        ).scalars().all()
+        db.session.expunge_all()
+        return jobs
+
+
+def has_lesson(chat_id, lesson_id):
+    with flask_app.app_context():
+        return db.session.execute(
+            db.select(EnrollmentJob.job_id).where(EnrollmentJob.chat_id == chat_id, EnrollmentJob.lesson_id == lesson_id)
+        ).first() is not None
+
+
+def get_metadata(job_id):
+    """ Lesson details of a job as they were when it was submitted, or None. """
+    with flask_app.app_context():
+        job = db.session.get(EnrollmentJob, job_id)
+        if job is None:
+            return None
+        return {
+            "title": job.title,
+            "location": job.location,
+            "enrollment_start": job.enrollment_start,
+            "lesson_start": job.lesson_start,
+        }
+
+
+def job_ids():
+    with flask_app.app_context():
+        return set(db.session.execute(db.select(EnrollmentJob.job_id)).scalars().all())
+
+
+def set_state(job_id, state):
+    with flask_app.app_context():
+        db.session.execute(db.update(EnrollmentJob).where(EnrollmentJob.job_id == job_id).values(state=state))
+        db.session.commit()
+
+
+def remove_job(job_id):
+    with flask_app.app_context():
+        db.session.execute(db.delete(EnrollmentJob).where(EnrollmentJob.job_id == job_id))
+        db.session.commit()
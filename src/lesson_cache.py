@@ -0,0 +1,48 @@
+import time
+from datetime import datetime
+
+from database import Lesson, db
+from app import app as flask_app
+
+""" Cache of lesson details, so repeated submissions of a lesson do not need a browser. """
+
+# details are scraped again after this many seconds, e.g. to pick up a changed enrollment start
+LESSON_TTL = 6 * 60 * 60
+
+
+def get_lesson(lesson_id):
+    """ Cached metadata of a lesson (see AsvzEnroller.get_metadata) or None. """
+    with flask_app.app_context():
+        lesson = db.session.get(Lesson, lesson_id)
+        if lesson is None:
+            return None
+        if lesson.fetched_at < time.time() - LESSON_TTL or lesson.lesson_start < datetime.today():
+            db.session.delete(lesson)
+            db.session.commit()
+            return None
+        return {
+            "title": lesson.title,
+            "location": lesson.location,
+            "enrollment_start": lesson.enrollment_start,
+            "lesson_start": lesson.lesson_start,
+        }
+
+
+def set_lesson(lesson_id, metadata):
+    with flask_app.app_context():
+        lesson = db.session.get(Lesson, lesson_id)
+        if lesson is None:
+            lesson = Lesson(lesson_id=lesson_id)
+            db.session.add(lesson)
+        lesson.title = metadata["title"]
+        lesson.location = metadata["location"]
+        lesson.enrollment_start = metadata["enrollment_start"]
+        lesson.lesson_start = metadata["lesson_start"]
+        lesson.fetched_at = time.time()
+        db.session.commit()
+
+
+def invalidate_lesson(lesson_id):
+    with flask_app.app_context():
+        db.session.execute(db.delete(Lesson).where(Lesson.lesson_id == lesson_id))
+        db.session.commit()
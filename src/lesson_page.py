@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import re
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+import lxml.html
+from lxml.etree import ParserError
+
+"""
+State of a lesson page parsed from a single snapshot of its DOM.
+
+Probing the page element by element costs a WebDriver round-trip per field and the full
+implicit wait for every element that is expected to be absent (the login button of a
+logged in session, the "ausgebucht" alert of a lesson with free places). Instead the page
+source is fetched once and all fields are read locally with lxml.
+"""
+
+LOGIN_BUTTON_XPATH = "//button[@class='btn btn-default' and @title='Login']"
+FULL_ALERT_XPATH = "//div[@class='alert alert-warning'][contains(., 'ausgebucht')]"
+REGISTER_BUTTON_XPATH = "//button[@id='btnRegister']"
+ENROLLMENT_TIME_XPATH = "//span[contains(., 'Online-Einschreibungen')]"
+LESSON_TIME_XPATH = "//dl[contains(., 'Datum/Zeit')]/dd"
+LOCATION_XPATH = "//dl[contains(., 'Anlage')]/dd"
+TITLE_XPATH = "//h1"
+NOT_FOUND_TAG = "app-page-not-found"
+
+DATETIME_FORMAT = "%d.%m.%Y %H:%M"
+DATETIME_PATTERN = re.compile(r"\d{2}\.\d{2}\.\d{4}\s\d{2}:\d{2}")
+
+# seconds between snapshots while the page is still rendering
+SNAPSHOT_POLL_FREQUENCY = 0.1
+
+
+class PageParseError(Exception):
+    pass
+
+
+@dataclass
+class LessonState:
+    logged_in: bool = False
+    not_found: bool = False
+    full: bool = False
+    # the register button reads "ENTFERNEN"
+    enrolled: bool = False
+    # None if the page does not announce it, e.g. when logged out or already open
+    enrollment_start: Optional[datetime] = None
+    lesson_start: Optional[datetime] = None
+    title: Optional[str] = None
+    location: Optional[str] = None
+
+    @property
+    def rendered(self):
+        """ Whether the lesson (or the not found page) has been rendered by the app. """
+        return self.not_found or self.title is not None
+
+
+def _text(tree, xpath):
+    elements = tree.xpath(xpath)
+    if not elements:
+        return None
+    return " ".join(elements[0].text_content().split())
+
+
+def _parse_time(raw, field):
+    try:
+        return datetime.strptime(raw, DATETIME_FORMAT)
+    except ValueError:
+        raise PageParseError("Failed to parse {}: '{}'".format(field, raw))
+
+
+def parse(html):
+    """ LessonState of a page source, fields that are not on the page are left at their defaults. """
+    try:
+        tree = lxml.html.fromstring(html)
+    except ParserError:
+        return LessonState()
+
+    state = LessonState(
+        logged_in=not tree.xpath(LOGIN_BUTTON_XPATH),
+        not_found=bool(tree.xpath("//" + NOT_FOUND_TAG)),
+        full=bool(tree.xpath(FULL_ALERT_XPATH)),
+        enrolled="ENTFERNEN" in (_text(tree, REGISTER_BUTTON_XPATH) or ""),
+        title=_text(tree, TITLE_XPATH),
+        location=_text(tree, LOCATION_XPATH),
+    )
+
+    # the intro text is only shown when logged in, the enrollment start is its first date
+    intro = _text(tree, ENROLLMENT_TIME_XPATH)
+    match = DATETIME_PATTERN.search(intro or "")
+    if match:
+        state.enrollment_start = _parse_time(match.group(0), "enrollment start time")
+
+    # the interval is like 'Mo, 10.05.2021 06:55 - 08:05'
+    interval = _text(tree, LESSON_TIME_XPATH)
+    if interval:
+        match = DATETIME_PATTERN.search(interval)
+        if match is None:
+            raise PageParseError("Failed to parse lesson start time: '{}'".format(interval))
+        state.lesson_start = _parse_time(match.group(0), "lesson start time")
+    return state
+
+
+def snapshot(driver, timeout=0):
+    """ LessonState of the current page, waits up to `timeout` seconds for the lesson to be rendered. """
+    deadline = time.monotonic() + timeout
+    while True:
+        state = parse(driver.page_source)
+        if state.rendered or time.monotonic() >= deadline:
+            return state
+        time.sleep(SNAPSHOT_POLL_FREQUENCY)
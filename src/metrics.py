@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, MetaData, Table, Column, String, Float, select
+from sqlalchemy.dialects.sqlite import insert
+from loguru import logger
+
+"""
+Enrollment metrics in the Prometheus text format.
+
+Enrollments run in the worker processes of the scheduler, the metrics are served by
+the flask app. Every process collects its samples in memory and adds them to a small
+SQLite table with flush(), which is called once a job is done so the database is never
+written in the middle of an enrollment.
+"""
+
+METRICS_DB_URL = "sqlite:///instance/metrics.db"
+
+PHASE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# seconds between the opening of the enrollment (server clock) and the registration
+DELAY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+COUNTER = "counter"
+HISTOGRAM = "histogram"
+
+# name: (type, help, buckets)
+FAMILIES = {
+    "enrollment_phase_seconds": (HISTOGRAM, "Duration of the phases of an enrollment.", PHASE_BUCKETS),
+    "enrollment_click_delay_seconds": (HISTOGRAM, "Time between the opening of the enrollment and the registration.", DELAY_BUCKETS),
+    "enrollment_outcomes_total": (COUNTER, "Enrollment attempts by outcome.", None),
+    "enrollment_retries_total": (COUNTER, "Retries within an enrollment by reason.", None),
+}
+
+metadata = MetaData()
+
+samples = Table(
+    "metric_sample",
+    metadata,
+    Column("sample", String, primary_key=True),
+    Column("family", String, index=True),
+    Column("value", Float),
+)
+
+_engine = None
+_pending = {}
+_lock = threading.Lock()
+
+
+def _get_engine():
+    # created lazily, so the module can be imported in every process
+    global _engine
+    if _engine is None:
+        _engine = create_engine(METRICS_DB_URL, connect_args={"timeout": 30})
+        metadata.create_all(_engine)
+    return _engine
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _sample(name, labels):
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in sorted(labels.items())))
+
+
+def _add(family, sample, amount):
+    with _lock:
+        entry = _pending.setdefault(sample, [family, 0.0])
+        entry[1] += amount
+
+
+def count(name, amount=1, **labels):
+    _add(name, _sample(name, labels), amount)
+
+
+def observe(name, value, **labels):
+    buckets = FAMILIES[name][2]
+    for bound in buckets + (float("inf"),):
+        if value <= bound:
+            _add(name, _sample(name + "_bucket", dict(labels, le=_format_value(bound))), 1)
+    _add(name, _sample(name + "_sum", labels), value)
+    _add(name, _sample(name + "_count", labels), 1)
+
+
+@contextmanager
+def span(phase, **labels):
+    """ Records the duration of the block in enrollment_phase_seconds. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        logger.debug("Phase {} took {:.3f}s".format(phase, elapsed))
+        observe("enrollment_phase_seconds", elapsed, phase=phase, **labels)
+
+
+def flush():
+    """ Adds the samples collected by this process to the shared table. """
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return
+    try:
+        with _get_engine().begin() as conn:
+            for sample, (family, amount) in pending.items():
+                statement = insert(samples).values(sample=sample, family=family, value=amount)
+                conn.execute(statement.on_conflict_do_update(
+                    index_elements=[samples.c.sample], set_={"value": samples.c.value + amount}
+                ))
+    except Exception as e:
+        # metrics must never break an enrollment
+        logger.warning("Could not store metrics: {}".format(e))
+
+
+def render():
+    """ All metrics in the Prometheus text exposition format. """
+    with _get_engine().connect() as conn:
+        rows = conn.execute(select(samples.c.family, samples.c.sample, samples.c.value).order_by(samples.c.sample)).all()
+    lines = []
+    for name, (kind, description, _) in FAMILIES.items():
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.extend("{} {}".format(sample, _format_value(value)) for family, sample, value in rows if family == name)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,122 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from telegram.error import RetryAfter, Forbidden, BadRequest, TelegramError
+from loguru import logger
+
+from database import OutboxMessage, db
+from app import app as flask_app
+from ratelimit import RateLimiter, retry_delay
+
+"""
+Persistent outbox for notifications from the enrollment workers.
+
+Workers only insert rows into the outbox table. A single dispatcher running on the
+bot's event loop delivers them with the bot's long-lived connection, respecting
+telegram's rate limits, retrying failures and picking up pending messages after
+a restart. The outbox is read and updated on a worker thread, never on the event loop.
+"""
+
+POLL_INTERVAL = 1.0
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 6
+RETRY_BACKOFF = 5
+
+
+def queue_message(chat_id, message):
+    now = time.time()
+    with flask_app.app_context():
+        db.session.add(OutboxMessage(chat_id=chat_id, message=message, created_at=now, attempts=0, next_attempt_at=now))
+        db.session.commit()
+
+
+class Dispatcher:
+    def __init__(self, bot, limiter=None):
+        self.bot = bot
+        self.limiter = limiter or RateLimiter()
+        # one thread, so the updates of the outbox do not contend for the database lock
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+
+    async def _io(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def _due(self):
+        """ Due messages in order. A chat whose oldest pending message waits for a retry gets none,
+        so its later messages do not overtake it. """
+        now = time.time()
+        with flask_app.app_context():
+            pending = db.session.execute(
+                db.select(OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.message, OutboxMessage.attempts, OutboxMessage.next_attempt_at)
+                .where(OutboxMessage.sent_at.is_(None), OutboxMessage.error.is_(None))
+                .order_by(OutboxMessage.id)
+            ).all()
+        due = []
+        blocked = set()
+        for message_id, chat_id, message, attempts, next_attempt_at in pending:
+            if chat_id in blocked:
+                continue
+            if next_attempt_at > now:
+                blocked.add(chat_id)
+                continue
+            due.append((message_id, chat_id, message, attempts))
+            if len(due) >= BATCH_SIZE:
+                break
+        return due
+
+    def _update(self, message_id, **values):
+        with flask_app.app_context():
+            db.session.execute(db.update(OutboxMessage).where(OutboxMessage.id == message_id).values(**values))
+            db.session.commit()
+
+    async def _send(self, message_id, chat_id, text, attempts):
+        await self.limiter.wait(chat_id)
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter as e:
+            logger.warning(f"Rate limited by telegram, retrying message {message_id} later")
+            await self._io(self._update, message_id, next_attempt_at=time.time() + retry_delay(e))
+            return False
+        except (Forbidden, BadRequest) as e:
+            # the user blocked the bot or the chat does not exist anymore, retrying will not help
+            logger.warning(f"Dropping message {message_id} to {chat_id}: {e}")
+            await self._io(self._update, message_id, error=str(e))
+            return True
+        except TelegramError as e:
+            attempts += 1
+            if attempts >= MAX_ATTEMPTS:
+                logger.error(f"Giving up on message {message_id} to {chat_id}: {e}")
+                await self._io(self._update, message_id, attempts=attempts, error=str(e))
+            else:
+                await self._io(self._update, message_id, attempts=attempts, next_attempt_at=time.time() + RETRY_BACKOFF * 2 ** attempts)
+            return False
+        await self._io(self._update, message_id, sent_at=time.time())
+        return True
+
+    async def _send_chat(self, messages):
+        # messages of a chat are delivered in order, stop at the first one that has to be retried
+        for message in messages:
+            if not await self._send(*message):
+                return
+
+    async def dispatch(self):
+        """ Sends all due messages, returns how many there were. """
+        due = await self._io(self._due)
+        chats = {}
+        for message in due:
+            chats.setdefault(message[1], []).append(message)
+        await asyncio.gather(*(self._send_chat(messages) for messages in chats.values()))
+        return len(due)
+
+    async def run(self):
+        logger.info("Notification dispatcher started")
+        while True:
+            try:
+                if await self.dispatch() == 0:
+                    await asyncio.sleep(POLL_INTERVAL)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Notification dispatcher failed: {e}")
+                await asyncio.sleep(POLL_INTERVAL)
@@ -0,0 +1,34 @@
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+""" Runs blocking work (selenium setups, logins) off the telegram event loop. """
+
+
+class SubmissionPipeline:
+    """ Bounded pool of background workers with a limit of concurrent submissions per user.
+
+    Only to be used from within the event loop, the bookkeeping is not thread safe.
+    """
+
+    def __init__(self, workers, per_user, name="pipeline"):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.per_user = per_user
+        self.active = defaultdict(int)
+
+    def _release(self, key):
+        self.active[key] -= 1
+        if self.active[key] <= 0:
+            del self.active[key]
+
+    def pending(self):
+        return sum(self.active.values())
+
+    def submit(self, key, func, *args):
+        """ Runs func(*args) in the background. Returns an awaitable future or None if `key` is at its limit. """
+        if self.active[key] >= self.per_user:
+            return None
+        self.active[key] += 1
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        future.add_done_callback(lambda _: self._release(key))
+        return future
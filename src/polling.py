@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import time
+from datetime import timedelta
+
+from apscheduler.triggers.base import BaseTrigger
+
+from timing import to_timestamp
+
+"""
+Adaptive polling schedule for full lessons.
+
+Free places mostly show up right after enrollment opens (people unenroll from a
+lesson they grabbed too eagerly) and in the hours before the lesson, when plans
+change. The policy polls densely in those phases, sparsely in between, and
+additionally follows the cancellations observed so far.
+"""
+
+MIN_INTERVAL = 10
+MAX_INTERVAL = 300
+
+# (seconds since enrollment opened, interval)
+AFTER_OPENING = [(15 * 60, 10), (2 * 60 * 60, 30)]
+# (seconds until the lesson starts, interval)
+BEFORE_LESSON = [(60 * 60, 10), (3 * 60 * 60, 20), (12 * 60 * 60, 60)]
+
+# a cancellation of this lesson makes further ones likely for a while
+RECENT_CANCELLATION_WINDOW = 10 * 60
+RECENT_CANCELLATION_INTERVAL = 10
+# hours before lesson start at which cancellations are grouped
+HISTORY_BUCKETS = [1, 2, 4, 8, 24, 48]
+# share of all observed cancellations a bucket needs to be considered hot
+HOT_BUCKET_SHARE = 0.25
+HOT_BUCKET_INTERVAL = 30
+
+# observations older than this are ignored for the cancellation profile
+HISTORY_WINDOW = 28 * 24 * 60 * 60
+
+# polling continues this long after the lesson start, so the last poll notices it
+STOP_AFTER_START = 10 * 60
+
+# returns (unix times of recent cancellations of a lesson, hours before start of all observed cancellations)
+history_provider = None
+
+
+def _bucket(hours_before):
+    for index, limit in enumerate(HISTORY_BUCKETS):
+        if hours_before < limit:
+            return index
+    return len(HISTORY_BUCKETS)
+
+
+class PollingPolicy:
+    def __init__(self, enrollment_start, lesson_start, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        self.enrollment_start = to_timestamp(enrollment_start)
+        self.lesson_start = to_timestamp(lesson_start)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def reasons(self, now, recent=(), history=()):
+        """ All rules that apply at unix time `now` as (interval, reason), densest first. """
+        reasons = [(self.max_interval, "default")]
+
+        since_opening = now - self.enrollment_start
+        for limit, interval in AFTER_OPENING:
+            if 0 <= since_opening < limit:
+                reasons.append((interval, "enrollment opened {:.0f} min ago".format(since_opening / 60)))
+                break
+
+        until_start = self.lesson_start - now
+        for limit, interval in BEFORE_LESSON:
+            if 0 <= until_start < limit:
+                reasons.append((interval, "lesson starts in {:.1f} h".format(until_start / 3600)))
+                break
+
+        if any(now - observed < RECENT_CANCELLATION_WINDOW for observed in recent):
+            reasons.append((RECENT_CANCELLATION_INTERVAL, "recent cancellation"))
+
+        if history:
+            bucket = _bucket(until_start / 3600)
+            share = sum(1 for hours in history if _bucket(hours) == bucket) / len(history)
+            if share >= HOT_BUCKET_SHARE:
+                reasons.append((HOT_BUCKET_INTERVAL, "{:.0%} of cancellations happen at this time".format(share)))
+
+        return sorted(
+            (min(max(interval, self.min_interval), self.max_interval), reason)
+            for interval, reason in reasons
+        )
+
+    def interval(self, now, recent=(), history=()):
+        return self.reasons(now, recent, history)[0][0]
+
+    def finished(self, now):
+        return now > self.lesson_start + STOP_AFTER_START
+
+
+class AdaptiveTrigger(BaseTrigger):
+    """ APScheduler trigger firing at the interval of a PollingPolicy. """
+
+    def __init__(self, lesson_id, enrollment_start, lesson_start):
+        self.lesson_id = lesson_id
+        self.enrollment_start = enrollment_start
+        self.lesson_start = lesson_start
+
+    @property
+    def policy(self):
+        return PollingPolicy(self.enrollment_start, self.lesson_start)
+
+    def _history(self):
+        if history_provider is None:
+            return (), ()
+        return history_provider(self.lesson_id)
+
+    def explain(self, now=None):
+        """ Current interval and the rule it comes from, e.g. (10, 'lesson starts in 0.5 h'). """
+        now = time.time() if now is None else now
+        return self.policy.reasons(now, *self._history())[0]
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        timestamp = now.timestamp()
+        policy = self.policy
+        if policy.finished(timestamp):
+            return None
+        interval = policy.interval(timestamp, *self._history())
+        if previous_fire_time is None:
+            return now
+        return previous_fire_time + timedelta(seconds=interval)
+
+    def __getstate__(self):
+        return {
+            "version": 1,
+            "lesson_id": self.lesson_id,
+            "enrollment_start": self.enrollment_start,
+            "lesson_start": self.lesson_start,
+        }
+
+    def __setstate__(self, state):
+        self.lesson_id = state["lesson_id"]
+        self.enrollment_start = state["enrollment_start"]
+        self.lesson_start = state["lesson_start"]
+
+    def __str__(self):
+        interval, reason = self.explain()
+        return "adaptive[every {}s: {}]".format(interval, reason)
+
+    def __repr__(self):
+        return "<AdaptiveTrigger (lesson_id='{}', lesson_start='{}')>".format(self.lesson_id, self.lesson_start)
@@ -0,0 +1,43 @@
+import asyncio
+import time
+from datetime import timedelta
+
+""" Rate limiting for messages sent through the telegram bot API. """
+
+# telegram allows about 30 messages per second overall and one per second per chat
+GLOBAL_RATE = 25
+PER_CHAT_INTERVAL = 1.0
+
+
+class RateLimiter:
+    """ Token bucket for the global rate plus a minimum interval between messages to the same chat. """
+
+    def __init__(self, rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.last_sent = {}
+        self.lock = asyncio.Lock()
+
+    async def wait(self, chat_id):
+        while True:
+            async with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                chat_delay = self.last_sent.get(chat_id, -self.per_chat_interval) + self.per_chat_interval - now
+                if self.tokens >= 1 and chat_delay <= 0:
+                    self.tokens -= 1
+                    self.last_sent[chat_id] = now
+                    return
+                delay = max(chat_delay, (1 - self.tokens) / self.rate)
+            await asyncio.sleep(delay)
+
+
+def retry_delay(error):
+    """ Seconds telegram asks us to wait, RetryAfter carries an int or a timedelta depending on the version. """
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
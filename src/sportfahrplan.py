@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import requests
+from loguru import logger
+
+from enroller import AsvzBotException, FACILITIES, LEVELS, get_lesson_id
+from http_enroller import parse_api_time
+
+"""
+Lookup of lessons in the Sportfahrplan, the weekly schedule of all ASVZ lessons.
+
+The Sportfahrplan page (SPORTFAHRPLAN_BASE_URL) loads its lessons from a JSON search
+endpoint filtered with the same facets as the page, which is queried here directly.
+"""
+
+EVENT_SEARCH_URL = "https://asvz.ch/asvz_api/event_search"
+REQUEST_TIMEOUT = 10
+PAGE_SIZE = 60
+# a day of lessons of a single facility easily fits, this bounds runaway paging
+MAX_PAGES = 10
+
+TIMEFORMAT = "%H:%M"
+
+
+def _facets(facility=None, level=None):
+    facets = []
+    if facility is not None:
+        facets.append("facility:{}".format(FACILITIES[facility]))
+    if level is not None:
+        facets.append("niveau:{}".format(LEVELS[level]))
+    return {"f[{}]".format(i): facet for i, facet in enumerate(facets)}
+
+
+def _names(value):
+    if isinstance(value, list):
+        return ", ".join(str(v) for v in value)
+    return value or ""
+
+
+def parse_events(data):
+    """ Lessons of a search response, events without a schalter lesson or that were cancelled are skipped. """
+    lessons = []
+    for event in data.get("results", []):
+        url = event.get("url") or ""
+        if "/tn/lessons/" not in url or event.get("cancelled"):
+            continue
+        try:
+            lessons.append({
+                "lesson_id": get_lesson_id(url),
+                "url": url,
+                "sport": event.get("sport_name") or "",
+                "title": event.get("title") or event.get("sport_name") or "",
+                "facility": _names(event.get("facility_name")),
+                "level": _names(event.get("niveau_name")),
+                "start": parse_api_time(event["from_date"]),
+                "end": parse_api_time(event["to_date"]) if event.get("to_date") else None,
+            })
+        except (KeyError, ValueError, AsvzBotException) as e:
+            logger.debug("Skipping malformed event {}: {}".format(event.get("nid"), e))
+    return lessons
+
+
+def search(start, end, facility=None, level=None, session=None):
+    """ All lessons starting between start and end, optionally of a facility and level (keys of FACILITIES and LEVELS). """
+    get = (session or requests).get
+    params = {"_format": "json", "limit": PAGE_SIZE, "date": start.strftime("%Y-%m-%d %H:%M")}
+    params.update(_facets(facility, level))
+    lessons = []
+    for page in range(MAX_PAGES):
+        params["offset"] = page * PAGE_SIZE
+        response = get(EVENT_SEARCH_URL, params=params, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+        events = parse_events(data)
+        lessons.extend(lesson for lesson in events if start <= lesson["start"] < end)
+        if len(data.get("results", [])) < PAGE_SIZE or (events and events[-1]["start"] >= end):
+            break
+    return lessons
+
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import time
+from email.utils import parsedate_to_datetime
+
+import pytz
+import requests
+from loguru import logger
+
+"""
+Precise timing of the registration against the clock of the ASVZ servers.
+
+The offset to the server clock is estimated from the `Date` header of a few
+requests. The header only has a resolution of one second, but every response
+bounds the offset to an interval; spreading the requests over a second boundary
+and intersecting the intervals narrows it down to a few tens of milliseconds.
+"""
+
+# lesson and enrollment times on the website are local times in Zurich
+LESSON_TIMEZONE = pytz.timezone("Europe/Zurich")
+
+SYNC_SAMPLES = 8
+SYNC_SPACING = 0.13
+# a sync with SYNC_SAMPLES takes about this many seconds, closer to the opening only
+# QUICK_SYNC_SAMPLES are taken so the sync does not delay the registration
+SYNC_DURATION = 2
+QUICK_SYNC_SAMPLES = 2
+SYNC_TIMEOUT = 5
+# offsets are reused for this many seconds before estimating again
+SYNC_TTL = 10 * 60
+
+# sleep coarsely until this many seconds before the target, then spin
+SPIN_WINDOW = 0.05
+COARSE_STEP = 0.5
+
+
+def to_timestamp(local_time):
+    """ Unix time of a naive local time as displayed on the ASVZ website. """
+    return LESSON_TIMEZONE.localize(local_time).timestamp()
+
+
+class ClockSync:
+    def __init__(self, url):
+        self.url = url
+        # server time minus local time in seconds
+        self.offset = 0.0
+        self.uncertainty = None
+        self.synced_at = None
+
+    def server_time(self):
+        return time.time() + self.offset
+
+    def estimate(self, samples=SYNC_SAMPLES):
+        lower, upper, midpoints = float("-inf"), float("inf"), []
+        with requests.Session() as session:
+            for sample in range(samples):
+                if sample > 0:
+                    time.sleep(SYNC_SPACING)
+                sent = time.time()
+                try:
+                    response = session.head(self.url, timeout=SYNC_TIMEOUT, allow_redirects=False)
+                except requests.RequestException as e:
+                    logger.debug("Clock sync request failed: {}".format(e))
+                    continue
+                received = time.time()
+                date = response.headers.get("Date")
+                if date is None:
+                    continue
+                server = parsedate_to_datetime(date).timestamp()
+                # the server stamped the response somewhere between sending and receiving,
+                # at a time within the second of the header
+                lower = max(lower, server - received)
+                upper = min(upper, server + 1 - sent)
+                midpoints.append(server + 0.5 - (sent + received) / 2)
+
+        if not midpoints:
+            logger.warning("Could not estimate server clock offset, using local clock")
+            return self.offset
+        if lower <= upper:
+            self.offset = (lower + upper) / 2
+            self.uncertainty = (upper - lower) / 2
+        else:
+            # inconsistent samples (e.g. load balanced servers with differing clocks)
+            self.offset = sum(midpoints) / len(midpoints)
+            self.uncertainty = 0.5
+        self.synced_at = time.time()
+        logger.info(
+            "Server clock offset: {:+.3f}s (±{:.3f}s)".format(self.offset, self.uncertainty)
+        )
+        return self.offset
+
+    def refresh(self, samples=SYNC_SAMPLES):
+        if self.synced_at is None or time.time() - self.synced_at > SYNC_TTL:
+            self.estimate(samples)
+        return self
+
+    def wait_until(self, target):
+        """ Blocks until the server clock reaches the unix time `target`. Returns True if it had to wait. """
+        local_target = target - self.offset
+        if time.time() >= local_target:
+            return False
+        while local_target - time.time() > COARSE_STEP + SPIN_WINDOW:
+            time.sleep(COARSE_STEP)
+        remaining = local_target - time.time() - SPIN_WINDOW
+        if remaining > 0:
+            time.sleep(remaining)
+        while time.time() < local_target:
+            pass
+        return True
+
+    def log_fire_error(self, target, action):
+        error = self.server_time() - target
+        logger.info("Fired {} {:+.1f}ms after opening (server clock)".format(action, error * 1000))
+        return error
+
+
+# one clock per url and process, workers are long-lived
+_clocks = {}
+
+
+def get_clock(url, deadline=None):
+    """ The synced clock of `url`. If the unix time `deadline` is too close for a full sync, a quick one is done. """
+    if url not in _clocks:
+        _clocks[url] = ClockSync(url)
+    samples = SYNC_SAMPLES
+    if deadline is not None and deadline - time.time() < SYNC_DURATION:
+        samples = QUICK_SYNC_SAMPLES
+    return _clocks[url].refresh(samples)
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+"""
+Cache of the users of the bot by chat id.
+
+Every Telegram update is authorized by looking up the user of its chat, the cache turns
+that into a dictionary lookup for chats seen recently. Entries expire after TTL seconds
+and at most MAX_ENTRIES chats are kept. The bot invalidates the chats it changes itself.
+The web app, admin.py and the enrollment workers change users in other processes, they call touch() which bumps
+the modification time of a marker file next to the database, and the bot drops the
+whole cache when it sees that time change.
+"""
+
+TTL = 5 * 60
+MAX_ENTRIES = 1024
+MARKER_FILENAME = "users.changed"
+
+
+def marker_path(app):
+    return os.path.join(app.instance_path, MARKER_FILENAME)
+
+
+def touch(app):
+    """ Tells the bot that users changed, call after committing the change. """
+    path = Path(marker_path(app))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+
+
+class UserCache:
+    def __init__(self, marker, ttl=TTL, max_entries=MAX_ENTRIES):
+        self.marker = marker
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # chat id: (expires, user), least recently used first
+        self._entries = OrderedDict()
+        # the poller threads look up users as well
+        self._lock = threading.Lock()
+        # bumped by every invalidation, a user loaded before it is not cached
+        self._generation = 0
+        self._marker_mtime = self._read_marker()
+
+    def _read_marker(self):
+        try:
+            return os.stat(self.marker).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def get(self, chat_id, load):
+        """ The user of `chat_id`, calls load(chat_id) if it is not cached. Chats without a user are cached as None. """
+        now = time.monotonic()
+        mtime = self._read_marker()
+        with self._lock:
+            if mtime != self._marker_mtime:
+                self._entries.clear()
+                self._generation += 1
+                self._marker_mtime = mtime
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(chat_id)
+                return entry[1]
+            generation = self._generation
+        user = load(chat_id)
+        with self._lock:
+            if generation != self._generation:
+                return user
+            self._entries[chat_id] = (now + self.ttl, user)
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, *chat_ids):
+        with self._lock:
+            for chat_id in chat_ids:
+                self._entries.pop(chat_id, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
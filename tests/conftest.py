@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+import yaml
+from werkzeug.serving import make_server
+
+# the modules of the bot import each other as top level modules
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+# the bot and the app read config.yaml and keep their databases relative to the working
+# directory, the tests get a scratch one so they never touch a real instance
+WORKDIR = Path(tempfile.mkdtemp(prefix="asvz-tests-"))
+(WORKDIR / "instance").mkdir()
+with open(WORKDIR / "config.yaml", "w") as f:
+    yaml.safe_dump({
+        "bot": {"token": "123:test", "link": "https://t.me/test"},
+        "app": {"secret": "dGVzdHRlc3R0ZXN0dGVzdHRlc3R0ZXN0dGVzdHRlc3Q=", "url": "http://localhost"},
+        "enroller": {"backend": "selenium"},
+    }, f)
+os.chdir(WORKDIR)
+
+import database  # noqa: E402
+
+database.DATABASE_URI = "sqlite:///{}".format(WORKDIR / "instance" / "asvz.db")
+
+
+@pytest.fixture
+def serve():
+    """ Serves flask apps on free local ports for the duration of a test, returns their base urls. """
+    servers = []
+
+    def start(app):
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return "http://127.0.0.1:{}".format(server.server_port)
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def flask_app():
+    """ The app with empty tables. """
+    from app import app
+
+    with app.app_context():
+        database.db.drop_all()
+        database.create_all()
+    return app
@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+
+from flask import Flask, request, redirect, jsonify
+
+""" Stub of the schalter API and the ASVZ login for the HTTP backend, see test_http_enroller.py. """
+
+PASSWORD = "secret"
+TOKEN = "stub-token"
+
+LOGIN_FORM = """<html><body>
+<form action="/account/login" method="post">
+  <input type="hidden" name="ReturnUrl" value="{return_url}">
+  <input id="AsvzId" name="AsvzId" type="text">
+  <input id="Password" name="Password" type="password">
+  <button type="submit">Login</button>
+</form>
+<form action="/account/external" method="post">
+  <button name="provider" value="SwitchAai" title="SwitchAai Account Login">SwitchAAI</button>
+</form>
+</body></html>"""
+
+
+def _iso(moment):
+    return moment.astimezone(timezone.utc).isoformat()
+
+
+class StubSchalter:
+    def __init__(self, capacity=10, opened=timedelta(hours=2), starts_in=timedelta(days=1)):
+        now = datetime.now(timezone.utc)
+        self.capacity = capacity
+        self.enrollment_from = now - opened
+        self.starts = now + starts_in
+        self.enrolled = set()
+        self.logins = []
+        # the lesson API answers with server errors
+        self.broken = False
+        # message enrollments are rejected with although the lesson has free places
+        self.reject = None
+        self.enroll_requests = 0
+
+    def lesson(self, lesson_id):
+        return {
+            "id": int(lesson_id),
+            "title": "Stub Yoga",
+            "sportName": "Yoga",
+            "facilities": [{"name": "Sport Center Polyterrasse"}],
+            "enrollmentFrom": _iso(self.enrollment_from),
+            "starts": _iso(self.starts),
+            "participantsMax": self.capacity,
+            "participantCount": len(self.enrolled),
+        }
+
+    def create_app(self):
+        app = Flask(__name__)
+
+        def authorized():
+            return request.headers.get("Authorization") == "Bearer " + TOKEN
+
+        @app.route("/connect/authorize")
+        def authorize():
+            return LOGIN_FORM.format(return_url=request.args["redirect_uri"])
+
+        @app.route("/account/login", methods=["POST"])
+        def login():
+            self.logins.append(request.form.get("AsvzId"))
+            if request.form.get("Password") != PASSWORD:
+                return LOGIN_FORM.format(return_url=request.form["ReturnUrl"])
+            return redirect("{}#access_token={}&expires_in=3600".format(request.form["ReturnUrl"], quote(TOKEN)))
+
+        @app.route("/tn/assets/oidc-login-redirect.html")
+        def login_redirect():
+            return "<html></html>"
+
+        @app.route("/tn-api/api/Lessons/<lesson_id>")
+        def lesson(lesson_id):
+            if self.broken:
+                return "", 500
+            return jsonify({"data": self.lesson(lesson_id)})
+
+        @app.route("/tn-api/api/Lessons/<lesson_id>/MyEnrollment")
+        def my_enrollment(lesson_id):
+            if not authorized():
+                return "", 401
+            return ("", 200) if lesson_id in self.enrolled else ("", 404)
+
+        @app.route("/tn-api/api/Lessons/<lesson_id>/Enrollment", methods=["POST"])
+        def enroll(lesson_id):
+            self.enroll_requests += 1
+            if not authorized():
+                return "", 401
+            if self.reject is not None:
+                return jsonify({"errors": [{"message": self.reject}]}), 422
+            if lesson_id in self.enrolled:
+                return jsonify({"errors": [{"message": "Sie sind bereits eingeschrieben."}]}), 422
+            if len(self.enrolled) >= self.capacity:
+                return jsonify({"errors": [{"message": "Die Lektion ist ausgebucht."}]}), 422
+            self.enrolled.add(lesson_id)
+            return jsonify({"data": {}}), 201
+
+        return app
@@ -0,0 +1,84 @@
+import json
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+import catalog
+import sportfahrplan
+from database import CatalogLesson, db
+
+FIXTURES = Path(__file__).parent / "fixtures"
+FACILITY = "Sport Center Polyterrasse"
+# the fixtures cover the 4th and 5th of March 2030
+NOW = datetime(2030, 3, 4, 6, 0)
+
+
+def recorded(name):
+    """ A search function answering with a recorded event search response, for FACILITY only. """
+    with open(FIXTURES / name) as f:
+        lessons = sportfahrplan.parse_events(json.load(f))
+
+    def search(start, end, facility=None, level=None, session=None):
+        if facility != FACILITY:
+            return []
+        return [lesson for lesson in lessons if start <= lesson["start"] < end]
+    return search
+
+
+@pytest.fixture(params=["fts", "like"])
+def store(request, flask_app, monkeypatch):
+    """ An empty catalog, searched through the full-text index or with LIKE. """
+    with flask_app.app_context():
+        db.session.execute(db.text(f"DROP TABLE IF EXISTS {catalog.FTS_TABLE}"))
+        db.session.commit()
+    monkeypatch.setattr(catalog, "_fts", None if request.param == "fts" else False)
+    return request.param
+
+
+def titles(**criteria):
+    return [lesson.title for lesson in catalog.search(after=NOW, **criteria)]
+
+
+def test_parse_events():
+    with open(FIXTURES / "event_search.json") as f:
+        lessons = sportfahrplan.parse_events(json.load(f))
+    # the cancelled lesson and the course without a schalter lesson are skipped
+    assert [lesson["lesson_id"] for lesson in lessons] == ["310001", "310002", "310005", "310006"]
+    assert lessons[0]["start"] == datetime(2030, 3, 4, 7, 30)
+    assert lessons[2]["level"] == "Alle, Fortgeschrittene"
+
+
+def test_sync(store):
+    # the first sync records every day of every facility, most of them empty
+    assert catalog.sync(search=recorded("event_search.json"), now=NOW) == len(catalog.FACILITIES) * catalog.HORIZON_DAYS
+    assert titles() == ["Yoga Vinyasa", "Crossfit Basics", "Spinning", "Yin Yoga"]
+    lesson = catalog.search(text="crossfit", after=NOW)[0]
+    assert (lesson.facility, lesson.level, lesson.weekday, lesson.time) == (FACILITY, "Mittlere", "Mo", "12:15")
+    # nothing is fetched again while the days are fresh
+    assert catalog.sync(search=recorded("event_search_changed.json"), now=NOW) == 0
+
+
+def test_replace_day(store, flask_app):
+    catalog.sync(search=recorded("event_search.json"), now=NOW)
+    with flask_app.app_context():
+        catalog._replace_day(FACILITY, NOW.date(), recorded("event_search_changed.json")(NOW.replace(hour=0), NOW.replace(day=5, hour=0), facility=FACILITY))
+        db.session.commit()
+        assert db.session.get(CatalogLesson, "310002") is None
+    # the lessons of the other day stay, the changed title is searchable and the dropped lesson is gone
+    assert titles() == ["Yoga Hatha", "Spinning", "Yin Yoga"]
+    assert titles(text="hatha") == ["Yoga Hatha"]
+    assert titles(text="vinyasa") == []
+    assert titles(text="crossfit") == []
+
+
+def test_search(store):
+    catalog.sync(search=recorded("event_search.json"), now=NOW)
+    assert titles(text="yoga") == ["Yoga Vinyasa", "Yin Yoga"]
+    assert titles(text="yog vin") == ["Yoga Vinyasa"]
+    assert titles(text="yoga", weekday="Tu") == ["Yin Yoga"]
+    assert titles(text="yoga", start_time="07:30") == ["Yoga Vinyasa"]
+    assert titles(level="Mittlere") == ["Crossfit Basics"]
+    assert titles(facility="Sport Center Irchel") == []
+    # quotes in the input do not break the query
+    titles(text='yoga" OR')
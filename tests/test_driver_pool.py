@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import driver_pool
+from driver_pool import DriverPool, Node, sessions
+
+NODES = [Node("http://node-1:4444/wd/hub", 2), Node("http://node-2:4444/wd/hub", 2)]
+
+
+@pytest.fixture
+def pool(tmp_path):
+    return DriverPool(None, lambda: None, url="sqlite:///{}".format(tmp_path / "driver_pool.db"), nodes=NODES)
+
+
+def add_session(pool, session_id, node, in_use, age, idle=0, pid=None):
+    now = time.time()
+    if in_use and pid is None:
+        pid = os.getpid()
+    with pool.engine.begin() as conn:
+        conn.execute(sessions.insert().values(
+            id=session_id, key="alice_ASVZ", created=now - age, last_used=now - idle, in_use=in_use, node=node.url, pid=pid,
+        ))
+
+
+def session_ids(pool):
+    with pool.engine.connect() as conn:
+        return set(conn.execute(sessions.select().with_only_columns(sessions.c.id)).scalars().all())
+
+
+def dead_pid():
+    worker = subprocess.Popen([sys.executable, "-c", "pass"])
+    worker.wait()
+    return worker.pid
+
+
+def test_purge_keeps_sessions_in_use(pool):
+    old = driver_pool.SESSION_MAX_AGE + 60
+    add_session(pool, "busy-old", NODES[0], True, old)
+    add_session(pool, "busy-old-2", NODES[1], True, old)
+    add_session(pool, "idle-old", NODES[1], False, old)
+    add_session(pool, "idle-expired", NODES[0], False, 60, idle=driver_pool.SESSION_MAX_IDLE + 1)
+    add_session(pool, "idle-fresh", NODES[0], False, 60)
+
+    with pool.engine.begin() as conn:
+        stale = pool._purge(conn, time.time())
+        left = set(conn.execute(sessions.select().with_only_columns(sessions.c.id)).scalars().all())
+
+    # sessions in use are recycled by release() once their worker is done
+    assert sorted(stale) == [("idle-expired", NODES[0].url), ("idle-old", NODES[1].url)]
+    assert left == {"busy-old", "busy-old-2", "idle-fresh"}
+
+
+def test_purge_reclaims_sessions_of_dead_workers(pool):
+    crashed = dead_pid()
+    add_session(pool, "held-by-crashed", NODES[0], True, 60, pid=crashed)
+    add_session(pool, "pending-{}-1.0".format(crashed), NODES[1], True, 1, pid=crashed)
+    # held for longer than any job takes, although the process still runs
+    add_session(pool, "held-forever", NODES[1], True, 60, idle=driver_pool.SESSION_MAX_AGE + driver_pool.IN_USE_MARGIN + 1)
+    add_session(pool, "held", NODES[0], True, driver_pool.SESSION_MAX_AGE + 60, idle=driver_pool.SESSION_MAX_AGE)
+
+    with pool.engine.begin() as conn:
+        stale = pool._purge(conn, time.time())
+
+    assert {session_id for session_id, _ in stale} == {"held-by-crashed", "pending-{}-1.0".format(crashed), "held-forever"}
+    assert session_ids(pool) == {"held"}
+
+
+def test_reset(pool, monkeypatch):
+    quit = []
+    monkeypatch.setattr(pool, "_quit", lambda session_id, node: quit.append(session_id))
+    add_session(pool, "held", NODES[0], True, 60)
+    add_session(pool, "idle", NODES[1], False, 60)
+    add_session(pool, "pending-1-1.0", NODES[1], True, 1)
+
+    pool.reset()
+
+    assert session_ids(pool) == set()
+    assert sorted(quit) == ["held", "idle"]
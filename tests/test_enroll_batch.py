@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import enroller
+import http_enroller
+from enroller import AsvzEnroller, CredentialsManager, LessonFull, BACKEND_HTTP, get_enroller
+from stub_schalter import StubSchalter, PASSWORD
+
+FULL_PAGE = """<html><body><app-root>
+<span>Online-Einschreibungen sind ab 01.01.2020 06:00 möglich.</span>
+<h1>Yoga</h1>
+<dl><dt>Datum/Zeit</dt><dd>Mo, {start} - 19:00</dd></dl>
+<dl><dt>Anlage</dt><dd>Polyterrasse</dd></dl>
+<div class="alert alert-warning">Diese Lektion ist ausgebucht.</div>
+</app-root></body></html>"""
+
+
+class FakeDriver:
+    """ A browser session with tabs that only serves full lesson pages. """
+
+    def __init__(self):
+        self.window_handles = ["tab-0"]
+        self.current_window_handle = "tab-0"
+        self.visited = []
+        self.switch_to = self
+
+    def new_window(self, kind):
+        handle = "tab-{}".format(len(self.window_handles))
+        self.window_handles.append(handle)
+        self.current_window_handle = handle
+
+    def window(self, handle):
+        self.current_window_handle = handle
+
+    def close(self):
+        self.window_handles.remove(self.current_window_handle)
+
+    def get(self, url):
+        self.visited.append(url)
+
+    def implicitly_wait(self, seconds):
+        pass
+
+    @property
+    def page_source(self):
+        start = datetime.today() + timedelta(days=1)
+        return FULL_PAGE.format(start=start.strftime("%d.%m.%Y %H:%M"))
+
+
+class FakePool:
+    def __init__(self):
+        self.driver = FakeDriver()
+        self.held = 0
+
+    def acquire(self, key, fresh=False):
+        self.held += 1
+        return self.driver
+
+    def release(self, key, driver, broken=None):
+        self.held -= 1
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(enroller, "DRIVER_POOL", pool)
+    return pool
+
+
+def selenium_enroller(lesson_id):
+    lesson_url = "https://schalter.asvz.ch/tn/lessons/{}".format(lesson_id)
+    instance = AsvzEnroller(lesson_url, CredentialsManager("ASVZ", "alice", "secret").get(), lesson_id)
+    opening = datetime.today() - timedelta(hours=2)
+    instance.set_metadata({"title": "Yoga", "location": "Polyterrasse", "enrollment_start": opening, "lesson_start": opening + timedelta(days=1)})
+    return instance
+
+
+def test_selenium_enroll_batch(pool):
+    enrollers = [selenium_enroller("1234"), selenium_enroller("5678")]
+    results = AsvzEnroller.enroll_batch(enrollers)
+    assert set(results) == {"1234", "5678"}
+    assert all(isinstance(result, LessonFull) for result in results.values())
+    assert pool.driver.visited == [instance.lesson_url for instance in enrollers]
+    # the session goes back to the pool with a single tab
+    assert pool.held == 0
+    assert pool.driver.window_handles == ["tab-0"]
+
+
+@pytest.fixture
+def base_url(serve, monkeypatch):
+    stub = StubSchalter()
+    url = serve(stub.create_app())
+    monkeypatch.setattr(http_enroller, "AUTH_BASE_URL", url)
+    return url, stub
+
+
+def http_enrollers(url):
+    return [
+        get_enroller("{}/tn/lessons/{}".format(url, lesson_id), "alice", PASSWORD, "ASVZ", backend=BACKEND_HTTP, id=lesson_id)
+        for lesson_id in ("1234", "5678")
+    ]
+
+
+def test_http_enroll_batch(base_url):
+    url, stub = base_url
+    enrollers = http_enrollers(url)
+    results = type(enrollers[0]).enroll_batch(enrollers)
+    assert results == {"1234": None, "5678": None}
+    assert stub.enrolled == {"1234", "5678"}
+    # one login for all lessons
+    assert stub.logins == ["alice"]
+
+
+def test_http_enroll_batch_falls_back_to_selenium(base_url, pool):
+    url, stub = base_url
+    enrollers = http_enrollers(url)
+    stub.broken = True
+    results = type(enrollers[0]).enroll_batch(enrollers)
+    assert set(results) == {"1234", "5678"}
+    assert len(pool.driver.visited) == 2
+    assert stub.enrolled == set()
@@ -0,0 +1,90 @@
+from datetime import timedelta
+
+import pytest
+
+import http_enroller
+from enroller import AlreadyEnrolled, LessonFull, BACKEND_HTTP, get_enroller
+from http_enroller import HttpClient, HttpEnroller
+from stub_schalter import StubSchalter, PASSWORD, TOKEN
+
+
+@pytest.fixture
+def stub():
+    return StubSchalter()
+
+
+@pytest.fixture
+def base_url(serve, stub):
+    return serve(stub.create_app())
+
+
+@pytest.fixture
+def auth_url(base_url, monkeypatch):
+    monkeypatch.setattr(http_enroller, "AUTH_BASE_URL", "https://auth.invalid")
+    http_enroller.configure_auth_url(base_url)
+    return base_url
+
+
+def lesson_enroller(base_url, password=PASSWORD):
+    return get_enroller(base_url + "/tn/lessons/1234", "alice", password, "ASVZ", backend=BACKEND_HTTP)
+
+
+def test_login(base_url, stub):
+    client = HttpClient(base_url, base_url)
+    try:
+        assert client.login({"organisation": "ASVZ", "username": "alice", "password": PASSWORD})
+    finally:
+        client.close()
+    assert client.access_token == TOKEN
+    assert stub.logins == ["alice"]
+
+
+def test_invalid_credentials(auth_url):
+    assert not HttpEnroller.check_login({"organisation": "ASVZ", "username": "alice", "password": "wrong"})
+
+
+def test_setup(auth_url):
+    enroller = lesson_enroller(auth_url)
+    assert enroller.lesson_title == "Stub Yoga"
+    assert enroller.lesson_location == "Sport Center Polyterrasse"
+    assert enroller.enrollment_start < enroller.lesson_start
+
+
+def test_enroll(auth_url, stub):
+    enroller = lesson_enroller(auth_url)
+    assert enroller.enroll()
+    # logged in on the configured identity server
+    assert stub.logins == ["alice"]
+    assert stub.enrolled == {"1234"}
+    # the login is cached for the next enrollment
+    assert enroller.session_state["access_token"] == TOKEN
+    with pytest.raises(AlreadyEnrolled):
+        enroller.enroll()
+    assert len(stub.logins) == 1
+
+
+def test_enroll_full(auth_url, stub):
+    stub.capacity = 0
+    with pytest.raises(LessonFull):
+        lesson_enroller(auth_url).enroll()
+    assert stub.enrolled == set()
+
+
+def test_enroll_taken_after_check(auth_url, stub):
+    # the lesson still shows free places, but they are gone when registering
+    stub.reject = "Die Lektion ist ausgebucht."
+    with pytest.raises(LessonFull):
+        lesson_enroller(auth_url).enroll()
+    assert stub.enroll_requests == 1
+
+
+def test_enroll_already_enrolled_at_opening(serve, monkeypatch):
+    stub = StubSchalter(opened=-timedelta(seconds=2))
+    url = serve(stub.create_app())
+    monkeypatch.setattr(http_enroller, "AUTH_BASE_URL", url)
+    enroller = lesson_enroller(url)
+    # enrolled elsewhere after the login
+    stub.reject = "Sie sind bereits eingeschrieben."
+    with pytest.raises(AlreadyEnrolled):
+        enroller.enroll()
+    assert stub.enroll_requests == 1
@@ -0,0 +1,34 @@
+from datetime import datetime
+from pathlib import Path
+
+import lesson_page
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def parse(name):
+    return lesson_page.parse((FIXTURES / name).read_text(encoding="utf-8"))
+
+
+def test_full_lesson():
+    state = parse("lesson_full.html")
+    assert state.rendered and state.logged_in and state.full and not state.enrolled
+    assert state.title == "Yoga Vinyasa"
+    assert state.location == "Sport Center Polyterrasse"
+    # the first date of the intro is the start of the enrollment
+    assert state.enrollment_start == datetime(2030, 3, 2, 7, 30)
+    assert state.lesson_start == datetime(2030, 3, 4, 7, 30)
+
+
+def test_logged_out():
+    state = parse("lesson_logged_out.html")
+    assert state.rendered and not state.logged_in and not state.full
+    # only shown when logged in
+    assert state.enrollment_start is None
+    assert state.lesson_start == datetime(2030, 3, 4, 12, 15)
+
+
+def test_not_found():
+    state = parse("lesson_not_found.html")
+    assert state.rendered and state.not_found
+    assert state.title is None
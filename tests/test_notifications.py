@@ -0,0 +1,44 @@
+import asyncio
+
+from telegram.error import TelegramError
+
+import notifications
+from database import OutboxMessage, db
+from notifications import Dispatcher, queue_message
+from ratelimit import RateLimiter
+
+
+class FakeBot:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        if text in self.failing:
+            self.failing.remove(text)
+            raise TelegramError("timed out")
+        self.sent.append((chat_id, text))
+
+
+def dispatch(dispatcher):
+    return asyncio.run(dispatcher.dispatch())
+
+
+def test_retry_keeps_order_of_chat(flask_app, monkeypatch):
+    bot = FakeBot(failing=["first"])
+    dispatcher = Dispatcher(bot, RateLimiter(per_chat_interval=0))
+    for text in ("first", "second"):
+        queue_message(1, text)
+    queue_message(2, "other")
+
+    dispatch(dispatcher)
+    assert bot.sent == [(2, "other")]
+    # the first message waits for its retry, the second must not overtake it
+    dispatch(dispatcher)
+    assert bot.sent == [(2, "other")]
+
+    monkeypatch.setattr(notifications.time, "time", lambda: 1e12)
+    dispatch(dispatcher)
+    assert bot.sent == [(2, "other"), (1, "first"), (1, "second")]
+    with flask_app.app_context():
+        assert db.session.execute(db.select(OutboxMessage).where(OutboxMessage.sent_at.is_(None))).first() is None
@@ -0,0 +1,81 @@
+import pickle
+from datetime import datetime, timedelta
+
+import pytest
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from database import User, db
+from enroller import AsvzEnroller, CredentialsManager
+from utils import encrypt
+
+LESSON_URL = "https://schalter.asvz.ch/tn/lessons/1234"
+OTHER_URL = "https://schalter.asvz.ch/tn/lessons/5678"
+CHAT_ID = 42
+
+
+@pytest.fixture
+def bot(flask_app, monkeypatch):
+    import bot
+
+    with flask_app.app_context():
+        db.session.add(User(
+            username="alice", asvz_username="alice", asvz_organisation="ASVZ", verified=1, chat_id=CHAT_ID,
+            asvz_password=encrypt("secret", bot.config["app"]["secret"]),
+        ))
+        db.session.commit()
+    # the stored jobs must not run, nor the catalog sync and subscription jobs of the bot
+    monkeypatch.setattr(bot.scheduler, "resume", lambda: None)
+    yield bot
+    if bot.scheduler.running:
+        bot.scheduler.shutdown(wait=False)
+
+
+def metadata():
+    opening = datetime.today().replace(microsecond=0) + timedelta(days=1)
+    return {"title": "Yoga", "location": "Polyterrasse", "enrollment_start": opening, "lesson_start": opening + timedelta(days=2)}
+
+
+def legacy_enroll(enroller, chat_id, notify_full=True):
+    """ Signature of bot.enroll when jobs carried the pickled enroller. """
+
+
+def store_jobs(*jobs):
+    """ Writes jobs to the jobstore of the bot like a previous run of it did. """
+    store = SQLAlchemyJobStore(url="sqlite:///instance/jobs.db")
+    scheduler = BackgroundScheduler(jobstores={"default": store})
+    scheduler.start(paused=True)
+    scheduler.remove_all_jobs()
+    for func, args, job_id in jobs:
+        scheduler.add_job(func, args=args, id=job_id, trigger="interval", seconds=30, start_date=datetime.today() + timedelta(hours=1))
+    # the old jobs referenced bot.enroll, which no longer takes their arguments
+    with store.engine.begin() as conn:
+        for job_id, state in conn.execute(store.jobs_t.select().with_only_columns(store.jobs_t.c.id, store.jobs_t.c.job_state)).all():
+            job = pickle.loads(state)
+            if job["func"].endswith(":legacy_enroll"):
+                job["func"] = "bot:enroll"
+                conn.execute(store.jobs_t.update().where(store.jobs_t.c.id == job_id).values(job_state=pickle.dumps(job)))
+    scheduler.shutdown(wait=False)
+
+
+def test_restart_with_existing_jobstore(bot):
+    import job_registry
+
+    # a job of a version that pickled the enroller and had no registry
+    legacy = AsvzEnroller(LESSON_URL, CredentialsManager("ASVZ", "alice", "secret").get(), "alice_ASVZ_" + LESSON_URL)
+    legacy.set_metadata(metadata())
+    current_id = "alice_ASVZ_" + OTHER_URL
+    store_jobs(
+        (legacy_enroll, (legacy, CHAT_ID), legacy.id),
+        (bot.enroll, (current_id, "alice", OTHER_URL, CHAT_ID), current_id),
+    )
+    job_registry.add_job(current_id, CHAT_ID, "5678", metadata())
+    job_registry.add_job("gone", CHAT_ID, "9999", metadata())
+
+    bot.start_scheduler()
+
+    assert job_registry.job_ids() == {legacy.id, current_id}
+    assert bot.scheduler.get_job(legacy.id).args == (legacy.id, "alice", LESSON_URL, CHAT_ID)
+    # the enroller is rebuilt from the registry, without loading the lesson page
+    assert job_registry.get_metadata(legacy.id)["title"] == "Yoga"
+    assert bot.load_enroller(legacy.id, bot.get_user_from_chat_id(CHAT_ID), LESSON_URL).lesson_title == "Yoga"
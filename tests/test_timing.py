@@ -0,0 +1,63 @@
+import time
+from datetime import timedelta
+
+import pytest
+from flask import Flask
+
+import http_enroller
+import timing
+from enroller import BACKEND_HTTP, get_enroller
+from stub_schalter import StubSchalter, PASSWORD
+
+
+@pytest.fixture(autouse=True)
+def clocks(monkeypatch):
+    monkeypatch.setattr(timing, "_clocks", {})
+    monkeypatch.setattr(timing, "SYNC_SPACING", 0)
+
+
+@pytest.fixture
+def server(serve):
+    """ A server answering HEAD requests with its Date header, counts them. """
+    app = Flask(__name__)
+    app.requests = 0
+
+    @app.route("/")
+    def index():
+        app.requests += 1
+        return ""
+
+    return serve(app), app
+
+
+def test_full_sync(server):
+    url, app = server
+    clock = timing.get_clock(url)
+    assert app.requests == timing.SYNC_SAMPLES
+    assert abs(clock.offset) < 1
+    # the offset is reused
+    assert timing.get_clock(url, deadline=time.time()) is clock
+    assert app.requests == timing.SYNC_SAMPLES
+
+
+def test_quick_sync_close_to_deadline(server):
+    url, app = server
+    timing.get_clock(url, deadline=time.time() + timing.SYNC_DURATION / 2)
+    assert app.requests == timing.QUICK_SYNC_SAMPLES
+
+
+def test_sync_before_login(serve, monkeypatch):
+    # opens after the time a full sync takes
+    stub = StubSchalter(opened=-timedelta(seconds=timing.SYNC_DURATION + 1))
+    url = serve(stub.create_app())
+    monkeypatch.setattr(http_enroller, "AUTH_BASE_URL", url)
+    enroller = get_enroller(url + "/tn/lessons/1234", "alice", PASSWORD, "ASVZ", backend=BACKEND_HTTP)
+
+    events = []
+    estimate, login = timing.ClockSync.estimate, http_enroller.HttpClient.login
+    monkeypatch.setattr(timing.ClockSync, "estimate", lambda self, samples: events.append(("sync", samples)) or estimate(self, samples))
+    monkeypatch.setattr(http_enroller.HttpClient, "login", lambda self, creds: events.append(("login",)) or login(self, creds))
+
+    assert enroller.enroll()
+    # waiting for the opening after the login does not sync again
+    assert events == [("sync", timing.SYNC_SAMPLES), ("login",)]